@@ -1,17 +1,40 @@
 # 各分析コードを統合した完全版(テクニカル分析＋個別株分析)
 import os
+import json
+import hashlib
+import hmac
+import logging
+import queue
 import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
 import yfinance as yf
+from yfinance.exceptions import YFRateLimitError
 import feedparser
 import urllib.parse
 import time
 import markdown
-from flask import Flask, render_template, request, jsonify, send_file
+from contextlib import contextmanager
+from flask import Flask, render_template, request, jsonify, send_file, g, has_request_context, Response
+from flask_compress import Compress
 from io import BytesIO
 import pdfkit
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import backtest
+import columnar
+import prompts
+import search
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# サンプリングプロファイラ (任意。インストールされている場合のみ利用可能)
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
 
 # 最新のGeminiライブラリをインポート
 from google import genai
@@ -22,13 +45,154 @@ load_dotenv()
 
 app = Flask(__name__)
 
+# --- ログ設定 (リクエストごとの計測結果をJSON形式で出力) ---
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("nikkei_app")
+
+# --- レスポンス圧縮 (JSON・Markdown・静的ファイルをbrotli/gzipで返す) ---
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_ALGORITHM_STREAMING"] = ["br", "gzip"]  # send_fileで返す静的ファイル用
+app.config["COMPRESS_MIMETYPES"] = [
+    "application/json", "text/markdown", "text/html", "text/css", "application/javascript", "text/javascript",
+]
+Compress(app)
+
+# 静的ファイルURLに付与するハッシュを長期キャッシュする期間 (1年)
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+# --- 計測 (Prometheusメトリクス・処理段階ごとの所要時間) ---
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "ルートごとのリクエスト処理時間",
+    ["route", "method", "status"], buckets=LATENCY_BUCKETS,
+)
+STAGE_LATENCY = Histogram(
+    "app_stage_duration_seconds", "処理段階 (fetch/db/compute/llm/pdf/serialize) ごとの所要時間",
+    ["route", "stage"], buckets=LATENCY_BUCKETS,
+)
+LLM_LATENCY = Histogram(
+    "gemini_request_duration_seconds", "Geminiモデルごとの応答時間",
+    ["model", "route"], buckets=LATENCY_BUCKETS,
+)
+LLM_ERRORS = Counter("gemini_request_errors_total", "Gemini呼び出しの失敗回数", ["model", "route"])
+LLM_TOKENS = Counter(
+    "gemini_tokens_total", "Geminiの入出力トークン数 (kind: prompt/cached/output)", ["model", "route", "kind"],
+)
+
+# 環境変数 PROFILER_ENABLED=1 の時だけ ?profile=1 付きリクエストをプロファイルする
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+
+# /metrics は環境変数 METRICS_TOKEN を設定した時だけ公開し、同じトークンを持つリクエスト
+# (Authorization: Bearer <token> または ?token=<token>) にだけ返す
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+def current_route():
+    # 計測ラベル用のルート名 (リクエスト外ならbackground)
+    if has_request_context():
+        return request.endpoint or "unknown"
+    return "background"
+
+@contextmanager
+def stage(name):
+    # 処理段階の所要時間を計測し、メトリクスとリクエスト内のスパン一覧に記録する
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.labels(route=current_route(), stage=name).observe(elapsed)
+        if has_request_context() and "spans" in g:
+            g.spans[name] = g.spans.get(name, 0.0) + elapsed
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.spans = {}
+    g.profiler = None
+    if PROFILER_ENABLED and Profiler is not None and request.args.get("profile") == "1":
+        g.profiler = Profiler()
+        g.profiler.start()
+
+@app.after_request
+def record_request_metrics(response):
+    if "request_start" not in g or request.endpoint in ("metrics", "static"):
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    route = request.endpoint or "unknown"
+    REQUEST_LATENCY.labels(route=route, method=request.method, status=response.status_code).observe(elapsed)
+
+    # ブラウザの開発者ツールで確認できるようServer-Timingヘッダーにも付与
+    response.headers["Server-Timing"] = ", ".join(
+        [f"{name};dur={sec * 1000:.1f}" for name, sec in g.spans.items()] + [f"total;dur={elapsed * 1000:.1f}"]
+    )
+
+    if g.profiler is not None:
+        g.profiler.stop()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profile_path = os.path.join(PROFILE_DIR, f"{route}_{datetime.now():%Y%m%d%H%M%S%f}.html")
+        with open(profile_path, "w", encoding="utf-8") as f:
+            f.write(g.profiler.output_html())
+        response.headers["X-Profile-Path"] = profile_path
+
+    logger.info(json.dumps({
+        "route": route, "method": request.method, "status": response.status_code,
+        "duration_ms": round(elapsed * 1000, 1),
+        "spans_ms": {name: round(sec * 1000, 1) for name, sec in g.spans.items()},
+    }, ensure_ascii=False))
+    return response
+
+def generate_content(model, contents, config=None):
+    # Gemini呼び出しをモデル別に計測するラッパー
+    route = current_route()
+    start = time.perf_counter()
+    try:
+        with stage("llm"):
+            response = client.models.generate_content(model=model, contents=contents, config=config)
+    except Exception:
+        LLM_ERRORS.labels(model=model, route=route).inc()
+        raise
+    finally:
+        LLM_LATENCY.labels(model=model, route=route).observe(time.perf_counter() - start)
+
+    # キャッシュの効果を確認できるよう、入力のうちキャッシュから読まれたトークン数も記録する
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        for kind, count in (("prompt", usage.prompt_token_count), ("cached", usage.cached_content_token_count),
+                            ("output", usage.candidates_token_count)):
+            if count:
+                LLM_TOKENS.labels(model=model, route=route, kind=kind).inc(count)
+    return response
+
+def generate_from_template(model, template, flags=None, thinking_level=None, **fields):
+    # プロンプトテンプレートから生成する。固定部分はキャッシュ済みならその名前で参照し、なければsystem_instructionで送る
+    _, contents = prompts.render(template, flags, **fields)
+    extra = {}
+    if thinking_level:
+        extra["thinking_config"] = types.ThinkingConfig(include_thoughts=True, thinking_level=thinking_level)
+
+    config, cached = prompt_cache.config(model, template, **extra)
+    if cached:
+        try:
+            return generate_content(model=model, contents=contents, config=config)
+        except Exception as e:
+            # キャッシュの期限切れ・削除などで失敗した場合だけ、キャッシュを使わずにやり直す
+            if not prompts.is_cache_error(e): raise
+            logger.warning(f"Cached prompt failed for {template}, retrying without cache: {e}")
+            prompt_cache.invalidate(model, template)
+            config = prompts.uncached_config(template, **extra)
+    return generate_content(model=model, contents=contents, config=config)
+
 # --- Gemini クライアントの初期化 (最新SDK方式) ---
 try:
     client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
 except Exception as e:
-    print(f"Gemini Client Init Error: {e}")
+    logger.error(f"Gemini Client Init Error: {e}")
     client = None
 
+# プロンプトの固定部分をSDKのキャッシュに登録する (PROMPT_CACHE=0 で無効化)
+prompt_cache = prompts.PromptCache(client, enabled=os.getenv("PROMPT_CACHE", "1") == "1")
+
 # 使用するGeminiモデルの設定
 MODEL_NAME = "gemini-3-flash-preview"
 MODEL_LITE = "gemini-2.5-flash-lite" # 会社説明用
@@ -38,6 +202,122 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CSV_PATH = os.path.join(BASE_DIR, 'stocks.csv')  # 銘柄リストCSV
 DB_PATH = os.path.join(BASE_DIR, 'stocks.db')    # 株価保存用DB
 
+# --- 外部APIの流量制御 (ホストごとのトークンバケット + 同一リクエストの集約) ---
+# Yahoo Finance などへのアクセスが集中すると流量制限 (HTTP 429) を受けるため、
+# 全リクエストで共有するトークンバケットで呼び出しの頻度を抑え、制限を受けたら一定時間呼び出しを止める。
+# 0 を指定するとそのホストの制限を無効化する
+UPSTREAM_WAIT = float(os.getenv("UPSTREAM_WAIT", "3"))            # トークンが空いた時に待つ最大秒数
+UPSTREAM_COOLDOWN = float(os.getenv("UPSTREAM_COOLDOWN", "60"))   # 流量制限を受けた後に呼び出しを止める秒数
+UPSTREAM_RETRY_AFTER = 30                                        # 上流が使えない時にクライアントへ返す再試行までの秒数
+
+UPSTREAM_CALLS = Counter("upstream_requests_total", "外部APIの呼び出し結果 (result: ok/error/throttled/rejected)", ["host", "result"])
+STALE_RESPONSES = Counter("stale_responses_total", "上流の失敗時に保存済みの古いデータを返した回数", ["route", "kind"])
+
+class UpstreamThrottled(Exception):
+    # 流量制限中のため外部APIを呼び出さなかった (または上流から429が返った)
+    pass
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        # トークンを1つ取得する。timeout秒以内に取得できなければFalse
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def cool_down(self, seconds):
+        # 上流から流量制限を受けたので、しばらく全スレッドの呼び出しを止める
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+def make_bucket(rate_env, burst_env, rate, burst):
+    rate = float(os.getenv(rate_env, rate))
+    return TokenBucket(rate, int(os.getenv(burst_env, burst))) if rate > 0 else None
+
+UPSTREAM_LIMITS = {
+    "yahoo": make_bucket("YAHOO_RATE_PER_SEC", "YAHOO_BURST", 2, 10),
+    "google_news": make_bucket("NEWS_RATE_PER_SEC", "NEWS_BURST", 1, 5),
+}
+
+def is_rate_limit_error(e):
+    if isinstance(e, YFRateLimitError):
+        return True
+    message = str(e)
+    return "Too Many Requests" in message or "429" in message
+
+@contextmanager
+def upstream(host, timeout=None):
+    # 外部APIを呼び出す処理を囲む。トークンを取れない・流量制限を受けた場合は UpstreamThrottled を送出する
+    bucket = UPSTREAM_LIMITS.get(host)
+    if bucket is not None and not bucket.acquire(UPSTREAM_WAIT if timeout is None else timeout):
+        UPSTREAM_CALLS.labels(host=host, result="rejected").inc()
+        raise UpstreamThrottled(f"{host}: too many requests")
+    try:
+        yield
+    except Exception as e:
+        if not is_rate_limit_error(e):
+            UPSTREAM_CALLS.labels(host=host, result="error").inc()
+            raise
+        UPSTREAM_CALLS.labels(host=host, result="throttled").inc()
+        logger.warning(f"Upstream rate limited ({host}), cooling down {UPSTREAM_COOLDOWN:.0f}s: {e}")
+        if bucket is not None:
+            bucket.cool_down(UPSTREAM_COOLDOWN)
+        raise UpstreamThrottled(f"{host}: rate limited") from e
+    UPSTREAM_CALLS.labels(host=host, result="ok").inc()
+
+def fetch_history(ticker, period, interval):
+    # yf.download は銘柄ごとの例外 (流量制限を含む) を握りつぶして空のDataFrameを返すため、Ticker.history で取得する
+    # (流量制限は YFRateLimitError として送出されるので、upstream() でクールダウン・代替データへの切り替えができる)
+    df = yf.Ticker(ticker).history(period=period, interval=interval, auto_adjust=True, actions=False)
+    return df[[c for c in ['Open', 'High', 'Low', 'Close', 'Volume'] if c in df.columns]]
+
+class SingleFlight:
+    # 同じキーの処理が実行中なら、後から来たスレッドは新たに呼び出さずその結果 (または例外) を待って共有する
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+        if not leader:
+            call["done"].wait()
+        else:
+            try:
+                call["result"] = fn()
+            except Exception as e:
+                call["error"] = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call["done"].set()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+
+inflight = SingleFlight()
+
 # 銘柄リストCSVからデータを読み込む関数
 def load_stock_data():
     if not os.path.exists(CSV_PATH):
@@ -61,6 +341,32 @@ def load_stock_data():
     stocks = df.to_dict(orient='records') # 全銘柄リスト
     return industries, stocks
 
+# --- 銘柄検索 (銘柄リストから作った検索インデックスを、CSVが更新されるまで使い回す) ---
+SEARCH_DEFAULT_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
+STOCK_FIELDS = ("ticker", "name", "industry")
+
+_search_index = None
+_search_index_version = None
+_search_index_lock = threading.Lock()
+
+def stock_list_version():
+    # 銘柄リストCSVの更新日時 (CSVがなければNone)
+    return os.path.getmtime(CSV_PATH) if os.path.exists(CSV_PATH) else None
+
+def get_search_index():
+    global _search_index, _search_index_version
+    version = stock_list_version()
+    with _search_index_lock:
+        if _search_index is None or _search_index_version != version:
+            _, stocks = load_stock_data()
+            _search_index = search.SearchIndex(stocks)
+            _search_index_version = version
+        return _search_index
+
+def stock_summary(stock):
+    return {key: stock.get(key) for key in STOCK_FIELDS}
+
 # --- Google News RSS 取得関数 ---
 def fetch_rss_news(topics, limit=200):
     if not topics:
@@ -76,7 +382,13 @@ def fetch_rss_news(topics, limit=200):
 
         encoded_topic = urllib.parse.quote(topic)
         rss_url = f"https://news.google.com/rss/search?q={encoded_topic}&hl=ja&gl=JP&ceid=JP:ja"
-        feed = feedparser.parse(rss_url)
+        try:
+            with stage("fetch"), upstream("google_news"):
+                feed = feedparser.parse(rss_url)
+        except UpstreamThrottled as e:
+            # 流量制限中は残りのトピックを取得せず、集まった分だけで分析する
+            logger.warning(f"News fetch skipped: {e}")
+            break
 
         if not feed.entries:
             continue
@@ -105,151 +417,1456 @@ def fetch_rss_news(topics, limit=200):
 
     return "\n\n".join(news_items), None, date_range_str
 
-# 取得した株価データをSQLite3データベースに保存する関数
-def store_to_db(ticker_symbol, df):
-    if df.empty: return
-    conn = sqlite3.connect(DB_PATH)
-    # 記号を除去してテーブル名を作成 (例: ^N225 -> N225_prices)
-    table_name = ticker_symbol.replace("^", "").replace(".", "_") + "_prices"
-    df_to_save = df.reset_index()
-    df_to_save.to_sql(table_name, conn, if_exists="replace", index=False)
-    conn.close()
+# --- チャートの期間(period)・足種(interval)設定 ---
+# yfinanceのperiod指定と、DBの保存データから切り出す際のオフセット（短い順）
+PERIOD_OFFSETS = {
+    "5d": pd.DateOffset(days=7),
+    "1mo": pd.DateOffset(months=1),
+    "3mo": pd.DateOffset(months=3),
+    "6mo": pd.DateOffset(months=6),
+    "1y": pd.DateOffset(years=1),
+    "2y": pd.DateOffset(years=2),
+    "5y": pd.DateOffset(years=5),
+    "10y": pd.DateOffset(years=10),
+    "max": None,
+}
+PERIOD_ORDER = list(PERIOD_OFFSETS.keys())
+
+# 足種ごとに指定可能な最長期間 (Yahoo側の取得制限に合わせる)
+INTERVAL_MAX_PERIOD = {
+    "5m": "1mo", "15m": "1mo", "30m": "1mo", "60m": "2y",
+    "1d": "max", "1wk": "max", "1mo": "max",
+}
+INTRADAY_INTERVALS = {"5m", "15m", "30m", "60m"}
+
+DEFAULT_PERIOD = "1y"
+DEFAULT_INTERVAL = "1d"
+
+# チャート表示用の最大ポイント数 (これを超える場合はLTTBで間引く)
+DEFAULT_MAX_POINTS = 800
+MIN_MAX_POINTS, MAX_MAX_POINTS = 100, 5000
+
+# DBに保存したデータを再利用する有効期間 (秒)
+STORE_TTL_INTRADAY = 5 * 60
+STORE_TTL_DAILY = 6 * 60 * 60
+
+# 株価バーの保存形式 ("sqlite": price_barsテーブル / "columnar": 銘柄ごとの列指向ファイルをメモリマップ)
+# どちらの場合も取得日時などの管理情報はSQLiteに保存する
+PRICE_STORE = os.getenv("PRICE_STORE", "sqlite")
+
+# --- SQLite アクセス層 (スレッドごとの接続プール + 単一ライターキュー) ---
+# 株価は銘柄・足種・日時を主キーにした1つのテーブルに保存し、UPSERTで差分更新する
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS price_bars (
+    ticker TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    open REAL, high REAL, low REAL, close REAL, volume REAL,
+    PRIMARY KEY (ticker, interval, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS price_fetches (
+    ticker TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    period TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (ticker, interval)
+);
+CREATE TABLE IF NOT EXISTS company_profiles (
+    ticker TEXT PRIMARY KEY,
+    name TEXT,
+    info TEXT NOT NULL,
+    model TEXT,
+    generated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS profile_claims (
+    ticker TEXT PRIMARY KEY,
+    claimed_until REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS market_digests (
+    digest_key TEXT PRIMARY KEY,
+    analysis TEXT NOT NULL,
+    date_range TEXT,
+    model TEXT,
+    generated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS digest_claims (
+    claim_key TEXT PRIMARY KEY,
+    claimed_until REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fundamentals (
+    ticker TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+"""
+UPSERT_BAR_SQL = """
+INSERT INTO price_bars (ticker, interval, ts, open, high, low, close, volume) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (ticker, interval, ts) DO UPDATE SET
+    open = excluded.open, high = excluded.high, low = excluded.low, close = excluded.close, volume = excluded.volume
+"""
+UPSERT_FETCH_SQL = """
+INSERT INTO price_fetches (ticker, interval, period, fetched_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (ticker, interval) DO UPDATE SET period = excluded.period, fetched_at = excluded.fetched_at
+"""
+UPSERT_PROFILE_SQL = """
+INSERT INTO company_profiles (ticker, name, info, model, generated_at) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (ticker) DO UPDATE SET
+    name = excluded.name, info = excluded.info, model = excluded.model, generated_at = excluded.generated_at
+"""
+UPSERT_FUNDAMENTALS_SQL = """
+INSERT INTO fundamentals (ticker, data, fetched_at) VALUES (?, ?, ?)
+ON CONFLICT (ticker) DO UPDATE SET data = excluded.data, fetched_at = excluded.fetched_at
+"""
+# 予約期限が切れている場合だけ予約を上書きする (上書きできなければ他のワーカーが生成中)
+CLAIM_PROFILE_SQL = """
+INSERT INTO profile_claims (ticker, claimed_until) VALUES (?, ?)
+ON CONFLICT (ticker) DO UPDATE SET claimed_until = excluded.claimed_until WHERE profile_claims.claimed_until < ?
+"""
+UPSERT_DIGEST_SQL = """
+INSERT INTO market_digests (digest_key, analysis, date_range, model, generated_at) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (digest_key) DO UPDATE SET
+    analysis = excluded.analysis, date_range = excluded.date_range, model = excluded.model, generated_at = excluded.generated_at
+"""
+CLAIM_DIGEST_SQL = """
+INSERT INTO digest_claims (claim_key, claimed_until) VALUES (?, ?)
+ON CONFLICT (claim_key) DO UPDATE SET claimed_until = excluded.claimed_until WHERE digest_claims.claimed_until < ?
+"""
+DB_TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+# 1回のトランザクションにまとめる書き込みジョブの最大数
+DB_WRITE_BATCH = 64
+# flush() で書き込みの完了を待つ最大時間 (秒)
+DB_FLUSH_TIMEOUT = 60
+
+_db_local = threading.local()
+_db_schema_lock = threading.Lock()
+_db_initialized_paths = set()
+
+def get_db(path=None):
+    # スレッドごとに接続を1本だけ開いて使い回す (synchronous=NORMAL)
+    path = path or DB_PATH
+    conns = getattr(_db_local, "conns", None)
+    if conns is None:
+        conns = _db_local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30, cached_statements=256)
+        # WALにすると、ライタースレッドの書き込み中も他のスレッド・ワーカーの読み出しが待たされない
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        with _db_schema_lock:
+            if path not in _db_initialized_paths:
+                conn.executescript(DB_SCHEMA)
+                _db_initialized_paths.add(path)
+        conns[path] = conn
+    return conn
+
+class DBWriter:
+    # 全スレッドからの書き込みを1本のスレッドに集約し、溜まったジョブを1トランザクションで書き込む
+    # ジョブは (種類, DBのパス, 内容, 完了通知) で、種類は bars (株価バー) / sql (1件のSQL) / flush
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # gunicornのfork後に各ワーカーで起動されるよう、最初の書き込み時に開始する
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, ticker, interval, period, rows):
+        # 株価バーと取得記録を書き込む
+        return self._put("bars", DB_PATH, (ticker, interval, period, rows, time.time()))
+
+    def execute(self, sql, params):
+        # 結果を使わない1件の書き込み (ファンダメンタルズ・プロフィールなどのUPSERT)
+        return self._put("sql", DB_PATH, (sql, params))
+
+    def flush(self, timeout=DB_FLUSH_TIMEOUT):
+        # キューに積まれた書き込みがすべて終わるまで待つ (時間内に終わらなければFalse)
+        return self._put("flush", None, None).wait(timeout)
+
+    def _put(self, kind, path, payload):
+        self._ensure_started()
+        done = threading.Event()
+        self._queue.put((kind, path, payload, done))
+        return done
+
+    def _run(self):
+        while True:
+            jobs = [self._queue.get()]
+            while len(jobs) < DB_WRITE_BATCH:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(jobs)
+            except Exception as e:
+                # 想定外の例外でライタースレッドが止まらないよう、このバッチだけ諦めて続ける
+                logger.exception(f"DB writer error: {e}")
+            finally:
+                for job in jobs:
+                    job[-1].set()
+
+    def _merge(self, jobs):
+        # DBごとに (株価バー, SQL) のジョブをまとめる。同じ銘柄・足種のバーは1つにまとめ
+        # (バーは日時ごとに新しいジョブの値を優先して統合し、期間は長いほう・取得日時は新しいほうを記録する)、
+        # SQLは積まれた順に実行する
+        by_path = {}
+        for kind, path, payload, _ in jobs:
+            if kind == "flush":
+                continue
+            bars, statements = by_path.setdefault(path, ({}, []))
+            if kind == "sql":
+                statements.append(payload)
+                continue
+            ticker, interval, period, rows, fetched_at = payload
+            key = (ticker, interval)
+            if key in bars:
+                old_period, old_rows, old_fetched_at = bars[key]
+                if isinstance(old_rows, dict) and isinstance(rows, dict):
+                    rows = columnar.merge_bars(old_rows, rows)
+                else:
+                    # UPSERTは後の行が優先されるため、古い行の後ろに新しい行を並べる
+                    rows = list(old_rows) + list(rows)
+                period = max(old_period, period, key=PERIOD_ORDER.index)
+                fetched_at = max(old_fetched_at, fetched_at)
+            bars[key] = (period, rows, fetched_at)
+        return by_path
+
+    def _write(self, jobs):
+        for path, (bars, statements) in self._merge(jobs).items():
+            try:
+                with stage("db"):
+                    conn = get_db(path)
+                    with conn:
+                        for (ticker, interval), (period, rows, fetched_at) in bars.items():
+                            if isinstance(rows, dict):
+                                # 列指向の保存形式: バーのファイルを置き換えてから取得記録を更新する
+                                write_columnar_bars(path, ticker, interval, rows)
+                            else:
+                                conn.executemany(UPSERT_BAR_SQL, rows)
+                            conn.execute(UPSERT_FETCH_SQL, (ticker, interval, period, fetched_at))
+                        for sql, params in statements:
+                            conn.execute(sql, params)
+            except (sqlite3.Error, OSError, ValueError) as e:
+                logger.exception(f"DB write error: {e}")
+
+db_writer = DBWriter()
+
+def columnar_dir(db_path):
+    # 列指向ファイルはDBファイルと対にして保存する (stocks.db -> stocks_bars/)
+    return os.path.splitext(db_path)[0] + "_bars"
+
+def write_columnar_bars(db_path, ticker_symbol, interval, new_bars):
+    file_path = columnar.bar_path(columnar_dir(db_path), ticker_symbol, interval)
+    old_bars = columnar.read_bars(file_path)
+    merged = columnar.merge_bars(old_bars, new_bars)
+    # 置き換え前に古いファイルのメモリマップを手放す
+    del old_bars
+    columnar.write_bars(file_path, merged)
+
+def read_columnar_bars(ticker_symbol, interval, since=None):
+    # since (Timestamp) 以降のバーをメモリマップ上のビューとして返す (なければNone)
+    bars = columnar.read_bars(columnar.bar_path(columnar_dir(DB_PATH), ticker_symbol, interval))
+    if bars is None or not len(bars["ts"]): return None
+    if since is not None:
+        bars = columnar.slice_since(bars, int(since.timestamp()))
+    return bars
+
+def columnar_index(bars):
+    return pd.DatetimeIndex(bars["ts"].view("datetime64[s]"), name="Date", copy=False)
+
+def last_stored_ts(ticker_symbol, interval):
+    # 保存済みの最終バーの日時 (DB_TS_FORMAT形式の文字列、なければNone)
+    if PRICE_STORE == "columnar":
+        bars = read_columnar_bars(ticker_symbol, interval)
+        return pd.Timestamp(int(bars["ts"][-1]), unit="s").strftime(DB_TS_FORMAT) if bars is not None else None
+    return get_db().execute(
+        "SELECT MAX(ts) FROM price_bars WHERE ticker = ? AND interval = ?", (ticker_symbol, interval)
+    ).fetchone()[0]
+
+# 取得した株価データをSQLite3データベース (または列指向ファイル) に保存する関数 (書き込みはライタースレッドで非同期に行う)
+def store_to_db(ticker_symbol, df, period=DEFAULT_PERIOD, interval=DEFAULT_INTERVAL):
+    if df.empty: return None
+    bars = df[['Open', 'High', 'Low', 'Close', 'Volume']]
+    if PRICE_STORE == "columnar":
+        if not bars.index.is_monotonic_increasing:
+            bars = bars.sort_index()
+        bars = bars[~bars.index.duplicated(keep="last")]
+        columns = {
+            "ts": bars.index.values.astype("datetime64[s]").astype(np.int64),
+            **{name.lower(): bars[name].to_numpy(dtype=np.float32) for name in ['Open', 'High', 'Low', 'Close']},
+            "volume": bars['Volume'].fillna(0).to_numpy(dtype=np.int64),
+        }
+        return db_writer.submit(ticker_symbol, interval, period, columns)
+    ts = bars.index.strftime(DB_TS_FORMAT)
+    values = bars.to_numpy(dtype=np.float64)
+    rows = [(ticker_symbol, interval, t, *map(float, v)) for t, v in zip(ts, values)]
+    return db_writer.submit(ticker_symbol, interval, period, rows)
+
+# DBに十分な期間・鮮度のデータがあれば読み出す関数 (なければNone)
+# allow_stale=True の場合は、上流が使えない時の代替として期限切れ・期間不足のデータもそのまま返す
+def load_from_db(ticker_symbol, period=DEFAULT_PERIOD, interval=DEFAULT_INTERVAL, allow_stale=False):
+    if not os.path.exists(DB_PATH): return None
+    try:
+        conn = get_db()
+        row = conn.execute("SELECT period, fetched_at FROM price_fetches WHERE ticker = ? AND interval = ?", (ticker_symbol, interval)).fetchone()
+        if not row: return None
+        stored_period, fetched_at = row
+        ttl = STORE_TTL_INTRADAY if interval in INTRADAY_INTERVALS else STORE_TTL_DAILY
+        if not allow_stale:
+            if time.time() - fetched_at > ttl: return None
+            if PERIOD_ORDER.index(stored_period) < PERIOD_ORDER.index(period): return None
+
+        # 要求された期間だけを切り出す (最終取得バーからの相対期間)
+        offset = PERIOD_OFFSETS[period]
+        if PRICE_STORE == "columnar":
+            bars = read_columnar_bars(ticker_symbol, interval)
+            if bars is None: return None
+            if offset is not None:
+                since = pd.Timestamp(int(bars["ts"][-1]), unit="s") - offset
+                bars = columnar.slice_since(bars, int(since.timestamp()))
+            # メモリマップ上の配列をコピーせずにそのまま列として使う
+            return pd.DataFrame(
+                {name: bars[name.lower()] for name in ['Open', 'High', 'Low', 'Close', 'Volume']},
+                index=columnar_index(bars), copy=False,
+            )
+        last_ts = last_stored_ts(ticker_symbol, interval)
+        if last_ts is None: return None
+        since = (pd.Timestamp(last_ts) - offset).strftime(DB_TS_FORMAT) if offset is not None else ""
+        rows = conn.execute(
+            "SELECT ts, open, high, low, close, volume FROM price_bars WHERE ticker = ? AND interval = ? AND ts >= ? ORDER BY ts",
+            (ticker_symbol, interval, since),
+        ).fetchall()
+    except (sqlite3.Error, OSError, ValueError) as e:
+        logger.warning(f"DB read error: {e}")
+        return None
+
+    if not rows: return None
+    ts, *columns = zip(*rows)
+    return pd.DataFrame(
+        dict(zip(['Open', 'High', 'Low', 'Close', 'Volume'], (np.array(c, dtype=np.float64) for c in columns))),
+        index=pd.DatetimeIndex(pd.to_datetime(ts, format=DB_TS_FORMAT), name="Date"),
+    )
+
+# 保存済みの日足終値を銘柄ごとのSeriesとして読み出す関数 (バックテスト・銘柄間比較用)
+def load_stored_closes(tickers, period="10y"):
+    if not tickers or not os.path.exists(DB_PATH): return {}
+    offset = PERIOD_OFFSETS[period]
+    since = pd.Timestamp.now() - offset if offset is not None else None
+    if PRICE_STORE == "columnar":
+        # 銘柄ごとに終値の列だけを読む (他の列のページは読み込まれない)
+        closes = {}
+        for ticker in tickers:
+            bars = read_columnar_bars(ticker, DEFAULT_INTERVAL, since)
+            if bars is not None and len(bars["ts"]):
+                closes[ticker] = pd.Series(bars["close"], index=columnar_index(bars), copy=False).dropna()
+        return closes
+
+    placeholders = ",".join("?" * len(tickers))
+    rows = get_db().execute(
+        f"SELECT ticker, ts, close FROM price_bars WHERE interval = ? AND ticker IN ({placeholders}) AND ts >= ? ORDER BY ticker, ts",
+        (DEFAULT_INTERVAL, *tickers, since.strftime(DB_TS_FORMAT) if since is not None else ""),
+    ).fetchall()
+    if not rows: return {}
+
+    df = pd.DataFrame(rows, columns=["ticker", "ts", "close"])
+    df["ts"] = pd.to_datetime(df["ts"], format=DB_TS_FORMAT)
+    return {ticker: g.set_index("ts")["close"].dropna() for ticker, g in df.groupby("ticker", sort=False)}
+
+# --- LTTB (Largest-Triangle-Three-Buckets) によるダウンサンプリング ---
+def lttb_indices(y, threshold):
+    # 形状を保ったまま threshold 点に間引くためのインデックスを返す (x軸は等間隔とみなす)
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # 次のバケットの平均点
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = (next_start + next_end - 1) / 2.0
+        avg_y = y[next_start:next_end].mean()
+
+        # 現在のバケットで、前の選択点・次バケット平均点と作る三角形が最大の点を選ぶ
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        xs = np.arange(start, end)
+        area = np.abs((a - avg_x) * (y[start:end] - y[a]) - (a - xs) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+def downsample_bars(df, max_points):
+    # 終値の形状をLTTBで保ちつつ、高値・安値・出来高は間引いた区間内で集約する
+    if len(df) <= max_points:
+        return df
+    idx = lttb_indices(df['Close'].to_numpy(dtype=float), max_points)
+    sampled = df.iloc[idx].copy()
+    sampled['High'] = np.maximum.reduceat(df['High'].to_numpy(dtype=float), idx)
+    sampled['Low'] = np.minimum.reduceat(df['Low'].to_numpy(dtype=float), idx)
+    sampled['Volume'] = np.add.reduceat(df['Volume'].to_numpy(dtype=float), idx)
+    return sampled
+
+def to_chart_time(ts, intraday):
+    # 日足以上は日付文字列、分足はチャートにそのまま表示される時刻のUNIX秒
+    if intraday:
+        return int((ts - pd.Timestamp("1970-01-01")) // pd.Timedelta(seconds=1))
+    return ts.strftime("%Y-%m-%d")
+
+# --- 静的ファイルのフィンガープリント (内容ハッシュ付きURL + immutableキャッシュ) ---
+_static_hashes = {}
+
+def static_file_hash(filename):
+    # ファイル内容のハッシュを返す (更新時刻が変わった時だけ再計算)
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = _static_hashes.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    _static_hashes[filename] = (mtime, digest)
+    return digest
+
+@app.url_defaults
+def add_static_hash(endpoint, values):
+    # url_for('static', ...) に ?v=<ハッシュ> を自動付与
+    if endpoint == "static" and "filename" in values:
+        digest = static_file_hash(values["filename"])
+        if digest:
+            values["v"] = digest
+
+@app.after_request
+def add_cache_headers(response):
+    # ハッシュ付きURLは内容が変わればURLも変わるため、ブラウザに無期限キャッシュさせる
+    if request.endpoint == "static" and request.args.get("v") and response.status_code == 200:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+def bars_etag(df, period, interval, max_points, stale=False):
+    # 株価データと表示条件から弱いETagを作成 (ファンダメンタルズ更新のため日付も含める)
+    # (上流の失敗時に返した古いデータは、復旧後に同じ内容でも取り直されるよう別のETagにする)
+    # (yfinance取得分とDB・列指向ファイルの読み出し分で同じ値になるよう、保存時の精度に揃えてからハッシュする)
+    h = hashlib.sha1(df.index.values.astype("datetime64[s]").astype(np.int64).tobytes())
+    h.update(df[['Open', 'High', 'Low', 'Close']].to_numpy(dtype=np.float32).tobytes())
+    h.update(df['Volume'].fillna(0).to_numpy(dtype=np.int64).tobytes())
+    h.update(f"{period}|{interval}|{max_points}|{datetime.now():%Y%m%d}|{'stale' if stale else ''}".encode())
+    return h.hexdigest()
+
+# --- 銘柄間比較 (リターン相関・日経平均に対するベータ・相対力ランキング) ---
+MARKET_BENCHMARK = "^N225"
+RS_HORIZONS = {"1m": 21, "3m": 63, "6m": 126, "12m": 252}               # 相対力を測る期間 (営業日数)
+RS_WEIGHTS = {"1m": 0.2, "3m": 0.3, "6m": 0.3, "12m": 0.2}              # 総合スコアへの重み
+DEFAULT_CORR_WINDOW = 60
+CORR_WINDOWS = (20, 60, 120, 252)   # 相関・ベータを計算する期間 (営業日数) の選択肢
+CORR_CACHE_SIZE = 8                 # 相関行列をキャッシュする (期間, 計算期間) の組み合わせ数 (1つで 銘柄数^2 x 8バイト)
+MATRIX_FFILL_LIMIT = 5   # 休場日の違い (NYダウなど) を埋める最大日数
+
+# 価格行列と相対力は (営業日, 期間) ごとに1つ、相関行列は件数を絞ってLRUでキャッシュする
+_price_matrix_cache = {}         # (DB, 営業日, 期間) -> 価格行列と相対力
+_universe_cache = OrderedDict()  # (DB, 営業日, 期間, 計算期間) -> 相関行列・ベータ
+_universe_cache_lock = threading.Lock()
+
+def build_price_matrix(tickers, period):
+    # 保存済みの日足終値を 日付 x 銘柄 の1つの行列に揃える (日経平均の営業日を基準にする)
+    closes = load_stored_closes(tickers, period)
+    if not closes: return pd.DataFrame()
+    matrix = pd.concat(closes, axis=1).sort_index()
+    matrix.index = matrix.index.normalize()
+    matrix = matrix[~matrix.index.duplicated(keep="last")]
+    if MARKET_BENCHMARK in matrix:
+        matrix = matrix[matrix[MARKET_BENCHMARK].notna()]
+    return matrix.ffill(limit=MATRIX_FFILL_LIMIT)
+
+def compute_correlations(matrix, window):
+    # 直近 window 日のリターン相関と、日経平均に対するベータを計算する
+    returns = matrix.pct_change(fill_method=None).iloc[-window:]
+    min_periods = max(10, window // 2)
+    corr = returns.corr(min_periods=min_periods)
+
+    beta = pd.Series(np.nan, index=matrix.columns)
+    if MARKET_BENCHMARK in returns:
+        cov = returns.cov(min_periods=min_periods)
+        beta = cov[MARKET_BENCHMARK] / cov.loc[MARKET_BENCHMARK, MARKET_BENCHMARK]
+    return {
+        "corr": corr.reindex(index=matrix.columns, columns=matrix.columns).to_numpy(),
+        "beta": beta.reindex(matrix.columns).to_numpy(),
+    }
+
+def compute_relative_strength(matrix):
+    # 期間別リターンと、日経平均に対する超過リターンによる相対力スコアを計算する
+    values = matrix.to_numpy(dtype=np.float64)
+    last = values[-1]
+    horizon_returns = {}
+    for label, days in RS_HORIZONS.items():
+        past = values[-1 - days] if len(values) > days else np.full(len(last), np.nan)
+        horizon_returns[label] = last / past - 1
+    # 日経平均を上回った分 (超過リターン) の加重平均を相対力スコアとする
+    bench_col = matrix.columns.get_loc(MARKET_BENCHMARK) if MARKET_BENCHMARK in matrix else None
+    score = np.zeros(len(last))
+    weight = np.zeros(len(last))
+    for label, r in horizon_returns.items():
+        excess = r - r[bench_col] if bench_col is not None else r
+        valid = ~np.isnan(excess)
+        score[valid] += RS_WEIGHTS[label] * excess[valid]
+        weight[valid] += RS_WEIGHTS[label]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        score = np.where(weight > 0, score / weight, np.nan)
+
+    return {"returns": horizon_returns, "rs_score": score}
+
+def get_price_matrix(trading_day, period):
+    # 全銘柄の価格行列と相対力を (営業日, 期間) ごとに1回だけ作る
+    key = (DB_PATH, trading_day, period)
+    with _universe_cache_lock:
+        cached = _price_matrix_cache.get(key)
+    if cached is not None:
+        return cached
+
+    _, stocks = load_stock_data()
+    with stage("db"):
+        matrix = build_price_matrix([s["ticker"] for s in stocks], period)
+    if matrix.empty or len(matrix) < 2:
+        return None
+    with stage("compute"):
+        entry = {"matrix": matrix, **compute_relative_strength(matrix)}
+    with _universe_cache_lock:
+        # 古い営業日の結果は捨てる
+        for old in [k for k in _price_matrix_cache if k[1] != trading_day]:
+            del _price_matrix_cache[old]
+        _price_matrix_cache[key] = entry
+    return entry
+
+def get_universe_stats(period, window):
+    # 全銘柄分の計算結果を最新の営業日ごとにキャッシュし、業種別・類似銘柄の表示はここから切り出す
+    # 営業日は日経平均の最終バーで判定する (主キーのインデックスで引けるので全件走査しない)
+    with stage("db"):
+        last_ts = last_stored_ts(MARKET_BENCHMARK, DEFAULT_INTERVAL)
+    trading_day = last_ts[:10] if last_ts else f"{datetime.now():%Y-%m-%d}"
+    prices = get_price_matrix(trading_day, period)
+    if prices is None:
+        return None
+
+    key = (DB_PATH, trading_day, period, window)
+    with _universe_cache_lock:
+        correlations = _universe_cache.get(key)
+        if correlations is not None:
+            _universe_cache.move_to_end(key)
+    if correlations is None:
+        with stage("compute"):
+            correlations = compute_correlations(prices["matrix"], window)
+        with _universe_cache_lock:
+            for old in [k for k in _universe_cache if k[1] != trading_day]:
+                del _universe_cache[old]
+            _universe_cache[key] = correlations
+            while len(_universe_cache) > CORR_CACHE_SIZE:
+                _universe_cache.popitem(last=False)
+
+    matrix = prices["matrix"]
+    return {
+        "as_of": matrix.index[-1].strftime("%Y-%m-%d"),
+        "tickers": list(matrix.columns),
+        "returns": prices["returns"],
+        "rs_score": prices["rs_score"],
+        **correlations,
+    }
+
+def _json_float(value, digits=4):
+    return None if value is None or np.isnan(value) else round(float(value), digits)
+
+# --- 現在値スナップショット (全ユーザーで1つの上流ポーリングを共有) ---
+QUOTE_POLL_INTERVAL = int(os.getenv("QUOTE_POLL_INTERVAL", "15"))  # 上流へのポーリング間隔 (秒)
+QUOTE_WATCH_TTL = 5 * 60            # 誰も見なくなった銘柄をポーリング対象から外すまでの時間 (秒)
+QUOTE_FIRST_WAIT = 5                # 未取得の銘柄を /quotes で待つ最大時間 (秒)
+QUOTE_HEARTBEAT_SECONDS = 20        # SSEの死活確認コメントの送信間隔 (秒)
+QUOTE_STREAM_MAX_SECONDS = 10 * 60  # SSE接続の最大時間 (ブラウザが自動で再接続する)
+QUOTE_MAX_TICKERS = 50              # 1リクエストで指定できる銘柄数
+QUOTE_MAX_WATCHED = int(os.getenv("QUOTE_MAX_WATCHED", "300"))  # ポーリング対象にできる銘柄数の上限 (全ユーザー合計)
+QUOTE_FETCH_THREADS = 8             # ポーリング時に並列で取得する銘柄数
+# SSE接続は接続中ずっとワーカーのスレッドを1本占有するため、1ワーカーあたりの同時接続数を抑える
+# (既定はgunicornの32スレッドの半分。超えた分は 503 を返し、ブラウザは /quotes のポーリングに切り替える)
+QUOTE_STREAM_MAX_CONNECTIONS = int(os.getenv("QUOTE_STREAM_MAX_CONNECTIONS", "16"))
+_quote_stream_slots = threading.BoundedSemaphore(QUOTE_STREAM_MAX_CONNECTIONS)
+
+def parse_tickers(raw):
+    # カンマ区切りの銘柄コードのうち、銘柄リストにあるものだけを重複なしのリストにする
+    # (任意の文字列を受け付けると、存在しない銘柄までポーリング対象に積み上がるため)
+    tickers = [t.strip() for t in (raw or "").split(",") if t.strip()]
+    index = get_search_index()
+    tickers = list(dict.fromkeys(t for t in tickers if t in index))
+    return tickers[:QUOTE_MAX_TICKERS]
+
+def fetch_quotes(tickers):
+    # 監視中の銘柄の直近5日分を並列に取得し、(銘柄 -> 現在値・前日終値, 取得に失敗した銘柄) を返す
+    # 銘柄ごとに上流のトークンを1つ使い、トークンが空いていない銘柄 (流量制限のクールダウン中を含む) は
+    # 待たずに次回のポーリングへ回す (取得に失敗した銘柄には含めない)
+    def fetch_one(ticker):
+        try:
+            with upstream("yahoo", timeout=0):
+                return ticker, True, fetch_history(ticker, "5d", "1d")
+        except UpstreamThrottled:
+            return ticker, False, None
+        except Exception as e:
+            logger.warning(f"Quote fetch error for {ticker}: {e}")
+            return ticker, True, None
+
+    with stage("fetch"):
+        with ThreadPoolExecutor(max_workers=min(QUOTE_FETCH_THREADS, len(tickers)), thread_name_prefix="quote") as pool:
+            results = list(pool.map(fetch_one, tickers))
+
+    quotes, failed = {}, set()
+    for ticker, attempted, df in results:
+        if not attempted:
+            continue
+        if df is None or df.empty or df['Close'].dropna().empty:
+            failed.add(ticker)
+            continue
+        closes = df['Close'].dropna()
+        price = float(closes.iloc[-1])
+        prev_close = float(closes.iloc[-2]) if len(closes) > 1 else None
+        change = price - prev_close if prev_close else None
+        quotes[ticker] = {
+            "ticker": ticker,
+            "price": price,
+            "prev_close": prev_close,
+            "change": change,
+            "change_pct": change / prev_close * 100 if prev_close else None,
+            "as_of": closes.index[-1].strftime("%Y-%m-%d"),
+            "updated_at": time.time(),
+        }
+    return quotes, failed
+
+class QuoteService:
+    # 監視銘柄を一定間隔でまとめて取得し、最新スナップショットをメモリに保持して購読者へ通知する
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._snapshot = {}   # 銘柄 -> 最新の現在値
+        self._changed_at = {} # 銘柄 -> 最後に値が変わったバージョン
+        self._version = 0
+        self._watched = {}    # 銘柄 -> 最後に参照された時刻
+        self._failed = set()  # 直近のポーリングで取得できなかった銘柄 (/quotes で結果を待たない)
+        self._fetched_at = {} # 銘柄 -> 最後に取得を試みた時刻 (古いものから順に取得する)
+        self._wake = threading.Event()
+        self._thread = None
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="quote-poller", daemon=True)
+                self._thread.start()
+
+    def watch(self, tickers):
+        # 銘柄をポーリング対象に加え、対象になった銘柄を返す (新しい銘柄があればすぐに取得させる)
+        # 対象の銘柄数が上限に達している場合、新しい銘柄は加えない
+        now = time.time()
+        with self._cond:
+            is_new = False
+            if len(self._watched) + len(tickers) > QUOTE_MAX_WATCHED:
+                self._expire(now)
+            for t in tickers:
+                if t not in self._watched:
+                    if len(self._watched) >= QUOTE_MAX_WATCHED:
+                        continue
+                    is_new = True
+                self._watched[t] = now
+            watched = [t for t in tickers if t in self._watched]
+        self._ensure_started()
+        if is_new:
+            self._wake.set()
+        return watched
+
+    def _expire(self, now):
+        # 誰も見なくなった銘柄をポーリング対象から外す (self._cond を保持して呼ぶ)
+        for t in [t for t, seen in self._watched.items() if now - seen > QUOTE_WATCH_TTL]:
+            del self._watched[t]
+            self._failed.discard(t)
+            self._fetched_at.pop(t, None)
+
+    def pending(self, tickers):
+        # まだ一度も取得を試みていない銘柄 (取得に失敗した銘柄は待っても届かないので含めない)
+        with self._cond:
+            return [t for t in tickers if t not in self._snapshot and t not in self._failed]
+
+    def snapshot(self, tickers):
+        with self._cond:
+            return {t: self._snapshot[t] for t in tickers if t in self._snapshot}, self._version
+
+    def wait_until_available(self, tickers, timeout):
+        with self._cond:
+            self._cond.wait_for(lambda: all(t in self._snapshot or t in self._failed for t in tickers), timeout)
+            return {t: self._snapshot[t] for t in tickers if t in self._snapshot}
+
+    def wait_for_changes(self, tickers, since_version, timeout):
+        # since_version 以降に値が変わった銘柄だけを返す (変化がなければtimeoutで空を返す)
+        with self._cond:
+            self._cond.wait_for(lambda: self._version > since_version, timeout)
+            changed = {t: self._snapshot[t] for t in tickers if self._changed_at.get(t, 0) > since_version}
+            return changed, self._version
+
+    def _run(self):
+        while True:
+            self._wake.wait(QUOTE_POLL_INTERVAL)
+            self._wake.clear()
+            now = time.time()
+            with self._cond:
+                self._expire(now)
+                # トークンが足りず取得できなかった銘柄が次回に優先されるよう、取得が古い順に並べる
+                tickers = sorted(self._watched, key=lambda t: (self._fetched_at.get(t, 0), t))
+            if not tickers:
+                continue
+            try:
+                quotes, failed = fetch_quotes(tickers)
+            except Exception as e:
+                logger.warning(f"Quote poll error: {e}")
+                continue
+
+            with self._cond:
+                for t in failed | set(quotes):
+                    self._fetched_at[t] = now
+                self._failed = (self._failed - set(quotes)) | failed
+                changed = [t for t, q in quotes.items()
+                           if t not in self._snapshot or (self._snapshot[t]["price"], self._snapshot[t]["prev_close"]) != (q["price"], q["prev_close"])]
+                if not changed:
+                    # 取得に失敗した銘柄を待っている /quotes を起こす
+                    self._cond.notify_all()
+                    continue
+                self._version += 1
+                for t in changed:
+                    self._snapshot[t] = quotes[t]
+                    self._changed_at[t] = self._version
+                self._cond.notify_all()
+
+quote_service = QuoteService()
+
+# --- 会社プロフィール (銘柄ごとにDBへ保存し、古くなったものは閑散時間帯にバックグラウンドで再生成) ---
+PROFILE_TTL = int(os.getenv("PROFILE_TTL_DAYS", "90")) * 24 * 60 * 60   # 再生成するまでの期間 (決算は四半期ごと)
+PROFILE_REFRESH_ENABLED = os.getenv("PROFILE_REFRESH", "1") == "1"
+PROFILE_REFRESH_HOURS = os.getenv("PROFILE_REFRESH_HOURS", "1-6")        # 再生成する時間帯 (日本時間 開始時-終了時)
+PROFILE_REFRESH_CONCURRENCY = int(os.getenv("PROFILE_REFRESH_CONCURRENCY", "2"))
+PROFILE_REFRESH_CHECK_SECONDS = 10 * 60  # 時間帯の確認・古いプロフィールの再検索の間隔 (秒)
+PROFILE_CLAIM_SECONDS = 10 * 60          # 他のワーカーと同じ銘柄を同時に生成しないための予約時間 (秒)
+JST = timezone(timedelta(hours=9))
+
+def load_company_profile(ticker):
+    # 保存済みのプロフィールを返す (なければNone)
+    if not os.path.exists(DB_PATH): return None
+    try:
+        with stage("db"):
+            row = get_db().execute("SELECT name, info, generated_at FROM company_profiles WHERE ticker = ?", (ticker,)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"Profile read error: {e}")
+        return None
+    return {"name": row[0], "info": row[1], "generated_at": row[2]} if row else None
+
+def company_name(ticker, profile=None):
+    # 生成に使う会社名は銘柄リスト (なければ保存済みプロフィール) から引き、リクエストの値は使わない
+    _, stocks = load_stock_data()
+    for stock in stocks:
+        if stock["ticker"] == ticker:
+            return stock["name"]
+    return profile["name"] if profile else None
+
+def generate_company_profile(ticker, name):
+    # Google検索付きでプロフィールを生成して保存する (書き込みはライタースレッドで非同期に行う)
+    response = generate_from_template(MODEL_LITE, "company_info", company_name=name, ticker=ticker)
+    generated_at = time.time()
+    db_writer.execute(UPSERT_PROFILE_SQL, (ticker, name, response.text, MODEL_LITE, generated_at))
+    return {"name": name, "info": response.text, "generated_at": generated_at}
+
+def claim_profile(ticker):
+    # 複数のgunicornワーカーが同じ銘柄を生成しないよう、DB上で一定時間だけ予約する
+    # (予約できたかをその場で判定するため、ライタースレッドを通さずに書き込む。バックグラウンドからのみ呼ばれる)
+    now = time.time()
+    conn = get_db()
+    with conn:
+        cursor = conn.execute(CLAIM_PROFILE_SQL, (ticker, now + PROFILE_CLAIM_SECONDS, now))
+    return cursor.rowcount == 1
+
+def in_refresh_window(now=None):
+    start, end = (int(h) for h in PROFILE_REFRESH_HOURS.split("-"))
+    hour = (now or datetime.now(JST)).hour
+    return start <= hour < end if start <= end else (hour >= start or hour < end)
+
+class ProfileRefresher:
+    # 未生成・期限切れのプロフィールを、閑散時間帯に同時実行数を抑えて古いものから再生成する
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ensure_started(self):
+        # gunicornのfork後に各ワーカーで起動されるよう、最初のリクエスト時に開始する
+        if not PROFILE_REFRESH_ENABLED or client is None:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="profile-refresher", daemon=True)
+                self._thread.start()
+
+    def stale_stocks(self):
+        _, stocks = load_stock_data()
+        generated = dict(get_db().execute("SELECT ticker, generated_at FROM company_profiles").fetchall())
+        cutoff = time.time() - PROFILE_TTL
+        # 会社プロフィールがあるのは個別株 (東証の「.T」銘柄) だけで、指数・先物・金利は対象外
+        stale = [s for s in stocks if s["ticker"].endswith(".T") and generated.get(s["ticker"], 0) < cutoff]
+        return sorted(stale, key=lambda s: generated.get(s["ticker"], 0))
+
+    def refresh_once(self):
+        # 古いプロフィールを再生成し、再生成できた件数を返す
+        stale = self.stale_stocks()
+        if not stale:
+            return 0
+        with ThreadPoolExecutor(max_workers=PROFILE_REFRESH_CONCURRENCY, thread_name_prefix="profile") as pool:
+            return sum(pool.map(self._refresh_one, stale))
+
+    def _refresh_one(self, stock):
+        # 時間帯を過ぎた場合や、他のワーカーが生成中の場合は何もしない
+        if not in_refresh_window() or not claim_profile(stock["ticker"]):
+            return 0
+        try:
+            generate_company_profile(stock["ticker"], stock["name"])
+            return 1
+        except Exception as e:
+            logger.warning(f"Profile refresh error for {stock['ticker']}: {e}")
+            return 0
+
+    def _run(self):
+        while True:
+            try:
+                if in_refresh_window():
+                    refreshed = self.refresh_once()
+                    if refreshed:
+                        logger.info(f"Refreshed {refreshed} company profiles")
+            except Exception as e:
+                logger.exception(f"Profile refresher error: {e}")
+            time.sleep(PROFILE_REFRESH_CHECK_SECONDS)
+
+profile_refresher = ProfileRefresher()
+
+# --- 市況ダイジェスト (標準トピックの市況分析を毎朝1回だけ生成してDBに保存し、全ユーザーで共有) ---
+# 画面のトピック区分ごとに「全トピックを選択」した組み合わせを標準とし、オプションなし・短期・中期・業種別の4種類を生成する。
+# これに一致するリクエストは保存済みの分析を返し、自由キーワードやその他のオプションを含む場合はその場で生成する
+DIGEST_TOPIC_SETS = {
+    "indices": ["日経平均", "グロース", "S&P500", "NASDAQ", "VIX", "ドル円", "日本国債", "米国債"],
+    "macro": ["FRB", "FOMC", "日銀", "利上げ", "利下げ", "米雇用統計", "CPI"],
+    "sectors": ["半導体", "生成AI", "データセンタ", "防衛株", "金価格", "原油価格", "ビットコイン"],
+    "earnings": ["決算発表", "上方修正", "下方修正", "株主還元", "増配", "自社株買い"],
+}
+DIGEST_VARIANTS = ("base", "short_term", "mid_term", "sector_view")   # base: 追加オプションなし
+DIGEST_OPTION_FLAGS = ("beginner_mode", "deep_analysis", "technical_mode", "short_term", "mid_term", "sector_view")
+DIGEST_ENABLED = os.getenv("MARKET_DIGEST", "1") == "1"
+DIGEST_HOUR = int(os.getenv("MARKET_DIGEST_HOUR", "7"))                 # 生成する時刻 (日本時間。寄り付き前)
+DIGEST_CONCURRENCY = int(os.getenv("MARKET_DIGEST_CONCURRENCY", "2"))
+DIGEST_CHECK_SECONDS = 10 * 60   # 未生成のダイジェストを確認する間隔 (秒)
+DIGEST_CLAIM_SECONDS = 30 * 60   # 他のワーカーと同じトピック区分を同時に生成しないための予約時間 (秒)
+DIGEST_NEWS_LIMIT = 150
+
+def digest_key(set_name, variant):
+    return f"{set_name}:{variant}"
+
+def match_digest(topics, free_keyword, flags):
+    # リクエストが標準の組み合わせに一致すればダイジェストのキーを返す (一致しなければNone)
+    if free_keyword.strip():
+        return None
+    enabled = [flag for flag in DIGEST_OPTION_FLAGS if flags.get(flag)]
+    if len(enabled) > 1 or (enabled and enabled[0] not in DIGEST_VARIANTS):
+        return None
+    for set_name, set_topics in DIGEST_TOPIC_SETS.items():
+        if set(topics) == set(set_topics):
+            return digest_key(set_name, enabled[0] if enabled else "base")
+    return None
+
+def digest_edition_start(now=None):
+    # 現在有効な版の開始時刻 (当日の生成時刻を過ぎていれば当日分、まだなら前日分)
+    now = now or datetime.now(JST)
+    start = now.replace(hour=DIGEST_HOUR, minute=0, second=0, microsecond=0)
+    return start if now >= start else start - timedelta(days=1)
+
+def load_market_digest(key):
+    # 現在の版のダイジェストを返す (未生成・前の版ならNone)
+    if key is None or not os.path.exists(DB_PATH): return None
+    try:
+        with stage("db"):
+            row = get_db().execute(
+                "SELECT analysis, date_range, generated_at FROM market_digests WHERE digest_key = ? AND generated_at >= ?",
+                (key, digest_edition_start().timestamp()),
+            ).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"Digest read error: {e}")
+        return None
+    return {"analysis": row[0], "date_range": row[1], "generated_at": row[2]} if row else None
+
+def claim_digest(set_name, edition_start):
+    # 複数のgunicornワーカーが同じ版を二重に生成しないよう、DB上で一定時間だけ予約する (予約の成否を使うため直接書き込む)
+    now = time.time()
+    conn = get_db()
+    with conn:
+        cursor = conn.execute(CLAIM_DIGEST_SQL, (f"{set_name}@{edition_start:%Y%m%d}", now + DIGEST_CLAIM_SECONDS, now))
+    return cursor.rowcount == 1
+
+def generate_market_digests(set_name, variants):
+    # トピック区分のニュースを1回だけ取得し、指定された種類の分析を生成して保存する
+    news_text, error, date_range = fetch_rss_news(DIGEST_TOPIC_SETS[set_name], DIGEST_NEWS_LIMIT)
+    if error:
+        raise RuntimeError(error)
+    for variant in variants:
+        response = generate_from_template(
+            MODEL_NAME, "analyze_market",
+            flags={variant: True} if variant != "base" else None,
+            thinking_level="high",
+            date_range=date_range, news_text=news_text,
+        )
+        db_writer.execute(UPSERT_DIGEST_SQL, (digest_key(set_name, variant), response.text, date_range, MODEL_NAME, time.time()))
+    return len(variants)
+
+class DigestBuilder:
+    # 生成時刻を過ぎて現在の版が揃っていなければ、不足分をバックグラウンドで生成する
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ensure_started(self):
+        # gunicornのfork後に各ワーカーで起動されるよう、最初のリクエスト時に開始する
+        if not DIGEST_ENABLED or client is None:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="digest-builder", daemon=True)
+                self._thread.start()
+
+    def missing(self, edition_start):
+        # トピック区分 -> 現在の版がまだない種類の一覧
+        current = {row[0] for row in get_db().execute(
+            "SELECT digest_key FROM market_digests WHERE generated_at >= ?", (edition_start.timestamp(),),
+        )}
+        missing = {
+            set_name: [v for v in DIGEST_VARIANTS if digest_key(set_name, v) not in current]
+            for set_name in DIGEST_TOPIC_SETS
+        }
+        return {set_name: variants for set_name, variants in missing.items() if variants}
+
+    def build_once(self):
+        # 不足しているダイジェストを生成し、生成できた件数を返す
+        edition_start = digest_edition_start()
+        missing = self.missing(edition_start)
+        if not missing:
+            return 0
+        with ThreadPoolExecutor(max_workers=DIGEST_CONCURRENCY, thread_name_prefix="digest") as pool:
+            return sum(pool.map(lambda item: self._build_one(*item, edition_start), missing.items()))
+
+    def _build_one(self, set_name, variants, edition_start):
+        if not claim_digest(set_name, edition_start):
+            return 0
+        try:
+            return generate_market_digests(set_name, variants)
+        except Exception as e:
+            logger.warning(f"Digest build error for {set_name}: {e}")
+            return 0
+
+    def _run(self):
+        while True:
+            try:
+                built = self.build_once()
+                if built:
+                    logger.info(f"Built {built} market digests")
+            except Exception as e:
+                logger.exception(f"Digest builder error: {e}")
+            time.sleep(DIGEST_CHECK_SECONDS)
+
+digest_builder = DigestBuilder()
+
+# Prometheus形式のメトリクスを公開するエンドポイント (METRICS_TOKEN 未設定の場合は存在しない扱い)
+@app.route("/metrics")
+def metrics():
+    if not METRICS_TOKEN:
+        return jsonify({"error": "not found"}), 404
+    header = request.headers.get("Authorization", "")
+    token = header[len("Bearer "):] if header.startswith("Bearer ") else request.args.get("token", "")
+    if not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return jsonify({"error": "forbidden"}), 403
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+# テクニカル指標（5, 25, 75本移動平均、25本乖離率）を列として追加する関数
+def add_indicators(df):
+    df['sma5'] = df['Close'].rolling(5).mean()
+    df['sma25'] = df['Close'].rolling(25).mean()
+    df['sma75'] = df['Close'].rolling(75).mean()
+    df['kairi25'] = (df['Close'] - df['sma25']) / df['sma25'] * 100
+    return df
+
+# フロントエンド（JavaScript）に送るチャートデータ形式に変換する関数
+def chart_payload(chart_df, intraday=False):
+    def to_list(series):
+        return [{"time": to_chart_time(idx, intraday), "value": float(v)} for idx, v in series.items() if pd.notna(v)]
+
+    return {
+        "candles": [{"time": to_chart_time(idx, intraday), "open": float(r["Open"]), "high": float(r["High"]), "low": float(r["Low"]), "close": float(r["Close"]), "volume": float(r["Volume"])} for idx, r in chart_df.iterrows()],
+        "sma5": to_list(chart_df['sma5']),
+        "sma25": to_list(chart_df['sma25']),
+        "sma75": to_list(chart_df['sma75']),
+        "kairi25": to_list(chart_df['kairi25']),
+    }
+
+# --- 🏦 ファンダメンタルズ情報の取得関数 (表示用の文字列を返す) ---
+def fetch_fundamentals(ticker, last_close=None):
+    market_cap_str, div_yield_str, payout_ratio_str, ex_div_date_str, roe_str, roa_str, per_str, pbr_str = "N/A", "N/A", "N/A", "N/A", "N/A", "N/A", "N/A", "N/A"
+
+    def call(fetch):
+        # fast_info・info の参照はそれぞれ別のHTTP呼び出しになるため、参照ごとに上流のトークンを1つ使う
+        with upstream("yahoo"):
+            return fetch()
+
+    try:
+        stock_obj = yf.Ticker(ticker)
+        
+        # fast_info (軽量API) を優先して利用
+        # 時価総額
+        mcap = None
+        if hasattr(stock_obj, 'fast_info') and 'market_cap' in stock_obj.fast_info:
+            mcap = call(lambda: stock_obj.fast_info['market_cap'])
+        
+        # fast_infoで取れない場合はinfo (重いAPI) を試す
+        info = {}
+        if not mcap:
+            try:
+                info = call(lambda: stock_obj.info)
+                mcap = info.get("marketCap")
+            except UpstreamThrottled:
+                raise
+            except Exception:
+                pass
+
+        if mcap:
+            market_cap_str = f"{mcap / 1e12:.2f} 兆円" if mcap >= 1e12 else f"{mcap / 1e8:.0f} 億円"
+
+        # PER/PBR (infoから取得が必要)
+        if not info:
+            try:
+                info = call(lambda: stock_obj.info)
+            except UpstreamThrottled:
+                raise
+            except Exception:
+                info = {}
+        
+        per = info.get("forwardPE") or info.get("trailingPE")
+        if per: per_str = f"{per:.2f}"
+        
+        pbr = info.get("priceToBook")
+        if pbr: pbr_str = f"{pbr:.2f}"
+
+        # 配当利回り
+        current_price = None
+        if hasattr(stock_obj, 'fast_info') and 'last_price' in stock_obj.fast_info:
+            current_price = call(lambda: stock_obj.fast_info['last_price'])
+        
+        if not current_price:
+            current_price = last_close
+
+        d_rate = info.get("dividendRate") 
+        
+        if d_rate and current_price:
+            calculated_yield = (d_rate / current_price) * 100
+            div_yield_str = f"{calculated_yield:.2f} %"
+        else:
+            dy = info.get("dividendYield") or info.get("trailingAnnualDividendYield")
+            if dy:
+                display_dy = dy * 100 if dy < 0.5 else dy 
+                div_yield_str = f"{display_dy:.2f} %"
+        
+        # その他の指標
+        payout = info.get("payoutRatio")
+        if payout is not None: payout_ratio_str = f"{payout * 100:.2f} %"
+        
+        ex_div = info.get("exDividendDate")
+        if ex_div: ex_div_date_str = datetime.fromtimestamp(ex_div).strftime('%m-%d')
+        
+        roe = info.get("returnOnEquity")
+        if roe: roe_str = f"{roe * 100:.2f} %"
+        
+        roa = info.get("returnOnAssets")
+        if roa: roa_str = f"{roa * 100:.2f} %"
+
+    except UpstreamThrottled:
+        # 流量制限は呼び出し元で保存済みの値に切り替えるため送出し、それ以外は取れた分だけで続行
+        raise
+    except Exception as e:
+        logger.warning(f"Fundamentals fetch error: {e}")
+
+    return {
+        "market_cap": market_cap_str, "dividend_yield": div_yield_str, "payout_ratio": payout_ratio_str,
+        "ex_div_date": ex_div_date_str, "roe": roe_str, "roa": roa_str, "per": per_str, "pbr": pbr_str
+    }
+
+FUNDAMENTAL_KEYS = ("market_cap", "dividend_yield", "payout_ratio", "ex_div_date", "roe", "roa", "per", "pbr")
+
+# 保存済みのファンダメンタルズを返す (なければNone)
+def load_stored_fundamentals(ticker):
+    if not os.path.exists(DB_PATH): return None
+    try:
+        row = get_db().execute("SELECT data, fetched_at FROM fundamentals WHERE ticker = ?", (ticker,)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"Fundamentals read error: {e}")
+        return None
+    return (json.loads(row[0]), row[1]) if row else None
+
+# ファンダメンタルズを返す。(値, 古いデータかどうか) のタプル
+# 株価と同じ期間は保存済みの値を使い、期限切れなら取得し直す。取得に失敗した場合は期限切れの保存値を返す
+def get_fundamentals(ticker, last_close=None):
+    with stage("db"):
+        stored = load_stored_fundamentals(ticker)
+    if stored and time.time() - stored[1] <= STORE_TTL_DAILY:
+        return stored[0], False
+
+    def fetch():
+        fundamentals = fetch_fundamentals(ticker, last_close)
+        # 1つも取れなかった場合は上流の失敗とみなして保存しない
+        if all(v == "N/A" for v in fundamentals.values()):
+            return fundamentals
+        db_writer.execute(UPSERT_FUNDAMENTALS_SQL, (ticker, json.dumps(fundamentals, ensure_ascii=False), time.time()))
+        return fundamentals
+
+    try:
+        with stage("fetch"):
+            fundamentals = inflight.do(("fundamentals", ticker), fetch)
+    except (UpstreamThrottled, sqlite3.Error) as e:
+        logger.warning(f"Fundamentals fetch skipped for {ticker}: {e}")
+        fundamentals = None
+    if fundamentals is not None and not all(v == "N/A" for v in fundamentals.values()):
+        return fundamentals, False
+    if stored:
+        STALE_RESPONSES.labels(route=current_route(), kind="fundamentals").inc()
+        return stored[0], True
+    return fundamentals or dict.fromkeys(FUNDAMENTAL_KEYS, "N/A"), False
+
+# yfinanceから株価を取得して整形・保存する (同じ銘柄・期間の同時リクエストは1回の取得を共有する)
+# 共有した結果は呼び出し元で書き換えないこと (指標を追加する場合はコピーする)
+def download_bars(ticker, period, interval):
+    def fetch():
+        with upstream("yahoo"):
+            df = fetch_history(ticker, period, interval)
+        if df.empty: return df
+
+        # 欠損値（空データ）を削除
+        df = df.dropna(subset=['Open', 'High', 'Low', 'Close'])
+
+        # 分足はタイムゾーン付きで返るため、取引所の現地時刻のまま扱う
+        if df.index.tz is not None:
+            df.index = df.index.tz_localize(None)
+
+        # データをDBに保存
+        with stage("db"):
+            store_to_db(ticker, df, period, interval)
+        return df
+
+    return inflight.do(("bars", ticker, period, interval), fetch)
 
 # メイン画面の表示
 @app.route("/")
 def index():
-    industries, stocks = load_stock_data()
-    return render_template("index.html", industries=industries, stocks=stocks)
+    profile_refresher.ensure_started()
+    digest_builder.ensure_started()
+    industries, _ = load_stock_data()
+    # 銘柄一覧はページに埋め込まず、/stocks と /search_stocks から必要な分だけ取得する
+    # 市況分析の区分ごとのプリセットは、事前生成する市況ダイジェストと同じトピックの組み合わせで送る
+    return render_template("index.html", industries=industries, digest_sets=DIGEST_TOPIC_SETS)
+
+# 業種ごとの銘柄一覧を返すAPI (銘柄リストのプルダウン用。industry=all で全銘柄)
+@app.route("/stocks")
+def stocks_list():
+    industry = request.args.get("industry", "all")
+    stock_index = get_search_index()
+    etag = hashlib.sha1(f"{stock_list_version()}|{industry}".encode()).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        not_modified = app.response_class(status=304)
+        not_modified.set_etag(etag, weak=True)
+        return not_modified
+
+    stocks = [stock_summary(s) for s in stock_index.stocks if industry == "all" or s.get("industry") == industry]
+    response = jsonify({"stocks": stocks})
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+# 銘柄コード・銘柄名 (かな・ローマ字)・業種で銘柄を検索するAPI (例: /search_stocks?q=toyota)
+@app.route("/search_stocks")
+def search_stocks():
+    query = request.args.get("q", "")
+    industry = request.args.get("industry", "all")
+    try:
+        limit = int(request.args.get("limit", SEARCH_DEFAULT_LIMIT))
+    except (TypeError, ValueError):
+        return jsonify({"error": "invalid limit"}), 400
+    limit = min(max(limit, 1), SEARCH_MAX_LIMIT)
+
+    with stage("compute"):
+        results = get_search_index().search(query, limit, None if industry == "all" else industry)
+    return jsonify({"results": [{**stock_summary(stock), "score": round(score, 1)} for stock, score in results]})
 
 # 銘柄が選択された際に株価データと統計情報を取得するAPI
-@app.route("/get_data", methods=["POST"])
+@app.route("/get_data", methods=["GET", "POST"])
 def get_data():
-    req = request.get_json()
+    # GETの場合はクエリ文字列で受け取り、ブラウザのHTTPキャッシュ(ETag再検証)を効かせる
+    req = request.get_json(silent=True) or request.args
     ticker = req.get("ticker")
     if not ticker: return jsonify({"error": "ticker not provided"}), 400
 
+    period = req.get("period", DEFAULT_PERIOD)
+    interval = req.get("interval", DEFAULT_INTERVAL)
+    if period not in PERIOD_OFFSETS or interval not in INTERVAL_MAX_PERIOD:
+        return jsonify({"error": "invalid period or interval"}), 400
+    if PERIOD_ORDER.index(period) > PERIOD_ORDER.index(INTERVAL_MAX_PERIOD[interval]):
+        return jsonify({"error": f"{interval}足で取得できる期間は最大{INTERVAL_MAX_PERIOD[interval]}です。"}), 400
     try:
-        # yfinanceで過去1年間のデータをダウンロード
-        df = yf.download(ticker, period="1y", interval="1d")
-        if df.empty: return jsonify({"error": "no data found"}), 404
-
-        # マルチインデックス対策
-        if isinstance(df.columns, pd.MultiIndex):
-            df.columns = df.columns.get_level_values(0)
-
-        # 欠損値（空データ）を削除
-        df = df.dropna(subset=['Open', 'High', 'Low', 'Close'])
+        max_points = int(req.get("max_points", DEFAULT_MAX_POINTS))
+    except (TypeError, ValueError):
+        return jsonify({"error": "invalid max_points"}), 400
+    max_points = min(max(max_points, MIN_MAX_POINTS), MAX_MAX_POINTS)
+    intraday = interval in INTRADAY_INTERVALS
+    date_fmt = "%Y-%m-%d %H:%M" if intraday else "%Y-%m-%d"
 
-        # --- 📊 統計データの計算 ---
-        max_price = float(df['High'].max())
-        max_date = df['High'].idxmax().strftime("%Y-%m-%d")
-        min_price = float(df['Low'].min())
-        min_date = df['Low'].idxmin().strftime("%Y-%m-%d")
-        # 出来高TOP10の抽出
-        top10_vol = df.sort_values(by='Volume', ascending=False).head(10)
-        volume_ranking = [{"date": idx.strftime("%Y-%m-%d"), "volume": int(row["Volume"])} for idx, row in top10_vol.iterrows()]
+    try:
+        # 保存済みデータが十分新しければDBから返し、なければyfinanceからダウンロード
+        with stage("db"):
+            df = load_from_db(ticker, period, interval)
+        source, stale = "db", False
+        if df is None:
+            source = "yahoo"
+            upstream_error = None
+            try:
+                with stage("fetch"):
+                    df = download_bars(ticker, period, interval).copy()
+            except Exception as e:
+                logger.warning(f"Upstream fetch failed for {ticker}: {e}")
+                upstream_error = e
+            if upstream_error is not None or df.empty:
+                # 上流が失敗・流量制限中の場合は、期限切れでも保存済みのデータを古いデータとして返す
+                with stage("db"):
+                    df = load_from_db(ticker, period, interval, allow_stale=True)
+                if df is None:
+                    if isinstance(upstream_error, UpstreamThrottled):
+                        response = jsonify({"error": "アクセスが集中しています。しばらくしてから再度お試しください。"})
+                        response.headers["Retry-After"] = str(UPSTREAM_RETRY_AFTER)
+                        return response, 503
+                    if upstream_error is not None: raise upstream_error
+                    return jsonify({"error": "no data found"}), 404
+                STALE_RESPONSES.labels(route=current_route(), kind="bars").inc()
+                source, stale = "db", True
+
+        # 株価データに変化がなければ 304 Not Modified を返す
+        etag = bars_etag(df, period, interval, max_points, stale)
+        if request.if_none_match.contains_weak(etag):
+            not_modified = app.response_class(status=304)
+            not_modified.set_etag(etag, weak=True)
+            return not_modified
 
         # --- 🏦 ファンダメンタルズ情報の取得 ---
-        market_cap_str, div_yield_str, payout_ratio_str, ex_div_date_str, roe_str, roa_str, per_str, pbr_str = "N/A", "N/A", "N/A", "N/A", "N/A", "N/A", "N/A", "N/A"
-        
-        try:
-            stock_obj = yf.Ticker(ticker)
-            
-            # fast_info (軽量API) を優先して利用
-            # 時価総額
-            mcap = None
-            if hasattr(stock_obj, 'fast_info') and 'market_cap' in stock_obj.fast_info:
-                mcap = stock_obj.fast_info['market_cap']
-            
-            # fast_infoで取れない場合はinfo (重いAPI) を試す
-            info = {}
-            if not mcap:
-                try:
-                    info = stock_obj.info
-                    mcap = info.get("marketCap")
-                except Exception:
-                    pass
-
-            if mcap:
-                market_cap_str = f"{mcap / 1e12:.2f} 兆円" if mcap >= 1e12 else f"{mcap / 1e8:.0f} 億円"
+        fundamentals, fundamentals_stale = get_fundamentals(ticker, float(df['Close'].iloc[-1]))
+
+        with stage("compute"):
+            # --- 📊 統計データの計算 ---
+            max_price = float(df['High'].max())
+            max_date = df['High'].idxmax().strftime(date_fmt)
+            min_price = float(df['Low'].min())
+            min_date = df['Low'].idxmin().strftime(date_fmt)
+            # 出来高TOP10の抽出 (分足は日ごとに合計して出来高急増日を求める)
+            daily_volume = df['Volume'].resample("D").sum() if intraday else df['Volume']
+            top10_vol = daily_volume.sort_values(ascending=False).head(10)
+            volume_ranking = [{"date": idx.strftime("%Y-%m-%d"), "volume": int(v)} for idx, v in top10_vol.items()]
+
+            # テクニカル指標の計算 (間引く前の全データで計算)
+            add_indicators(df)
+
+            # チャート表示用に間引く
+            chart_df = downsample_bars(df, max_points)
+
+        with stage("serialize"):
+            response = jsonify({
+                **chart_payload(chart_df, intraday),
+                "period": period, "interval": interval, "intraday": intraday,
+                "total_points": len(df), "source": source,
+                "stale": stale or fundamentals_stale,
+                "stats": {
+                    "max_price": max_price, "max_date": max_date, "min_price": min_price, "min_date": min_date,
+                    "volume_ranking": volume_ranking, **fundamentals
+                }
+            })
+        response.set_etag(etag, weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    except Exception as e:
+        logger.exception(f"Data fetch error: {e}")
+        return jsonify({"error": str(e)}), 500
 
-            # PER/PBR (infoから取得が必要)
-            if not info:
-                try:
-                    info = stock_obj.info
-                except Exception:
-                    info = {}
-            
-            per = info.get("forwardPE") or info.get("trailingPE")
-            if per: per_str = f"{per:.2f}"
-            
-            pbr = info.get("priceToBook")
-            if pbr: pbr_str = f"{pbr:.2f}"
-
-            # 配当利回り
-            current_price = None
-            if hasattr(stock_obj, 'fast_info') and 'last_price' in stock_obj.fast_info:
-                current_price = stock_obj.fast_info['last_price']
-            
-            if not current_price and not df.empty:
-                current_price = df['Close'].iloc[-1]
-
-            d_rate = info.get("dividendRate") 
-            
-            if d_rate and current_price:
-                calculated_yield = (d_rate / current_price) * 100
-                div_yield_str = f"{calculated_yield:.2f} %"
+# 指定銘柄の現在値スナップショットを返すAPI (例: /quotes?tickers=7203.T,^N225)
+@app.route("/quotes")
+def quotes():
+    tickers = parse_tickers(request.args.get("tickers"))
+    if not tickers: return jsonify({"error": "tickers not provided"}), 400
+
+    watched = quote_service.watch(tickers)
+    snapshot, version = quote_service.snapshot(tickers)
+    pending = quote_service.pending(watched)
+    if pending:
+        # 初めて参照された銘柄は最初のポーリング結果を少しだけ待つ
+        snapshot.update(quote_service.wait_until_available(pending, QUOTE_FIRST_WAIT))
+    return jsonify({"quotes": snapshot, "version": version})
+
+# 現在値の変化をServer-Sent Eventsで配信するAPI (上流へのポーリングは全接続で共有)
+@app.route("/quotes/stream")
+def quotes_stream():
+    tickers = parse_tickers(request.args.get("tickers"))
+    if not tickers: return jsonify({"error": "tickers not provided"}), 400
+    if not _quote_stream_slots.acquire(blocking=False):
+        # 接続数の上限に達した場合は、スナップショットを返す /quotes のポーリングに誘導する
+        response = jsonify({"error": "too many streams", "poll": "/quotes", "interval": QUOTE_POLL_INTERVAL})
+        response.headers["Retry-After"] = str(QUOTE_POLL_INTERVAL)
+        return response, 503
+    quote_service.watch(tickers)
+
+    def events():
+        snapshot, version = quote_service.snapshot(tickers)
+        yield f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+        deadline = time.time() + QUOTE_STREAM_MAX_SECONDS
+        while time.time() < deadline:
+            changed, version = quote_service.wait_for_changes(tickers, version, QUOTE_HEARTBEAT_SECONDS)
+            # 接続中は監視を継続させる
+            quote_service.watch(tickers)
+            if changed:
+                yield f"event: quote\ndata: {json.dumps(changed)}\n\n"
             else:
-                dy = info.get("dividendYield") or info.get("trailingAnnualDividendYield")
-                if dy:
-                    display_dy = dy * 100 if dy < 0.5 else dy 
-                    div_yield_str = f"{display_dy:.2f} %"
-            
-            # その他の指標
-            payout = info.get("payoutRatio")
-            if payout is not None: payout_ratio_str = f"{payout * 100:.2f} %"
-            
-            ex_div = info.get("exDividendDate")
-            if ex_div: ex_div_date_str = datetime.fromtimestamp(ex_div).strftime('%m-%d')
-            
-            roe = info.get("returnOnEquity")
-            if roe: roe_str = f"{roe * 100:.2f} %"
-            
-            roa = info.get("returnOnAssets")
-            if roa: roa_str = f"{roa * 100:.2f} %"
+                yield ": keepalive\n\n"
 
-        except Exception as e:
-            print(f"Fundamentals fetch error: {e}")
-            # エラーが出ても株価データがあれば続行
-        
-        # テクニカル指標（5, 25, 75日移動平均、25日乖離率）の計算
-        df['sma5'] = df['Close'].rolling(5).mean()
-        df['sma25'] = df['Close'].rolling(25).mean()
-        df['sma75'] = df['Close'].rolling(75).mean()
-        df['kairi25'] = (df['Close'] - df['sma25']) / df['sma25'] * 100
-
-        # データをDBに保存
-        store_to_db(ticker, df)
+    response = Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # 切断・タイムアウトでレスポンスが閉じられたら枠を返す
+    response.call_on_close(_quote_stream_slots.release)
+    return response
 
-        # フロントエンド（JavaScript）に送る形式に変換
-        def to_list(series):
-            return [{"time": idx.strftime("%Y-%m-%d"), "value": float(v)} for idx, v in series.items() if pd.notna(v)]
+# --- バックテストルート (保存済みの株価でゴールデン/デッドクロス・乖離率の売買ルールを検証) ---
+@app.route("/backtest", methods=["POST"])
+def run_backtest():
+    req = request.get_json()
+    strategy = req.get("strategy", "ma_cross")
+    period = req.get("period", "10y")
+    ticker = req.get("ticker")
+    industry = req.get("industry")
+    if period not in PERIOD_OFFSETS: return jsonify({"error": "invalid period"}), 400
+
+    # 対象銘柄: 単一銘柄、またはstocks.csvの業種 ("all"で全銘柄)
+    if ticker:
+        tickers = [ticker]
+    elif industry:
+        _, stocks = load_stock_data()
+        tickers = [s["ticker"] for s in stocks if industry == "all" or s["industry"] == industry]
+    else:
+        return jsonify({"error": "ticker or industry not provided"}), 400
 
+    try:
+        cost_bps = float(req.get("cost_bps", 0))
+        with stage("db"):
+            closes = load_stored_closes(tickers, period)
+        if not closes:
+            return jsonify({"error": "保存済みの株価データがありません。先にチャートを表示してデータを保存してください。"}), 404
+
+        with stage("compute"):
+            results, params = backtest.run_backtests(
+                {t: series.to_numpy() for t, series in closes.items()}, strategy, req.get("params"), cost_bps
+            )
         return jsonify({
-            "candles": [{"time": idx.strftime("%Y-%m-%d"), "open": float(r["Open"]), "high": float(r["High"]), "low": float(r["Low"]), "close": float(r["Close"]), "volume": float(r["Volume"])} for idx, r in df.iterrows()],
-            "sma5": to_list(df['sma5']),
-            "sma25": to_list(df['sma25']),
-            "sma75": to_list(df['sma75']),
-            "kairi25": to_list(df['kairi25']),
-            "stats": {
-                "max_price": max_price, "max_date": max_date, "min_price": min_price, "min_date": min_date,
-                "volume_ranking": volume_ranking, "market_cap": market_cap_str,
-                "dividend_yield": div_yield_str, "payout_ratio": payout_ratio_str, "ex_div_date": ex_div_date_str, 
-                "roe": roe_str, "roa": roa_str, "per": per_str, "pbr": pbr_str
-            }
+            "strategy": strategy, "params": params, "period": period, "cost_bps": cost_bps,
+            "results": results,
+            "summary": backtest.summarize(results),
+            "missing": [t for t in tickers if t not in results],
         })
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        print(f"Data fetch error: {e}")
+        logger.exception(f"Backtest Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# --- 銘柄間比較ルート (業種別の相関行列・ベータ・相対力ランキング、指定銘柄と値動きの近い銘柄) ---
+@app.route("/universe_stats", methods=["GET"])
+def universe_stats():
+    period = request.args.get("period", DEFAULT_PERIOD)
+    industry = request.args.get("industry", "all")
+    ticker = request.args.get("ticker")
+    if period not in PERIOD_OFFSETS: return jsonify({"error": "invalid period"}), 400
+    try:
+        window = int(request.args.get("window", DEFAULT_CORR_WINDOW))
+    except ValueError:
+        window = None
+    if window not in CORR_WINDOWS:
+        return jsonify({"error": f"window must be one of {', '.join(map(str, CORR_WINDOWS))}"}), 400
+
+    try:
+        stats = get_universe_stats(period, window)
+        if stats is None:
+            return jsonify({"error": "保存済みの株価データがありません。先にチャートを表示してデータを保存してください。"}), 404
+
+        _, stocks = load_stock_data()
+        info = {s["ticker"]: s for s in stocks}
+        position = {t: i for i, t in enumerate(stats["tickers"])}
+        selected = [t for t in stats["tickers"] if industry == "all" or info.get(t, {}).get("industry") == industry]
+
+        with stage("serialize"):
+            score = stats["rs_score"]
+            # 順位は全銘柄の中での順位 (NaNは並べ替えの比較を壊すため、スコアが計算できない銘柄を先に除いてから並べる)
+            valid = [t for t in stats["tickers"] if np.isfinite(score[position[t]])]
+            ranked = sorted(valid, key=lambda t: -score[position[t]])
+            overall_rank = {t: i + 1 for i, t in enumerate(ranked)}
+            rankings = [{
+                "ticker": t,
+                "name": info.get(t, {}).get("name", t),
+                "industry": info.get(t, {}).get("industry"),
+                "beta": _json_float(stats["beta"][position[t]]),
+                "returns": {label: _json_float(r[position[t]] * 100, 2) for label, r in stats["returns"].items()},
+                "rs_score": _json_float(score[position[t]] * 100, 2),
+                "rank": overall_rank.get(t),
+                "percentile": round(100 * (1 - (overall_rank[t] - 1) / len(ranked)), 1) if t in overall_rank else None,
+            } for t in selected]
+            rankings.sort(key=lambda r: r["rank"] or len(position) + 1)
+
+            idx = [position[t] for t in selected]
+            corr = stats["corr"][np.ix_(idx, idx)]
+            result = {
+                "as_of": stats["as_of"], "period": period, "window": window, "benchmark": MARKET_BENCHMARK,
+                "industry": industry,
+                "tickers": selected,
+                "correlation": np.where(np.isnan(corr), None, corr.round(3)).tolist(),
+                "rankings": rankings,
+            }
+
+            # 指定銘柄と相関の高い銘柄 (業種を問わず全銘柄から)
+            if ticker:
+                if ticker not in position:
+                    return jsonify({"error": f"{ticker} の保存済みデータがありません"}), 404
+                row = stats["corr"][position[ticker]]
+                peers = [t for t in stats["tickers"] if t != ticker and t != MARKET_BENCHMARK and not np.isnan(row[position[t]])]
+                peers.sort(key=lambda t: -row[position[t]])
+                result["ticker"] = ticker
+                result["peers"] = [{
+                    "ticker": t, "name": info.get(t, {}).get("name", t),
+                    "industry": info.get(t, {}).get("industry"),
+                    "correlation": _json_float(row[position[t]], 3),
+                } for t in peers[:10]]
+        return jsonify(result)
+    except Exception as e:
+        logger.exception(f"Universe Stats Error: {e}")
         return jsonify({"error": str(e)}), 500
 
 # --- AI テクニカル分析ルート (チャートデータに基づきAIが解説) ---
@@ -263,56 +1880,23 @@ def analyze():
     beginner_mode = req.get("beginner_mode", False)
     deep_analysis = req.get("deep_analysis", False)
     
+    # プロンプトは直近1年間の日足 (移動平均線は5/25/75日) を前提にしているため、それ以外の足・期間は受け付けない
+    if (req.get("period", "1y"), req.get("interval", "1d")) != ("1y", "1d"):
+        return jsonify({"error": "テクニカル分析は直近1年間の日足で行います (period=1y, interval=1d)"}), 400
+
     recent_candles = [{"t": c["time"], "c": c["close"]} for c in req.get("candles", [])] 
     recent_kairi = [{"t": k["time"], "v": round(k["value"], 2)} for k in req.get("kairi25", [])]
 
     if not client: return jsonify({"error": "AI Client not initialized"}), 500
 
-    extra_instructions = ""
-    if beginner_mode:
-        extra_instructions += "\n- 初学者向け説明：説明の際に使用する専門用語に「※」で注釈を追加して投資初学者でも分かりやすい説明をすること。"
-    if deep_analysis:
-        extra_instructions += "\n- 詳細分析：騙しやノイズの可能性についても考慮し、複数のシナリオ（強気・弱気）を提示すること。"
-
-    prompt = f"""
-    # 役割
-    あなたは金融市場を分析するプロの投資アナリストです。
-    
-    # 目的
-    投資判断のために、以下の図データ、出力ルール、指示内容に従って
-    銘柄「{ticker}」のテクニカル指標に基づく分析をする。
-
-    # 図データ
-    直近1年間の終値推移: {recent_candles}
-    直近1年間の25日移動平均線乖離率: {recent_kairi}
-    
-    # 出力ルール
-    - 分析結果はMarkdown形式で出力すること。
-    - 分析結果が不明瞭な箇所は、不明瞭な箇所を記述した上で、「判断材料不足」としてもよい。
-    
-    # 指示内容
-    1. トレンド分析：5日(短期), 25日(中期), 75日(長期)の各移動平均線の向きから現在のトレンドを分析。
-    2. 移動平均線分析：25日と75日のクロス状況(ゴールデンクロスまたはデッドクロス)と、移動平均線3本が収束することによるオーバーシュートの予兆を考察。
-    3. ライン分析：明確な支持線・抵抗線が見える日付範囲と価格帯を分析。
-    4. 乖離率考察：現在の25日乖離率と、過去の乖離率の推移を比較することで、売られすぎ・買われすぎの目安となる値を極値を基に考察。異常値と思われる値は異常値である旨を記載すること。
-    5. 結論：1～4の内容を基に、今後の展望と、戦略アドバイスを出力。
-
-    ## 追加の指示内容
-    {extra_instructions}
-    """
     try:
-        # モデルと設定の切り替え
+        # モデルと設定の切り替え (Liteモデル以外(High Thinking)の場合のみThinking設定を入れる)
         target_model = MODEL_LITE if use_lite else MODEL_NAME
-        
-        gen_config_params = {}
-        if not use_lite:
-            # Liteモデル以外(High Thinking)の場合のみThinking設定を入れる
-            gen_config_params["thinking_config"] = types.ThinkingConfig(include_thoughts=True, thinking_level="low")
-
-        response = client.models.generate_content(
-            model=target_model,
-            contents=prompt,
-            config=types.GenerateContentConfig(**gen_config_params)
+        response = generate_from_template(
+            target_model, "analyze",
+            flags={"beginner_mode": beginner_mode, "deep_analysis": deep_analysis},
+            thinking_level=None if use_lite else "low",
+            ticker=ticker, recent_candles=recent_candles, recent_kairi=recent_kairi,
         )
         return jsonify({"analysis": response.text})
     except Exception as e:
@@ -331,57 +1915,21 @@ def analyze_full():
 
     if not client: return jsonify({"error": "AI Client not initialized"}), 500
 
-    extra_instructions = ""
-    if beginner_mode:
-        extra_instructions += "\n- 初学者向け説明：説明の際に使用する専門用語に「※」で注釈を追加して投資初学者でも分かりやすい説明をすること。"
-    if deep_analysis:
-        extra_instructions += "\n- 詳細分析：競合他社との比較や、業界全体の動向についても言及し、より多角的な視点で分析すること。"
-
-    prompt = f"""
-    # 役割
-    あなたは金融市場を分析するプロの投資アナリストです。
-
-    # 目的
-    投資判断のために、以下の出力ルールと指示内容に従って
-    Google Searchを用いて最新情報を取得することで
-    銘柄「{ticker}」を分析する。
-    
-    # 出力ルール
-    - 分析結果はMarkdown形式で出力すること。
-    - 各項目の最後に、根拠となる出典URLを必ず明記すること。
-    - 分析結果が不明瞭な箇所は、不明瞭な箇所を記述した上で、「判断材料不足」としてもよい。
-    
-    # 指示内容
-    1. 業績抽出：最新決算の売上・利益、キャッシュフロー、業績変動要因、および今後の株主還元策（配当・自社株買い等）を抽出。
-    2. 動向考察：直近1年の株価推移を分析し、上昇・下落の主因を考察。
-    3. 需給分析：現在の信用倍率と推移から、個人・機関の売買動向を分析。
-    4. 評価抽出：目標株価・コンセンサス情報を抽出。
-    5. 結論：今後の注目イベントとリスク要因を整理。
-
-    ## 追加の指示内容
-    {extra_instructions}
-    """
-    
     try:
         # モデルと設定の切り替え
         target_model = MODEL_LITE if use_lite else MODEL_NAME
-        
-        gen_config_params = {
-            "tools": [types.Tool(google_search=types.GoogleSearch())]
-        }
-        if not use_lite:
-            gen_config_params["thinking_config"] = types.ThinkingConfig(include_thoughts=True, thinking_level="low")
 
         # Google検索(Grounding)機能を有効化して回答を生成
-        response = client.models.generate_content(
-            model=target_model,
-            contents=prompt,
-            config=types.GenerateContentConfig(**gen_config_params)
+        response = generate_from_template(
+            target_model, "analyze_full",
+            flags={"beginner_mode": beginner_mode, "deep_analysis": deep_analysis},
+            thinking_level=None if use_lite else "low",
+            ticker=ticker,
         )
         return jsonify({"analysis": response.text})
-        
+
     except Exception as e:
-        print(f"Detailed Analysis Error: {str(e)}")
+        logger.exception(f"Detailed Analysis Error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 # --- AI 出来高急増日背景分析ルート (特定の日の出来高急増要因を調査) ---
@@ -415,51 +1963,18 @@ def analyze_volume():
 
     date_groups_str = "\n".join([f"- {', '.join(group)}" for group in grouped_dates])
 
-    prompt = f"""
-    # 役割
-    あなたは金融市場を分析するプロの投資アナリストです。
-    
-    # 目的
-    投資判断のために、以下の出来高データ、出力ルール、指示内容に従って
-    銘柄「{ticker}」の出来高数1位～10位の日に市場で何が起きたのかを、
-    Google Searchを用いて調査する。
-
-    # 出来高データ
-    {date_groups_str}
-    
-    # 出力ルール
-    - 分析結果はMarkdown形式で出力すること。
-    - 分析結果が不明瞭な箇所は、不明瞭な箇所を記述した上で、「判断材料不足」としてもよい。
-    - 調査対象は、個別株そのものの調査と、日経平均・S&P500といったマクロ指標の調査を行なうこと。ただし、マクロ指標が±2%以上変動している場合は経済的なニュースだけでなく、政治的なニュースも調査すること。
-    - 対象日・発生イベント・投資家心理の部分は、表形式でまとめること。
-    - 各項目の最後に、根拠となる出典URLを最後に明記すること。
-    - 個別株による要因は個別要因とし、マクロ指標による要因は市況要因とすることで、分けて記述すること。また、どちらの要因も影響が大きい場合は共通要因として一緒に記述すること。
-    
-    # 指示内容
-    1. 発生イベント：決算発表、マクロ指標、経済ニュースなど、原因となった事象を調査。
-    2. 投資家心理：市場がそのニュースをどう受け止め、なぜ出来高が急増したかを考察。
-    3. 横断的考察：複数の日付がある場合、それらが「下落と反発」などどのような一連のストーリーを形成しているかを考察。
-    """
-    
     try:
         # モデルと設定の切り替え
         target_model = MODEL_LITE if use_lite else MODEL_NAME
-        
-        gen_config_params = {
-            "tools": [types.Tool(google_search=types.GoogleSearch())]
-        }
-        if not use_lite:
-            gen_config_params["thinking_config"] = types.ThinkingConfig(include_thoughts=True, thinking_level="low")
-
-        response = client.models.generate_content(
-            model=target_model,
-            contents=prompt,
-            config=types.GenerateContentConfig(**gen_config_params)
+        response = generate_from_template(
+            target_model, "analyze_volume",
+            thinking_level=None if use_lite else "low",
+            ticker=ticker, date_groups=date_groups_str,
         )
         return jsonify({"analysis": response.text})
-        
+
     except Exception as e:
-        print(f"Volume Analysis Error: {str(e)}")
+        logger.exception(f"Volume Analysis Error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 # --- 市況分析ルート (RSSニュースに基づきAIが解説) ---
@@ -480,8 +1995,6 @@ def analyze_market():
     # モデル設定
     use_lite = req.get("use_lite_model", False)
 
-    if not client: return jsonify({"error": "AI Client not initialized"}), 500
-
     query_parts = selected_topics[:]
     if free_keyword:
         query_parts.append(free_keyword)
@@ -489,65 +2002,35 @@ def analyze_market():
     if not query_parts:
         return jsonify({"error": "分析対象のキーワードを選択または入力してください。"}), 400
 
+    # 標準の組み合わせなら、今朝生成済みのダイジェストをそのまま返す
+    digest_builder.ensure_started()
+    flags = {
+        "beginner_mode": beginner_mode, "deep_analysis": deep_analysis, "technical_mode": technical_mode,
+        "short_term": short_term, "mid_term": mid_term, "sector_view": sector_view,
+    }
+    digest = load_market_digest(match_digest(selected_topics, free_keyword, flags))
+    if digest:
+        return jsonify({
+            "analysis": digest["analysis"],
+            "date_range": digest["date_range"],
+            "digest_generated_at": datetime.fromtimestamp(digest["generated_at"], JST).strftime("%Y-%m-%d %H:%M"),
+        })
+
+    if not client: return jsonify({"error": "AI Client not initialized"}), 500
+
     # ニュース取得
     news_text, error, date_range = fetch_rss_news(query_parts, 150)
     if error:
         return jsonify({"error": error}), 404
 
-    # Geminiへの指示作成
-    extra_instructions = ""
-    if beginner_mode:
-        extra_instructions += "\n- 初学者向け説明：説明の際に使用する専門用語に「※」で注釈を追加して投資初学者でも分かりやすい説明をすること。"
-    if deep_analysis:
-        extra_instructions += "\n- 詳細分析：市場が抱えるリスクとその影響について分析すること。市場心理とボラティリティについても分析すること。"
-    if technical_mode:
-        extra_instructions += "\n- テクニカル分析：トレンド(上昇または下降)、支持・抵抗、出来高について分析してください。"     
-    if short_term:
-        extra_instructions += "\n- 短期分析：直近1週間の短期的な目線の分析をすること。特に、信用取引の状況について分析すること。"   
-    if mid_term:
-        extra_instructions += "\n- 中期分析：直近1ヶ月の中期的な目線の分析をすること。特に、月間の主要な経済指標やトレンドの変化について分析すること。"   
-    if sector_view:
-        extra_instructions += "\n- 業種別分析：ニュース上で話題になっている各業種の状況について分析すること。"
-
-    prompt = f"""
-    # 役割
-    あなたは金融市場を分析するプロの投資アナリストです。
-    
-    # 目的
-    投資判断のために、以下のニュースデータ、出力ルール、指示内容に従って
-    取得ニュースに基づく市場の分析をする。
-    
-    # ニュースデータ
-    ニュース数と期間：{date_range}
-    ニュース本文：{news_text}
-    
-    # 出力ルール
-    - 分析結果はMarkdown形式で出力すること。
-    - 分析結果が不明瞭な箇所は、不明瞭な箇所を記述した上で、「判断材料不足」としてもよい。
-    - 出力結果の冒頭に、ニュース数と期間を記載すること。
-    - 今後の予測は行わなくてもよい。
-    
-    # 指示内容
-    - 分類抽出：トピックごとに見出しを分け、関連するニュースの要点を抽出。
-    - 影響考察：各トピックが市場へ与える影響を考察。
-    
-    ## 追加の指示内容
-    {extra_instructions}
-    """
-
     try:
-        # モデルと設定の切り替え
+        # モデルと設定の切り替え (Market分析はHigh Thinking)
         target_model = MODEL_LITE if use_lite else MODEL_NAME
-        
-        gen_config_params = {}
-        if not use_lite:
-            # Market分析はHigh Thinking
-            gen_config_params["thinking_config"] = types.ThinkingConfig(include_thoughts=True, thinking_level="high")
-
-        response = client.models.generate_content(
-            model=target_model,
-            contents=prompt,
-            config=types.GenerateContentConfig(**gen_config_params)
+        response = generate_from_template(
+            target_model, "analyze_market",
+            flags=flags,
+            thinking_level=None if use_lite else "high",
+            date_range=date_range, news_text=news_text,
         )
         return jsonify({
             "analysis": response.text,
@@ -576,102 +2059,48 @@ def analyze_total():
     
     context_text = "\n\n---\n\n".join(combined_texts)
 
-    prompt = f"""
-    # 役割
-    あなたは金融市場のレポートを分析するプロの投資戦略家です。
-
-    # 目的
-    最終的な投資判断をするために、以下のレポートデータ、出力ルール、指示内容に従って
-    各分析結果から得られた情報を整理・分析する。
-    
-    # レポートデータ
-    {context_text}
-
-    # 出力ルール
-    - 分析結果はMarkdown形式で出力すること。
-    - 分析結果が不明瞭な箇所は、不明瞭な箇所を記述した上で、「判断材料不足」としてもよい。
-    
-    # 指示内容
-    1. 各分析結果の要点を統合し、現在の市場環境におけるリスクとチャンスを整理。
-    2. データの中に同じ業種の異なる銘柄が含まれている場合は銘柄比較をしてもよい。例えば、相対的な強みと弱み、業績推移、株主還元姿勢の違い等を解説。
-    3. 短期的(1カ月以内)・中期的(1カ月～3カ月以内)・長期的(3カ月～1年以内)な視点で、総合的な投資戦略及び、その戦略の根拠を提供。
-    4. 最終的な投資判断材料としての総括と、としてのアドバイスを、その金融商品を保有している人向け、保有していない人向けそれぞれに提供。
-    """
-
     try:
-        # モデルと設定の切り替え
+        # モデルと設定の切り替え (Total分析はHigh Thinking)
         target_model = MODEL_LITE if use_lite else MODEL_NAME
-        
-        gen_config_params = {}
-        if not use_lite:
-            # Total分析はHigh Thinking
-            gen_config_params["thinking_config"] = types.ThinkingConfig(include_thoughts=True, thinking_level="high")
-
-        response = client.models.generate_content(
-            model=target_model,
-            contents=prompt,
-            config=types.GenerateContentConfig(**gen_config_params)
+        response = generate_from_template(
+            target_model, "analyze_total",
+            thinking_level=None if use_lite else "high",
+            context_text=context_text,
         )
         return jsonify({"analysis": response.text})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-# --- AI 会社説明取得ルート (Google Searchを活用) ---
+# --- AI 会社説明取得ルート (保存済みプロフィールを返し、未生成の場合のみGoogle Searchを活用して生成) ---
 @app.route("/get_company_info", methods=["POST"])
 def get_company_info():
-    req = request.get_json()
-    ticker = req.get("ticker", "不明")
-    name = req.get("name", "不明")
-    
-    if not client: return jsonify({"error": "AI Client not initialized"}), 500
+    req = request.get_json(silent=True) or {}
+    ticker = req.get("ticker")
+    refresh = req.get("refresh", False)
+    if not ticker: return jsonify({"error": "ticker not provided"}), 400
 
-    # 現在の株価等の補助データを取得してAIに渡す
-    price_info = ""
-    try:
-        stock_obj = yf.Ticker(ticker)
-        # infoから最新価格を取得（currentPrice または regularMarketPrice）
-        current_price = stock_obj.info.get("currentPrice") or stock_obj.info.get("regularMarketPrice")
-        if current_price:
-            currency = stock_obj.info.get("currency", "JPY")
-            price_info = f"現在の株価: {current_price} {currency}"
-    except Exception as e:
-        print(f"Price fetch error in company info: {e}")
+    # 保存済みのプロフィールがあればDBから返す (期限切れのものはバックグラウンドで再生成される)
+    stored = load_company_profile(ticker)
+    profile = None if refresh else stored
+    source = "db"
+    if profile is None:
+        name = company_name(ticker, stored)
+        if name is None: return jsonify({"error": "unknown ticker"}), 404
+        if not client: return jsonify({"error": "AI Client not initialized"}), 500
+        try:
+            profile = generate_company_profile(ticker, name)
+            source = "live"
+        except Exception as e:
+            logger.exception(f"Company Info Error: {str(e)}")
+            return jsonify({"error": str(e)}), 500
+    profile_refresher.ensure_started()
 
-    prompt = f"""
-    # 役割
-    あなたは特定の企業の情報を調査することを得意とする企業アナリストです。
-    
-    # 目的
-    簡潔な企業情報を知るために、
-    以下の出力ルールと指示内容に従って
-    日本株銘柄「{name} ({ticker})」について、
-    Google Searchを用いて最新情報を調査する。
-    
-    # 出力ルール
-    - 回答はMarkdown形式で出力すること。
-    - 各項目のタイトルの後に改行すること。
-    - 各項目1〜4行程度で簡潔にまとめること。
-    - 出力結果の最後の部分に、「会社URL:」として、会社の公式サイトURLを必ず記載すること。
-    - 分析結果が不明瞭な箇所は、不明瞭な箇所を記述した上で、「判断材料不足」としてもよい。
-    
-    # 指示内容
-    1. 事業内容と優位性: 主要な事業を記述し、その後に直近1年の中で力を入れている事業を記述。その後に、競合他社に対する優位性を記述。
-    2. 活動拠点: 売上高構成比率の大きさの観点から、売上高の順に国内または海外の拠点記述。
-    3. 配当実績と優待: 過去10年間の配当実績を調査して取得して配当実績の推移(増加・減少・横ばい等)を評価。加えて、現在から一年前までの期間で、株主優待制度の実施状況・優待の内容を記述。
-    """
-    
-    try:
-        response = client.models.generate_content(
-            model=MODEL_LITE,
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                tools=[types.Tool(google_search=types.GoogleSearch())]
-            )
-        )
-        return jsonify({"info": response.text})
-    except Exception as e:
-        print(f"Company Info Error: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+    return jsonify({
+        "info": profile["info"],
+        "generated_at": datetime.fromtimestamp(profile["generated_at"], JST).strftime("%Y-%m-%d %H:%M"),
+        "stale": time.time() - profile["generated_at"] > PROFILE_TTL,
+        "source": source,
+    })
 
 # --- AI 再調査・深掘りルート (既存レポートに対する追加調査) ---
 @app.route("/re_research", methods=["POST"])
@@ -701,73 +2130,13 @@ def re_research():
     
     context_text = "\n\n---\n\n".join(combined_texts)
 
-    extra_instructions = ""
-    if beginner_mode:
-        extra_instructions += "\n- 初学者向け説明：説明の際に使用する専門用語に「※」で注釈を追加して投資初学者でも分かりやすい説明をすること。"
-    if deep_analysis:
-        extra_instructions += "\n- 詳細分析：表面的な事実だけでなく、背景にある要因や将来的なリスクについても深く分析すること。"
-    if short_term:
-        extra_instructions += "\n- 短期分析：直近1週間の短期的な目線の分析をすること。特に、直近のイベントや需給の変化に着目すること。"
-    if mid_term:
-        extra_instructions += "\n- 中期分析：直近1ヶ月の中期的な目線の分析をすること。特に、トレンドの転換点や経済指標の影響に着目すること。"
-
-    prompt = ""
+    flags = {"beginner_mode": beginner_mode, "deep_analysis": deep_analysis, "short_term": short_term, "mid_term": mid_term}
     if mode == "auto":
-        prompt = f"""
-        # 役割
-        あなたは金融情報を調査することを得意とする金融アナリストです。
-
-        # 目的
-        以下のレポートの内容を精査し、情報の不足・矛盾・新たな疑問点を自律的に発見した上で、
-        Google Searchによる再調査を行なうことで、「再調査レポート」を作成する。
-
-        # レポート
-        {context_text}
-
-        # 出力ルール
-        - 分析結果はMarkdown形式で出力すること。
-        - 各項目の最後に、根拠となる出典URLを必ず明記すること。
-        - 分析結果が不明瞭な箇所は、不明瞭な箇所を記述した上で、「判断材料不足」としてもよい。
-
-        # 指示内容
-        1. 批判的検証: 元のレポートに欠けている視点、データが古い可能性、論理の飛躍を指摘し、それを補完する最新情報を調査・提示。
-        2. 深掘り調査: 元のレポートで触れられているトピックについて、「なぜ？」「その背景は？」「競合はどうなのか？」といった疑問を自ら立て、追加調査。
-        3. リスク再評価: 新たな情報を踏まえた上で、投資判断における隠れたリスクを分析。
-        4. 結論: 再調査によって新たに得られた情報を整理。
-
-        ## 追加の指示内容
-        {extra_instructions}
-        """
+        template, fields = "re_research_auto", {"context_text": context_text}
     else:
         if not user_question:
              return jsonify({"error": "質問内容が入力されていません。"}), 400
-        
-        prompt = f"""
-        # 役割
-        あなたは金融アドバイザーとしてユーザの質問に答える人です。
-
-        # 目的
-        以下のレポートの内容と、ユーザの質問を踏まえた上で、Google Searchを用いて
-        ユーザの質問に回答する。
-
-        # レポート
-        {context_text}
-
-        # ユーザーの質問
-        {user_question}
-
-        # 出力ルール
-        - 回答はMarkdown形式で出力すること。
-        - 各項目の最後に、根拠となる出典URLを必ず明記すること。
-        - 分析結果が不明瞭な箇所は、不明瞭な箇所を記述した上で、「判断材料不足」としてもよい。
-
-        # 指示内容
-        1. 質問への回答: ユーザーの質問に対して、最新情報に基づいた具体的かつ明確な回答を提供。
-        2. 関連情報の補足: 質問に関連する重要な周辺情報や、投資判断において考慮すべき点があれば追加で言及。
-
-        ## 追加の指示内容
-        {extra_instructions}
-        """
+        template, fields = "re_research_manual", {"context_text": context_text, "user_question": user_question}
 
     try:
         # Google検索(Grounding)機能を有効化して回答を生成
@@ -777,20 +2146,12 @@ def re_research():
 
         for attempt in range(max_retries):
             try:
-                # モデルと設定の切り替え
+                # モデルと設定の切り替え (Re-ResearchはHigh Thinking)
                 target_model = MODEL_LITE if use_lite else MODEL_NAME
-                
-                gen_config_params = {
-                    "tools": [types.Tool(google_search=types.GoogleSearch())]
-                }
-                if not use_lite:
-                    # Re-ResearchはHigh Thinking
-                    gen_config_params["thinking_config"] = types.ThinkingConfig(include_thoughts=True, thinking_level="high")
-
-                response = client.models.generate_content(
-                    model=target_model,
-                    contents=prompt,
-                    config=types.GenerateContentConfig(**gen_config_params)
+                response = generate_from_template(
+                    target_model, template, flags=flags,
+                    thinking_level=None if use_lite else "high",
+                    **fields,
                 )
                 return jsonify({"analysis": response.text})
             except Exception as inner_e:
@@ -803,7 +2164,7 @@ def re_research():
                 raise inner_e # その他のエラー、またはリトライ回数超過時は例外を投げる
         
     except Exception as e:
-        print(f"Re-Research Error: {str(e)}")
+        logger.exception(f"Re-Research Error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 # --- PDF出力ルート (pdfkit使用) ---
@@ -954,13 +2315,14 @@ def export_pdf():
         
         # PDF生成
         try:
-            pdf_bytes = pdfkit.from_string(full_html, False, options=options, configuration=config)
+            with stage("pdf"):
+                pdf_bytes = pdfkit.from_string(full_html, False, options=options, configuration=config)
         except OSError as e:
             if "No wkhtmltopdf executable found" in str(e):
                 return jsonify({"error": "サーバーに wkhtmltopdf がインストールされていません。公式サイトからインストールするか、wkhtmltopdf.exeを配置してください。"}), 500
             raise e
         except Exception as e:
-            print(f"wkhtmltopdf runtime error: {e}")
+            logger.exception(f"wkhtmltopdf runtime error: {e}")
             return jsonify({"error": f"PDF Generation Error: {str(e)}"}), 500
 
         pdf_io = BytesIO(pdf_bytes)
@@ -973,7 +2335,7 @@ def export_pdf():
             download_name=filename
         )
     except Exception as e:
-        print(f"PDF Export Error: {e}")
+        logger.exception(f"PDF Export Error: {e}")
         return jsonify({"error": str(e)}), 500
 
 if __name__ == "__main__":
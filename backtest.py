@@ -0,0 +1,163 @@
+# 移動平均線クロス・25日乖離率の売買ルールを保存済みの株価で検証するバックテストエンジン
+#
+# Flaskやyfinanceに依存しない純粋なNumPy計算のみをまとめたモジュール。
+# 銘柄ごとの計算はプロセスプールで並列化するため、ワーカーはこのモジュールだけを読み込めば動くようにしている。
+#
+# 売買ルールはいずれも「当日終値でシグナル確定 → 翌日の値動きから損益を計上」とし、先読みを避ける。
+#   ma_cross : 短期移動平均線 > 長期移動平均線 (ゴールデンクロス後) の間だけ保有
+#   kairi    : 25日乖離率が entry% 以下で買い、exit% 以上で手仕舞い
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+TRADING_DAYS = 252
+
+# 戦略ごとの既定パラメータ
+STRATEGY_DEFAULTS = {
+    "ma_cross": {"fast": 25, "slow": 75},
+    "kairi": {"window": 25, "entry": -10.0, "exit": 0.0},
+}
+
+# この銘柄数未満ならプロセスを使わずにその場で計算する (プロセス起動のほうが高くつくため)
+PARALLEL_MIN_TICKERS = 8
+
+_executor = None
+
+
+def rolling_mean(values, window):
+    # 累積和を使った移動平均 (先頭 window-1 個は NaN)
+    out = np.full(len(values), np.nan)
+    if len(values) < window:
+        return out
+    csum = np.cumsum(np.insert(values, 0, 0.0))
+    out[window - 1:] = (csum[window:] - csum[:-window]) / window
+    return out
+
+
+def ffill_positions(signals):
+    # 1 (買い) / 0 (手仕舞い) / NaN (変化なし) のシグナル列を前方埋めして保有状態にする
+    valid = ~np.isnan(signals)
+    idx = np.where(valid, np.arange(len(signals)), 0)
+    np.maximum.accumulate(idx, out=idx)
+    positions = signals[idx]
+    positions[np.isnan(positions)] = 0.0
+    return positions
+
+
+def strategy_positions(closes, strategy, params):
+    if strategy == "ma_cross":
+        fast = rolling_mean(closes, int(params["fast"]))
+        slow = rolling_mean(closes, int(params["slow"]))
+        return np.where(fast > slow, 1.0, 0.0)
+    if strategy == "kairi":
+        sma = rolling_mean(closes, int(params["window"]))
+        kairi = (closes - sma) / sma * 100
+        signals = np.full(len(closes), np.nan)
+        signals[kairi >= float(params["exit"])] = 0.0
+        signals[kairi <= float(params["entry"])] = 1.0
+        return ffill_positions(signals)
+    raise ValueError(f"unknown strategy: {strategy}")
+
+
+def backtest_closes(closes, strategy, params, cost_bps=0.0):
+    # 1銘柄分の終値配列に対して売買ルールを適用し、成績指標を返す
+    closes = np.asarray(closes, dtype=np.float64)
+    if len(closes) < 3:
+        return None
+
+    positions = strategy_positions(closes, strategy, params)
+    # 当日のシグナルで翌日を保有する
+    held = np.concatenate(([0.0], positions[:-1]))
+    daily_returns = np.concatenate(([0.0], closes[1:] / closes[:-1] - 1))
+
+    # 売買の切り替え時に片道コストを差し引く
+    turnover = np.abs(np.diff(held, prepend=0.0))
+    strategy_returns = held * daily_returns - turnover * cost_bps / 10000
+
+    equity = np.cumprod(1 + strategy_returns)
+    drawdown = equity / np.maximum.accumulate(equity) - 1
+
+    # 取引ごとの損益 (保有開始ごとに番号を振って集計)。手仕舞い日のコストもその取引に含める
+    prev_held = np.concatenate(([0.0], held[:-1]))
+    entries = (held == 1.0) & (prev_held == 0.0)
+    trade_ids = np.cumsum(entries) * ((held == 1.0) | (prev_held == 1.0))
+    trade_log_returns = np.bincount(trade_ids, weights=np.log1p(strategy_returns), minlength=int(trade_ids.max()) + 1)[1:]
+    trades = len(trade_log_returns)
+
+    years = (len(closes) - 1) / TRADING_DAYS
+    total_return = float(equity[-1] - 1)
+    return {
+        "bars": int(len(closes)),
+        "total_return": total_return * 100,
+        "annual_return": ((1 + total_return) ** (1 / years) - 1) * 100 if years > 0 and total_return > -1 else None,
+        "buy_and_hold": float(closes[-1] / closes[0] - 1) * 100,
+        "max_drawdown": float(drawdown.min()) * 100,
+        "trades": trades,
+        "hit_rate": float((trade_log_returns > 0).mean()) * 100 if trades else None,
+        "exposure": float(held.mean()) * 100,
+    }
+
+
+def _run_one(args):
+    ticker, closes, strategy, params, cost_bps = args
+    return ticker, backtest_closes(closes, strategy, params, cost_bps)
+
+
+def _get_executor():
+    # マルチスレッドのWebサーバーからforkするとロックを引き継いで固まることがあるため、forkserver(なければspawn)を使う
+    global _executor
+    if _executor is None:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        _executor = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=context)
+    return _executor
+
+
+def run_backtests(price_map, strategy, params=None, cost_bps=0.0):
+    # price_map: 銘柄 -> 終値配列。銘柄数が多い場合はプロセスプールで並列に計算する
+    global _executor
+    if strategy not in STRATEGY_DEFAULTS:
+        raise ValueError(f"unknown strategy: {strategy}")
+    merged = {**STRATEGY_DEFAULTS[strategy], **(params or {})}
+    jobs = [(ticker, closes, strategy, merged, cost_bps) for ticker, closes in price_map.items()]
+
+    results = None
+    if len(jobs) >= PARALLEL_MIN_TICKERS:
+        try:
+            executor = _get_executor()
+            chunksize = max(1, len(jobs) // (executor._max_workers * 4))
+            results = list(executor.map(_run_one, jobs, chunksize=chunksize))
+        except BrokenProcessPool:
+            # ワーカーが落ちた場合はプールを作り直すことにして、今回はその場で計算する
+            _executor = None
+    if results is None:
+        results = map(_run_one, jobs)
+    return {ticker: result for ticker, result in results if result is not None}, merged
+
+
+def summarize(results):
+    # 複数銘柄の結果を平均・中央値などにまとめる
+    if not results:
+        return {}
+    values = list(results.values())
+
+    def column(key):
+        return np.array([v[key] for v in values if v[key] is not None], dtype=np.float64)
+
+    total = column("total_return")
+    hit = column("hit_rate")
+    ranked = sorted(results.items(), key=lambda kv: kv[1]["total_return"], reverse=True)
+    return {
+        "tickers": len(values),
+        "mean_return": float(total.mean()),
+        "median_return": float(np.median(total)),
+        "mean_buy_and_hold": float(column("buy_and_hold").mean()),
+        "mean_max_drawdown": float(column("max_drawdown").mean()),
+        "mean_hit_rate": float(hit.mean()) if len(hit) else None,
+        "win_ratio": float((total > 0).mean()) * 100,
+        "best": [{"ticker": t, "total_return": r["total_return"]} for t, r in ranked[:5]],
+        "worst": [{"ticker": t, "total_return": r["total_return"]} for t, r in ranked[-5:][::-1]],
+    }
@@ -0,0 +1,417 @@
+# 株価データ取得・指標計算・描画データ作成などのホットパスを計測するベンチマーク
+#
+# 使い方 (リポジトリ直下で実行):
+#   python -m benchmarks.bench                  # 計測して結果を表示
+#   python -m benchmarks.bench --quick          # 銘柄数・繰り返し回数を減らして短時間で計測
+#   python -m benchmarks.bench --save-baseline  # 結果を benchmarks/baseline.json に保存
+#   python -m benchmarks.bench --compare        # baseline.json と比較し、劣化があれば終了コード1
+#   python -m benchmarks.bench --record         # 実際のyfinance・RSSから fixtures/ を記録し直す (要ネットワーク)
+#
+# yfinance・Google News RSS・Gemini の応答は fixtures/ の記録済みデータで置き換えるため、オフラインで実行できる。
+# 株価の記録 (fixtures/prices/*.csv) がない銘柄は、銘柄コードを種にした再現可能な乱数で10年分の日足を合成する。
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import argparse
+import platform
+import statistics
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+FIXTURE_DIR = os.path.join(BENCH_DIR, "fixtures")
+PRICE_FIXTURE_DIR = os.path.join(FIXTURE_DIR, "prices")
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+
+sys.path.insert(0, ROOT_DIR)
+import app  # noqa: E402
+import backtest  # noqa: E402
+
+# リクエストごとの計測ログは計測結果の表示の邪魔になるため抑制
+logging.getLogger("nikkei_app").setLevel(logging.WARNING)
+
+# 合成データの最終日 (実行日によって結果が変わらないよう固定)
+FIXTURE_END_DATE = "2026-10-16"
+PERIODS = ["1y", "2y", "5y", "10y"]
+TOPIC_COUNTS = [1, 5, 10]
+UNIVERSE_SIZES = [1, 10, 50, 242]
+QUICK_UNIVERSE_SIZES = [1, 10, 50]
+
+
+# --- 記録済みフィクスチャの読み込み ---
+def fixture_path(name):
+    return os.path.join(FIXTURE_DIR, name)
+
+def price_fixture_path(ticker):
+    return os.path.join(PRICE_FIXTURE_DIR, ticker.replace("^", "").replace(".", "_") + ".csv")
+
+def synthetic_prices(ticker, years=10):
+    # 銘柄コードを種にした幾何ブラウン運動で日足を合成
+    rng = np.random.default_rng(zlib.crc32(ticker.encode()))
+    idx = pd.bdate_range(end=FIXTURE_END_DATE, periods=years * 245, name="Date")
+    close = 1000 * np.exp(np.cumsum(rng.normal(0.0003, 0.018, len(idx))))
+    open_ = close * (1 + rng.normal(0, 0.005, len(idx)))
+    spread = np.abs(rng.normal(0, 0.01, len(idx))) * close
+    return pd.DataFrame({
+        "Open": open_,
+        "High": np.maximum(open_, close) + spread,
+        "Low": np.minimum(open_, close) - spread,
+        "Close": close,
+        "Volume": rng.integers(100_000, 10_000_000, len(idx)),
+    }, index=idx)
+
+_price_cache = {}
+
+def load_prices(ticker):
+    if ticker not in _price_cache:
+        path = price_fixture_path(ticker)
+        if os.path.exists(path):
+            _price_cache[ticker] = pd.read_csv(path, index_col="Date", parse_dates=["Date"])
+        else:
+            _price_cache[ticker] = synthetic_prices(ticker)
+    return _price_cache[ticker]
+
+def slice_period(df, period):
+    offset = app.PERIOD_OFFSETS[period]
+    if offset is None:
+        return df
+    return df[df.index >= df.index[-1] - offset]
+
+
+# --- 外部サービスのスタブ ---
+class FakeTicker:
+    # yf.Ticker の代わりに記録済みのファンダメンタルズを返す
+    def __init__(self, ticker):
+        with open(fixture_path("fundamentals.json"), encoding="utf-8") as f:
+            data = json.load(f)
+        self.ticker = ticker
+        self.fast_info = data["fast_info"]
+        self.info = data["info"]
+
+    def history(self, period="1mo", interval="1d", **kwargs):
+        # 株価は記録済み (なければ合成) の日足を期間で切り出して返す
+        return slice_period(load_prices(self.ticker), period).copy()
+
+class _StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+class _StubModels:
+    def __init__(self, text):
+        self._text = text
+
+    def generate_content(self, model, contents, config=None):
+        return _StubResponse(self._text)
+
+class _StubCachedContent:
+    def __init__(self, name):
+        self.name = name
+
+class _StubCaches:
+    # SDKのキャッシュ登録の代わり (登録内容は名前ごとに保持するだけ)
+    def __init__(self):
+        self.registered = {}
+
+    def create(self, model, config=None):
+        name = f"cachedContents/stub-{len(self.registered)}"
+        self.registered[name] = (model, config)
+        return _StubCachedContent(name)
+
+class StubGeminiClient:
+    # Geminiの代わりに記録済みのMarkdownを返すクライアント
+    def __init__(self):
+        with open(fixture_path("gemini_response.md"), encoding="utf-8") as f:
+            self.models = _StubModels(f.read())
+        self.caches = _StubCaches()
+
+def install_stubs(db_dir):
+    with open(fixture_path("google_news.xml"), "rb") as f:
+        rss_bytes = f.read()
+    parse = app.feedparser.parse
+
+    app.yf.Ticker = FakeTicker
+    # RSSは毎回パースさせる (ネットワーク以外のコストは実際と同じ)
+    app.feedparser.parse = lambda url, *args, **kwargs: parse(rss_bytes)
+    app.client = StubGeminiClient()
+    app.prompt_cache = app.prompts.PromptCache(app.client)
+    app.PROFILE_REFRESH_ENABLED = False
+    app.DIGEST_ENABLED = False
+    # 外部APIはスタブのため流量制限をかけない (制限のオーバーヘッドではなく処理そのものを計測する)
+    app.UPSTREAM_LIMITS.clear()
+    app.DB_PATH = os.path.join(db_dir, "bench.db")
+
+    # wkhtmltopdfがない環境ではPDF変換のみスタブにする (Markdown→HTML変換までを計測)
+    pdf_backend = "wkhtmltopdf"
+    if not shutil.which("wkhtmltopdf") and not os.path.exists("/usr/bin/wkhtmltopdf"):
+        pdf_backend = "stub"
+        app.pdfkit.from_string = lambda html, output_path, **kwargs: b"%PDF-1.4 bench stub"
+    return pdf_backend
+
+
+# --- 計測 ---
+def measure(fn, repeat, setup=None):
+    # setupは計測時間に含めない。初回はimportやキャッシュの準備を含むため計測しない
+    if setup:
+        setup()
+    fn()
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    ordered = sorted(samples)
+    return {
+        "runs": repeat,
+        "min_ms": round(ordered[0], 3),
+        "median_ms": round(statistics.median(ordered), 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        "mean_ms": round(statistics.fmean(ordered), 3),
+    }
+
+_db_generation = [0]
+
+def reset_db():
+    # 書き込み待ちを済ませてから、新しいDBファイルに切り替える (接続はパスごとに張り直される)
+    app.db_writer.flush()
+    _db_generation[0] += 1
+    app.DB_PATH = os.path.join(os.path.dirname(app.DB_PATH), f"bench_{_db_generation[0]}.db")
+
+def expect_ok(response):
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.status_code}: {response.get_data(as_text=True)[:200]}")
+    return response
+
+def run_benchmarks(quick=False):
+    repeat = 3 if quick else 10
+    http = app.app.test_client()
+    results = {}
+
+    def record(name, fn, runs=repeat, setup=None):
+        results[name] = measure(fn, runs, setup)
+        print(f"{name:<40} median {results[name]['median_ms']:>10.2f} ms  (min {results[name]['min_ms']:.2f}, runs {runs})")
+
+    # 指標計算・間引き・JSON化 (期間ごと)
+    base = load_prices("7203.T")
+    for period in PERIODS:
+        df = slice_period(base, period)
+        record(f"indicators[{period}]", lambda df=df: app.add_indicators(df.copy()))
+
+        full = app.add_indicators(df.copy())
+        record(f"downsample[{period}]", lambda full=full: app.downsample_bars(full, app.DEFAULT_MAX_POINTS))
+
+        chart_df = app.downsample_bars(full, app.DEFAULT_MAX_POINTS)
+        with app.app.app_context():
+            record(f"serialize[{period}]", lambda chart_df=chart_df: app.app.json.dumps(app.chart_payload(chart_df)))
+
+    # get_data のエンドツーエンド (未保存: yfinance取得+DB保存 / 保存済み: DB読み出し)
+    for period in PERIODS:
+        url = f"/get_data?ticker=7203.T&period={period}"
+        record(f"get_data_cold[{period}]", lambda url=url: expect_ok(http.get(url)), setup=reset_db)
+        expect_ok(http.get(url))
+        app.db_writer.flush()
+        record(f"get_data_warm[{period}]", lambda url=url: expect_ok(http.get(url)))
+
+    # 列指向ファイル (PRICE_STORE=columnar) に保存した場合の読み出し
+    app.PRICE_STORE = "columnar"
+    for period in PERIODS:
+        url = f"/get_data?ticker=7203.T&period={period}"
+        reset_db()
+        expect_ok(http.get(url))
+        app.db_writer.flush()
+        record(f"get_data_warm_columnar[{period}]", lambda url=url: expect_ok(http.get(url)))
+    app.PRICE_STORE = "sqlite"
+
+    # 銘柄数を増やした場合 (全銘柄の1年分を順に読み込む)
+    _, stocks = app.load_stock_data()
+    tickers = [s["ticker"] for s in stocks]
+    for size in (QUICK_UNIVERSE_SIZES if quick else UNIVERSE_SIZES):
+        subset = tickers[:size]
+        def load_universe(subset=subset):
+            for ticker in subset:
+                expect_ok(http.get(f"/get_data?ticker={quote(ticker, safe='')}"))
+            app.db_writer.flush()
+        record(f"get_data_universe[{len(subset)}]", load_universe, runs=1 if size > 50 else min(repeat, 3), setup=reset_db)
+
+    # 複数スレッドから同時にチャートを読み込んだ場合 (DBの書き込み競合を含む)
+    def load_parallel(subset=tickers[:50], workers=8):
+        def load(ticker):
+            expect_ok(app.app.test_client().get(f"/get_data?ticker={quote(ticker, safe='')}"))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(load, subset))
+        app.db_writer.flush()
+    record("get_data_parallel[8x50]", load_parallel, runs=min(repeat, 3), setup=reset_db)
+
+    # バックテスト (全銘柄 × 10年分の日足、プロセスプールで並列計算)
+    universe_closes = {t: load_prices(t)["Close"].to_numpy() for t in tickers}
+    for strategy in ("ma_cross", "kairi"):
+        record(f"backtest_{strategy}[{len(tickers)}x10y]",
+               lambda strategy=strategy: backtest.run_backtests(universe_closes, strategy), runs=min(repeat, 3))
+
+    # 全銘柄の終値の読み出し (保存形式ごと)
+    for store in ("columnar", "sqlite"):
+        app.PRICE_STORE = store
+        reset_db()
+        for ticker in tickers:
+            app.store_to_db(ticker, load_prices(ticker), "10y")
+        app.db_writer.flush()
+        record(f"load_closes_{store}[{len(tickers)}x10y]", lambda: app.load_stored_closes(tickers, "10y"), runs=min(repeat, 3))
+
+    # 銘柄間比較 (全銘柄の終値行列から相関・ベータ・相対力を計算 / 同じ営業日の2回目以降はキャッシュから返す)
+    record(f"universe_stats_cold[{len(tickers)}x1y]", lambda: expect_ok(http.get("/universe_stats")),
+           runs=min(repeat, 3), setup=lambda: (app._price_matrix_cache.clear(), app._universe_cache.clear()))
+    record(f"universe_stats_warm[{len(tickers)}x1y]", lambda: expect_ok(http.get("/universe_stats?industry=金融系")))
+
+    # RSSニュース取得 (トピック数ごと)
+    topics = ["日経平均", "半導体", "為替", "米国株", "日銀", "決算", "原油", "金利", "自動車", "銀行"]
+    for count in TOPIC_COUNTS:
+        record(f"fetch_rss_news[{count}]", lambda count=count: app.fetch_rss_news(topics[:count], 150))
+
+    # プロンプト組み立て (Geminiはスタブのため、ルート処理とプロンプト作成のコスト)
+    for period in ("1y", "10y"):
+        chart_df = app.downsample_bars(app.add_indicators(slice_period(base, period).copy()), app.DEFAULT_MAX_POINTS)
+        payload = {"ticker": "7203.T", **app.chart_payload(chart_df)}
+        record(f"analyze_prompt[{period}]", lambda payload=payload: expect_ok(http.post("/analyze", json=payload)))
+    market_payload = {"topics": topics[:5], "deep_analysis": True, "sector_view": True}
+    record("analyze_market_prompt[5]", lambda: expect_ok(http.post("/analyze_market", json=market_payload)))
+    # 市況ダイジェスト (標準トピックの組み合わせは事前生成済みの分析を返す)
+    app.generate_market_digests("indices", ["base"])
+    app.db_writer.flush()
+    digest_payload = {"topics": app.DIGEST_TOPIC_SETS["indices"]}
+    record("analyze_market_digest[indices]", lambda: expect_ok(http.post("/analyze_market", json=digest_payload)))
+    # 会社プロフィール (保存済みの読み出し / 再生成)
+    company_payload = {"ticker": "7203.T", "name": "トヨタ自動車"}
+    record("company_info[db]", lambda: expect_ok(http.post("/get_company_info", json=company_payload)))
+    record("company_info[generate]",
+           lambda: expect_ok(http.post("/get_company_info", json={**company_payload, "refresh": True})))
+
+    # 銘柄検索 (コード前方一致 / ローマ字読み / 部分一致 / 曖昧一致) とトップページ
+    for label, query in (("code", "72"), ("romaji", "toyota"), ("substring", "電鉄"), ("fuzzy", "sony")):
+        record(f"search_stocks[{label}]", lambda query=query: expect_ok(http.get("/search_stocks", query_string={"q": query})))
+    record("index_page", lambda: expect_ok(http.get("/")))
+
+    # PDF出力 (レポートの長さごと)
+    with open(fixture_path("gemini_response.md"), encoding="utf-8") as f:
+        report = f.read()
+    for scale in (1, 10):
+        pdf_payload = {"title": "ベンチマーク", "content": "\n\n".join([report] * scale), "ticker": "7203.T"}
+        record(f"export_pdf[x{scale}]", lambda pdf_payload=pdf_payload: expect_ok(http.post("/export_pdf", json=pdf_payload)),
+               runs=max(1, repeat // 2))
+
+    return results
+
+# --- ベースラインとの比較 ---
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if not previous:
+            continue
+        ratio = current["median_ms"] / previous["median_ms"] if previous["median_ms"] else 1.0
+        mark = "REGRESSION" if ratio > 1 + tolerance else ("improved" if ratio < 1 - tolerance else "")
+        print(f"{name:<40} {previous['median_ms']:>10.2f} -> {current['median_ms']:>10.2f} ms  x{ratio:.2f} {mark}")
+        if mark == "REGRESSION":
+            regressions.append(name)
+    return regressions
+
+
+# --- 実データの記録 (要ネットワーク) ---
+def record_fixtures(ticker_count):
+    import yfinance as yf
+    import feedparser
+    import urllib.request
+
+    os.makedirs(PRICE_FIXTURE_DIR, exist_ok=True)
+    _, stocks = app.load_stock_data()
+    for s in stocks[:ticker_count]:
+        df = yf.download(s["ticker"], period="10y", interval="1d", progress=False)
+        if df.empty:
+            continue
+        if isinstance(df.columns, pd.MultiIndex):
+            df.columns = df.columns.get_level_values(0)
+        df = df.dropna(subset=["Open", "High", "Low", "Close"])[["Open", "High", "Low", "Close", "Volume"]]
+        df.rename_axis("Date").to_csv(price_fixture_path(s["ticker"]))
+        print(f"recorded prices: {s['ticker']} ({len(df)} rows)")
+
+    stock_obj = yf.Ticker("7203.T")
+    fast_info = {k: stock_obj.fast_info[k] for k in ("market_cap", "last_price")}
+    keys = json.load(open(fixture_path("fundamentals.json"), encoding="utf-8"))["info"].keys()
+    info = {k: stock_obj.info.get(k) for k in keys}
+    with open(fixture_path("fundamentals.json"), "w", encoding="utf-8") as f:
+        json.dump({"fast_info": fast_info, "info": info}, f, ensure_ascii=False, indent=2)
+    print("recorded fundamentals: 7203.T")
+
+    url = "https://news.google.com/rss/search?q=" + quote("株式") + "&hl=ja&gl=JP&ceid=JP:ja"
+    with urllib.request.urlopen(url, timeout=30) as res:
+        rss_bytes = res.read()
+    if feedparser.parse(rss_bytes).entries:
+        with open(fixture_path("google_news.xml"), "wb") as f:
+            f.write(rss_bytes)
+        print("recorded rss: google_news.xml")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="日経225スマートAI分析 ベンチマーク")
+    parser.add_argument("--quick", action="store_true", help="繰り返し回数と銘柄数を減らして実行")
+    parser.add_argument("--output", help="結果JSONの保存先")
+    parser.add_argument("--save-baseline", action="store_true", help="結果を baseline.json として保存")
+    parser.add_argument("--compare", action="store_true", help="baseline.json と比較して劣化を検出")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="劣化とみなす中央値の増加率 (既定: 0.25)")
+    parser.add_argument("--record", action="store_true", help="実データを取得して fixtures/ を記録し直す")
+    parser.add_argument("--record-tickers", type=int, default=10, help="--record で記録する銘柄数")
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixtures(args.record_tickers)
+        return 0
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        pdf_backend = install_stubs(db_dir)
+        results = run_benchmarks(quick=args.quick)
+
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "quick": args.quick,
+            "pdf_backend": pdf_backend,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"baseline saved: {BASELINE_PATH}")
+    if args.compare:
+        if not os.path.exists(BASELINE_PATH):
+            print("baseline.json がありません。--save-baseline で作成してください。")
+            return 1
+        with open(BASELINE_PATH, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} 件の劣化を検出しました: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+# 銘柄・足種ごとのOHLCVを列ごとの型付き配列として1ファイルに保存し、読み出し時はメモリマップする保存形式
+#
+# ファイル構成 (リトルエンディアン):
+#   ヘッダー 16バイト : マジック b"OHLCV1\0\0" + 行数 (int64)
+#   列データ          : ts (int64, 取引所現地時刻のエポック秒) / open, high, low, close (float32) / volume (int64)
+#                       の順に、各列が連続して並ぶ (列ごとに読めば必要なページだけがメモリに載る)
+# 書き込みは一時ファイルに書いてから置き換えるため、読み出し側が書きかけの状態を見ることはない。
+# 読み出した配列はファイルのメモリマップ上のビュー (読み取り専用) で、期間の切り出しもコピーせずに行う。
+import os
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+MAGIC = b"OHLCV1\0\0"
+HEADER_SIZE = 16
+COLUMNS = (
+    ("ts", np.dtype("<i8")),
+    ("open", np.dtype("<f4")),
+    ("high", np.dtype("<f4")),
+    ("low", np.dtype("<f4")),
+    ("close", np.dtype("<f4")),
+    ("volume", np.dtype("<i8")),
+)
+ROW_SIZE = sum(dtype.itemsize for _, dtype in COLUMNS)
+
+# Windowsではメモリマップ中のファイルを置き換えられないため、読み出しが終わるまで少し待って再試行する
+REPLACE_RETRIES = 5
+REPLACE_RETRY_DELAY = 0.05
+
+
+def bar_path(root, ticker, interval):
+    # 銘柄コードはリクエストから渡されるため、パスとして解釈されないようにエスケープする
+    return os.path.join(root, f"{urllib.parse.quote(ticker, safe='')}@{interval}.ohlcv")
+
+
+def read_bars(path):
+    # 列名 -> 配列 (メモリマップ上のビュー) を返す。ファイルがなければNone
+    try:
+        if os.path.getsize(path) < HEADER_SIZE:
+            return None
+        buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    except FileNotFoundError:
+        return None
+    if bytes(buffer[:8]) != MAGIC:
+        raise ValueError(f"not an OHLCV file: {path}")
+    rows = int(np.frombuffer(buffer, dtype="<i8", count=1, offset=8)[0])
+    if len(buffer) != HEADER_SIZE + rows * ROW_SIZE:
+        raise ValueError(f"truncated OHLCV file: {path}")
+
+    columns, offset = {}, HEADER_SIZE
+    for name, dtype in COLUMNS:
+        columns[name] = np.frombuffer(buffer, dtype=dtype, count=rows, offset=offset)
+        offset += rows * dtype.itemsize
+    return columns
+
+
+def write_bars(path, columns):
+    # 全列を一時ファイルに書き出してから置き換える
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rows = len(columns["ts"])
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.int64(rows).astype("<i8").tobytes())
+        for name, dtype in COLUMNS:
+            f.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+
+    for attempt in range(REPLACE_RETRIES):
+        try:
+            os.replace(tmp_path, path)
+            return
+        except PermissionError:
+            if attempt == REPLACE_RETRIES - 1:
+                os.remove(tmp_path)
+                raise
+            time.sleep(REPLACE_RETRY_DELAY * (attempt + 1))
+
+
+def merge_bars(old, new):
+    # 既存のバーに新しいバーを重ね、時刻順に並べる (同じ時刻は新しい値を優先)
+    if old is None or not len(old["ts"]):
+        return new
+    if not len(new["ts"]):
+        return old
+    # 新しいバーがすべて既存より後なら単純に連結する
+    if new["ts"][0] > old["ts"][-1]:
+        return {name: np.concatenate([old[name], new[name]]) for name, _ in COLUMNS}
+
+    ts = np.concatenate([old["ts"], new["ts"]])
+    order = np.argsort(ts, kind="stable")
+    sorted_ts = ts[order]
+    keep = order[np.append(sorted_ts[1:] != sorted_ts[:-1], True)]
+    return {name: np.concatenate([old[name], new[name]])[keep] for name, _ in COLUMNS}
+
+
+def slice_since(columns, since_ts):
+    # since_ts (エポック秒) 以降の行をコピーせずに切り出す
+    start = int(np.searchsorted(columns["ts"], since_ts, side="left"))
+    return {name: values[start:] for name, values in columns.items()}
@@ -0,0 +1,335 @@
+# Geminiに送るプロンプトのテンプレートと、固定部分のコンテキストキャッシュ
+#
+# 各ルートのプロンプトを「固定部分 (役割・出力ルール・指示内容)」と「リクエストごとの部分 (目的・データ・追加の指示)」に分ける。
+# 固定部分はsystem_instructionとして毎回同じ内容・同じ位置で送るため、Gemini側の暗黙的なプレフィックスキャッシュが効きやすい。
+# さらにSDKのキャッシュ機能 (client.caches) が使える場合は、固定部分を一度だけ登録して以降は名前で参照する。
+# 登録できない場合 (最小トークン数に満たない・未対応のモデル・スタブなど) は通常のsystem_instructionに戻す。
+import logging
+import threading
+import time
+
+from google.genai import types
+
+logger = logging.getLogger("nikkei_app.prompts")
+
+CACHE_TTL_SECONDS = 60 * 60          # 登録したキャッシュの有効期間
+CACHE_REFRESH_MARGIN = 5 * 60        # 期限切れ直前のキャッシュは使わずに登録し直す
+CACHE_RETRY_SECONDS = 6 * 60 * 60    # 登録に失敗したテンプレートを再試行するまでの時間
+
+UNCLEAR_RULE = "- 分析結果が不明瞭な箇所は、不明瞭な箇所を記述した上で、「判断材料不足」としてもよい。"
+BEGINNER_OPTION = "- 初学者向け説明：説明の際に使用する専門用語に「※」で注釈を追加して投資初学者でも分かりやすい説明をすること。"
+
+# 再調査は自動・質問モードで同じ追加指示を使う
+RE_RESEARCH_OPTIONS = {
+    "beginner_mode": BEGINNER_OPTION,
+    "deep_analysis": "- 詳細分析：表面的な事実だけでなく、背景にある要因や将来的なリスクについても深く分析すること。",
+    "short_term": "- 短期分析：直近1週間の短期的な目線の分析をすること。特に、直近のイベントや需給の変化に着目すること。",
+    "mid_term": "- 中期分析：直近1ヶ月の中期的な目線の分析をすること。特に、トレンドの転換点や経済指標の影響に着目すること。",
+}
+
+# system: 固定部分 / user: リクエストごとの部分 (str.formatの書式) / search: Google検索を使うか
+# options: リクエストのフラグ名 -> 追加の指示内容 (この順番で追加する)
+TEMPLATES = {
+    "analyze": {
+        "system": f"""# 役割
+あなたは金融市場を分析するプロの投資アナリストです。
+
+# 出力ルール
+- 分析結果はMarkdown形式で出力すること。
+{UNCLEAR_RULE}
+
+# 指示内容
+1. トレンド分析：5日(短期), 25日(中期), 75日(長期)の各移動平均線の向きから現在のトレンドを分析。
+2. 移動平均線分析：25日と75日のクロス状況(ゴールデンクロスまたはデッドクロス)と、移動平均線3本が収束することによるオーバーシュートの予兆を考察。
+3. ライン分析：明確な支持線・抵抗線が見える日付範囲と価格帯を分析。
+4. 乖離率考察：現在の25日乖離率と、過去の乖離率の推移を比較することで、売られすぎ・買われすぎの目安となる値を極値を基に考察。異常値と思われる値は異常値である旨を記載すること。
+5. 結論：1～4の内容を基に、今後の展望と、戦略アドバイスを出力。""",
+        "user": """# 目的
+投資判断のために、以下の図データと、出力ルール・指示内容に従って
+銘柄「{ticker}」のテクニカル指標に基づく分析をする。
+
+# 図データ
+直近1年間の終値推移: {recent_candles}
+直近1年間の25日移動平均線乖離率: {recent_kairi}
+
+## 追加の指示内容
+{extra_instructions}""",
+        "search": False,
+        "options": {
+            "beginner_mode": BEGINNER_OPTION,
+            "deep_analysis": "- 詳細分析：騙しやノイズの可能性についても考慮し、複数のシナリオ（強気・弱気）を提示すること。",
+        },
+    },
+    "analyze_full": {
+        "system": f"""# 役割
+あなたは金融市場を分析するプロの投資アナリストです。
+
+# 出力ルール
+- 分析結果はMarkdown形式で出力すること。
+- 各項目の最後に、根拠となる出典URLを必ず明記すること。
+{UNCLEAR_RULE}
+
+# 指示内容
+1. 業績抽出：最新決算の売上・利益、キャッシュフロー、業績変動要因、および今後の株主還元策（配当・自社株買い等）を抽出。
+2. 動向考察：直近1年の株価推移を分析し、上昇・下落の主因を考察。
+3. 需給分析：現在の信用倍率と推移から、個人・機関の売買動向を分析。
+4. 評価抽出：目標株価・コンセンサス情報を抽出。
+5. 結論：今後の注目イベントとリスク要因を整理。""",
+        "user": """# 目的
+投資判断のために、出力ルールと指示内容に従って
+Google Searchを用いて最新情報を取得することで
+銘柄「{ticker}」を分析する。
+
+## 追加の指示内容
+{extra_instructions}""",
+        "search": True,
+        "options": {
+            "beginner_mode": BEGINNER_OPTION,
+            "deep_analysis": "- 詳細分析：競合他社との比較や、業界全体の動向についても言及し、より多角的な視点で分析すること。",
+        },
+    },
+    "analyze_volume": {
+        "system": f"""# 役割
+あなたは金融市場を分析するプロの投資アナリストです。
+
+# 出力ルール
+- 分析結果はMarkdown形式で出力すること。
+{UNCLEAR_RULE}
+- 調査対象は、個別株そのものの調査と、日経平均・S&P500といったマクロ指標の調査を行なうこと。ただし、マクロ指標が±2%以上変動している場合は経済的なニュースだけでなく、政治的なニュースも調査すること。
+- 対象日・発生イベント・投資家心理の部分は、表形式でまとめること。
+- 各項目の最後に、根拠となる出典URLを最後に明記すること。
+- 個別株による要因は個別要因とし、マクロ指標による要因は市況要因とすることで、分けて記述すること。また、どちらの要因も影響が大きい場合は共通要因として一緒に記述すること。
+
+# 指示内容
+1. 発生イベント：決算発表、マクロ指標、経済ニュースなど、原因となった事象を調査。
+2. 投資家心理：市場がそのニュースをどう受け止め、なぜ出来高が急増したかを考察。
+3. 横断的考察：複数の日付がある場合、それらが「下落と反発」などどのような一連のストーリーを形成しているかを考察。""",
+        "user": """# 目的
+投資判断のために、以下の出来高データと、出力ルール・指示内容に従って
+銘柄「{ticker}」の出来高数1位～10位の日に市場で何が起きたのかを、
+Google Searchを用いて調査する。
+
+# 出来高データ
+{date_groups}""",
+        "search": True,
+        "options": {},
+    },
+    "analyze_market": {
+        "system": f"""# 役割
+あなたは金融市場を分析するプロの投資アナリストです。
+
+# 出力ルール
+- 分析結果はMarkdown形式で出力すること。
+{UNCLEAR_RULE}
+- 出力結果の冒頭に、ニュース数と期間を記載すること。
+- 今後の予測は行わなくてもよい。
+
+# 指示内容
+- 分類抽出：トピックごとに見出しを分け、関連するニュースの要点を抽出。
+- 影響考察：各トピックが市場へ与える影響を考察。""",
+        "user": """# 目的
+投資判断のために、以下のニュースデータと、出力ルール・指示内容に従って
+取得ニュースに基づく市場の分析をする。
+
+# ニュースデータ
+ニュース数と期間：{date_range}
+ニュース本文：{news_text}
+
+## 追加の指示内容
+{extra_instructions}""",
+        "search": False,
+        "options": {
+            "beginner_mode": BEGINNER_OPTION,
+            "deep_analysis": "- 詳細分析：市場が抱えるリスクとその影響について分析すること。市場心理とボラティリティについても分析すること。",
+            "technical_mode": "- テクニカル分析：トレンド(上昇または下降)、支持・抵抗、出来高について分析してください。",
+            "short_term": "- 短期分析：直近1週間の短期的な目線の分析をすること。特に、信用取引の状況について分析すること。",
+            "mid_term": "- 中期分析：直近1ヶ月の中期的な目線の分析をすること。特に、月間の主要な経済指標やトレンドの変化について分析すること。",
+            "sector_view": "- 業種別分析：ニュース上で話題になっている各業種の状況について分析すること。",
+        },
+    },
+    "analyze_total": {
+        "system": f"""# 役割
+あなたは金融市場のレポートを分析するプロの投資戦略家です。
+
+# 出力ルール
+- 分析結果はMarkdown形式で出力すること。
+{UNCLEAR_RULE}
+
+# 指示内容
+1. 各分析結果の要点を統合し、現在の市場環境におけるリスクとチャンスを整理。
+2. データの中に同じ業種の異なる銘柄が含まれている場合は銘柄比較をしてもよい。例えば、相対的な強みと弱み、業績推移、株主還元姿勢の違い等を解説。
+3. 短期的(1カ月以内)・中期的(1カ月～3カ月以内)・長期的(3カ月～1年以内)な視点で、総合的な投資戦略及び、その戦略の根拠を提供。
+4. 最終的な投資判断材料としての総括と、としてのアドバイスを、その金融商品を保有している人向け、保有していない人向けそれぞれに提供。""",
+        "user": """# 目的
+最終的な投資判断をするために、以下のレポートデータと、出力ルール・指示内容に従って
+各分析結果から得られた情報を整理・分析する。
+
+# レポートデータ
+{context_text}""",
+        "search": False,
+        "options": {},
+    },
+    "company_info": {
+        "system": f"""# 役割
+あなたは特定の企業の情報を調査することを得意とする企業アナリストです。
+
+# 出力ルール
+- 回答はMarkdown形式で出力すること。
+- 各項目のタイトルの後に改行すること。
+- 各項目1〜4行程度で簡潔にまとめること。
+- 出力結果の最後の部分に、「会社URL:」として、会社の公式サイトURLを必ず記載すること。
+{UNCLEAR_RULE}
+
+# 指示内容
+1. 事業内容と優位性: 主要な事業を記述し、その後に直近1年の中で力を入れている事業を記述。その後に、競合他社に対する優位性を記述。
+2. 活動拠点: 売上高構成比率の大きさの観点から、売上高の順に国内または海外の拠点記述。
+3. 配当実績と優待: 過去10年間の配当実績を調査して取得して配当実績の推移(増加・減少・横ばい等)を評価。加えて、現在から一年前までの期間で、株主優待制度の実施状況・優待の内容を記述。""",
+        "user": """# 目的
+簡潔な企業情報を知るために、
+出力ルールと指示内容に従って
+日本株銘柄「{company_name} ({ticker})」について、
+Google Searchを用いて最新情報を調査する。""",
+        "search": True,
+        "options": {},
+    },
+    "re_research_auto": {
+        "system": f"""# 役割
+あなたは金融情報を調査することを得意とする金融アナリストです。
+
+# 出力ルール
+- 分析結果はMarkdown形式で出力すること。
+- 各項目の最後に、根拠となる出典URLを必ず明記すること。
+{UNCLEAR_RULE}
+
+# 指示内容
+1. 批判的検証: 元のレポートに欠けている視点、データが古い可能性、論理の飛躍を指摘し、それを補完する最新情報を調査・提示。
+2. 深掘り調査: 元のレポートで触れられているトピックについて、「なぜ？」「その背景は？」「競合はどうなのか？」といった疑問を自ら立て、追加調査。
+3. リスク再評価: 新たな情報を踏まえた上で、投資判断における隠れたリスクを分析。
+4. 結論: 再調査によって新たに得られた情報を整理。""",
+        "user": """# 目的
+以下のレポートの内容を精査し、情報の不足・矛盾・新たな疑問点を自律的に発見した上で、
+Google Searchによる再調査を行なうことで、「再調査レポート」を作成する。
+
+# レポート
+{context_text}
+
+## 追加の指示内容
+{extra_instructions}""",
+        "search": True,
+        "options": RE_RESEARCH_OPTIONS,
+    },
+    "re_research_manual": {
+        "system": f"""# 役割
+あなたは金融アドバイザーとしてユーザの質問に答える人です。
+
+# 出力ルール
+- 回答はMarkdown形式で出力すること。
+- 各項目の最後に、根拠となる出典URLを必ず明記すること。
+{UNCLEAR_RULE}
+
+# 指示内容
+1. 質問への回答: ユーザーの質問に対して、最新情報に基づいた具体的かつ明確な回答を提供。
+2. 関連情報の補足: 質問に関連する重要な周辺情報や、投資判断において考慮すべき点があれば追加で言及。""",
+        "user": """# 目的
+以下のレポートの内容と、ユーザの質問を踏まえた上で、Google Searchを用いて
+ユーザの質問に回答する。
+
+# レポート
+{context_text}
+
+# ユーザーの質問
+{user_question}
+
+## 追加の指示内容
+{extra_instructions}""",
+        "search": True,
+        "options": RE_RESEARCH_OPTIONS,
+    },
+}
+
+
+def render(name, flags=None, **fields):
+    # (固定部分, リクエストごとの部分) を返す。flagsで有効になっている追加の指示内容を差し込む
+    template = TEMPLATES[name]
+    flags = flags or {}
+    extra = "\n".join(text for key, text in template["options"].items() if flags.get(key))
+    return template["system"], template["user"].format(extra_instructions=extra, **fields)
+
+
+def search_tools(name):
+    # Google検索を使うテンプレートならツール一覧を返す
+    if TEMPLATES[name]["search"]:
+        return [types.Tool(google_search=types.GoogleSearch())]
+    return None
+
+
+def uncached_config(name, **extra):
+    # キャッシュを使わない場合の設定 (固定部分はsystem_instructionとして先頭に送る)
+    return types.GenerateContentConfig(system_instruction=TEMPLATES[name]["system"], tools=search_tools(name), **extra)
+
+
+def is_cache_error(e):
+    # 登録したキャッシュ自体が使えない (期限切れ・削除済み・不正な cached_content) ことによる失敗か
+    # (過負荷・流量制限・安全性フィルタなどはキャッシュを使わずに送り直しても解消しないため含めない)
+    return getattr(e, "code", None) in (400, 403, 404) and "cache" in str(e).lower()
+
+
+class PromptCache:
+    # テンプレートの固定部分をモデルごとにSDKのキャッシュへ登録し、その名前を使い回す
+    def __init__(self, client, enabled=True, ttl=CACHE_TTL_SECONDS):
+        self.client = client
+        self.enabled = enabled
+        self.ttl = ttl
+        self._entries = {}   # (model, name) -> (キャッシュ名, 期限)
+        self._failed = {}    # (model, name) -> 再試行してよい時刻
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _supported(self):
+        return self.enabled and self.client is not None and hasattr(self.client, "caches")
+
+    def get(self, model, name):
+        # 使えるキャッシュ名を返す (使えない場合はNone)
+        if not self._supported():
+            return None
+        key = (model, name)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # 同じテンプレートを複数スレッドが同時に登録しないよう、テンプレートごとに直列化する
+        with key_lock:
+            now = time.time()
+            entry = self._entries.get(key)
+            if entry and entry[1] - now > CACHE_REFRESH_MARGIN:
+                return entry[0]
+            if self._failed.get(key, 0) > now:
+                return None
+            try:
+                cached = self.client.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        display_name=f"nikkei-{name}",
+                        system_instruction=TEMPLATES[name]["system"],
+                        tools=search_tools(name),
+                        ttl=f"{self.ttl}s",
+                    ),
+                )
+            except Exception as e:
+                logger.info(f"Prompt cache unavailable for {name} on {model}: {e}")
+                self._failed[key] = now + CACHE_RETRY_SECONDS
+                self._entries.pop(key, None)
+                return None
+            self._entries[key] = (cached.name, now + self.ttl)
+            return cached.name
+
+    def invalidate(self, model, name):
+        # 期限切れ・削除済みで使えなかったキャッシュを捨てる (次回の呼び出しで登録し直す)
+        with self._lock:
+            self._entries.pop((model, name), None)
+
+    def config(self, model, name, **extra):
+        # (GenerateContentConfig, キャッシュを使ったか) を返す
+        cache_name = self.get(model, name)
+        if cache_name:
+            return types.GenerateContentConfig(cached_content=cache_name, **extra), True
+        return uncached_config(name, **extra), False
@@ -0,0 +1,215 @@
+# 銘柄コード・銘柄名 (かな・ローマ字の読みを含む)・業種から銘柄を探す検索インデックス
+#
+# 起動時に全銘柄から検索キーを作っておき、1回の検索は二分探索と転置索引の参照だけで済ませる。
+#   ・表記の揺れは正規化で吸収する (全角/半角・大文字/小文字・カタカナ/ひらがな)
+#   ・銘柄名の読みは、CSVのkana列 → pykakasi (インストールされている場合) → 銘柄名そのもの の順で使い、
+#     読みのかな部分はヘボン式のローマ字にも変換して「toyota」「にんてんどう」のような入力でも引けるようにする
+#   ・前方一致・部分一致で候補が足りない場合は、文字の2-gramを共有する銘柄を候補にし、
+#     キーとの類似度 (difflib) が高いものだけを曖昧一致として補う
+# 候補は「コード完全一致 > コード前方一致 > 名前・読みの前方一致 > 部分一致 > 業種一致 > 曖昧一致」の順に並べる。
+import bisect
+import difflib
+import unicodedata
+
+# 漢字の読みを自動で付ける (任意。インストールされている場合のみ利用)
+try:
+    import pykakasi
+except ImportError:
+    pykakasi = None
+
+SCORE_CODE_EXACT = 100
+SCORE_CODE_PREFIX = 90
+SCORE_NAME_PREFIX = 80
+SCORE_SUBSTRING = 60
+SCORE_INDUSTRY = 40
+SCORE_FUZZY = 30           # 曖昧一致はキーとの類似度 (0~1) を掛ける
+FUZZY_MIN_SHARED = 0.5     # 候補にする2-gramの共有率
+FUZZY_MIN_SIMILARITY = 0.7
+FUZZY_MIN_LENGTH = 3
+DEFAULT_LIMIT = 10
+
+# 検索キーから取り除く区切り文字
+SEPARATORS = str.maketrans("", "", " 　・･-_()（）&＆'")
+
+# ひらがな -> ローマ字 (ヘボン式)。拗音は2文字で先に照合する
+ROMAJI = {
+    "あ": "a", "い": "i", "う": "u", "え": "e", "お": "o",
+    "か": "ka", "き": "ki", "く": "ku", "け": "ke", "こ": "ko",
+    "さ": "sa", "し": "shi", "す": "su", "せ": "se", "そ": "so",
+    "た": "ta", "ち": "chi", "つ": "tsu", "て": "te", "と": "to",
+    "な": "na", "に": "ni", "ぬ": "nu", "ね": "ne", "の": "no",
+    "は": "ha", "ひ": "hi", "ふ": "fu", "へ": "he", "ほ": "ho",
+    "ま": "ma", "み": "mi", "む": "mu", "め": "me", "も": "mo",
+    "や": "ya", "ゆ": "yu", "よ": "yo",
+    "ら": "ra", "り": "ri", "る": "ru", "れ": "re", "ろ": "ro",
+    "わ": "wa", "ゐ": "i", "ゑ": "e", "を": "o", "ん": "n",
+    "が": "ga", "ぎ": "gi", "ぐ": "gu", "げ": "ge", "ご": "go",
+    "ざ": "za", "じ": "ji", "ず": "zu", "ぜ": "ze", "ぞ": "zo",
+    "だ": "da", "ぢ": "ji", "づ": "zu", "で": "de", "ど": "do",
+    "ば": "ba", "び": "bi", "ぶ": "bu", "べ": "be", "ぼ": "bo",
+    "ぱ": "pa", "ぴ": "pi", "ぷ": "pu", "ぺ": "pe", "ぽ": "po",
+    "ゔ": "vu", "ぁ": "a", "ぃ": "i", "ぅ": "u", "ぇ": "e", "ぉ": "o",
+    "ゃ": "ya", "ゅ": "yu", "ょ": "yo", "ゎ": "wa",
+    "きゃ": "kya", "きゅ": "kyu", "きょ": "kyo", "しゃ": "sha", "しゅ": "shu", "しょ": "sho",
+    "ちゃ": "cha", "ちゅ": "chu", "ちょ": "cho", "にゃ": "nya", "にゅ": "nyu", "にょ": "nyo",
+    "ひゃ": "hya", "ひゅ": "hyu", "ひょ": "hyo", "みゃ": "mya", "みゅ": "myu", "みょ": "myo",
+    "りゃ": "rya", "りゅ": "ryu", "りょ": "ryo", "ぎゃ": "gya", "ぎゅ": "gyu", "ぎょ": "gyo",
+    "じゃ": "ja", "じゅ": "ju", "じょ": "jo", "びゃ": "bya", "びゅ": "byu", "びょ": "byo",
+    "ぴゃ": "pya", "ぴゅ": "pyu", "ぴょ": "pyo",
+    "ふぁ": "fa", "ふぃ": "fi", "ふぇ": "fe", "ふぉ": "fo", "てぃ": "ti", "でぃ": "di",
+    "うぃ": "wi", "うぇ": "we", "うぉ": "wo", "しぇ": "she", "じぇ": "je", "ちぇ": "che",
+}
+
+
+def normalize(text):
+    # 全角英数を半角に、大文字を小文字に、カタカナをひらがなにそろえ、区切り文字を除く
+    text = unicodedata.normalize("NFKC", str(text)).lower().translate(SEPARATORS)
+    return "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c for c in text)
+
+
+def to_romaji(text):
+    # 正規化済みの文字列のかな部分をローマ字にする (かな以外の文字はそのまま残す)
+    out, i = [], 0
+    while i < len(text):
+        c = text[i]
+        if c == "っ" and i + 1 < len(text):
+            # 促音は次の音の子音を重ねる
+            following = ROMAJI.get(text[i + 1:i + 3]) or ROMAJI.get(text[i + 1])
+            if following:
+                out.append("t" if following.startswith("ch") else following[0])
+            i += 1
+            continue
+        if c == "ー":
+            # 長音は直前の母音を重ねる (「そにー」→「sonii」)
+            if out and out[-1][-1] in "aiueo":
+                out.append(out[-1][-1])
+            i += 1
+            continue
+        pair = ROMAJI.get(text[i:i + 2])
+        if pair:
+            out.append(pair)
+            i += 2
+            continue
+        out.append(ROMAJI.get(c, c))
+        i += 1
+    return "".join(out)
+
+
+def bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)} if len(text) > 1 else {text}
+
+
+class SearchIndex:
+    def __init__(self, stocks):
+        # stocks: ticker, name, industry (任意で kana) を持つ辞書のリスト
+        self.stocks = list(stocks)
+        self._tickers = {stock["ticker"] for stock in self.stocks}
+        converter = pykakasi.kakasi() if pykakasi is not None else None
+
+        prefix_keys, suffix_keys = [], []
+        self._keys = []
+        self._grams = {}
+        self._industries = {}
+        for i, stock in enumerate(self.stocks):
+            ticker = normalize(stock["ticker"])
+            name = normalize(stock["name"])
+            kana = stock.get("kana")
+            reading = normalize(kana) if isinstance(kana, str) else ""   # CSVの空欄はNaNになる
+            if not reading and converter is not None:
+                reading = normalize("".join(part["hira"] for part in converter.convert(stock["name"])))
+            keys = {name, reading or name}
+            # 長音は母音を重ねた形と省いた形の両方で引けるようにする (「sonii」「soni」)
+            keys |= {to_romaji(key) for key in keys} | {to_romaji(key.replace("ー", "")) for key in keys}
+            keys.discard("")
+            self._keys.append(keys)
+
+            # 銘柄コードは「7203.T」「7203」のどちらでも引けるようにする
+            code = ticker.split(".")[0].lstrip("^")
+            prefix_keys += [(code, i, True), (ticker, i, True)]
+            for key in keys:
+                prefix_keys.append((key, i, False))
+                # 先頭以外から始まる接尾辞を並べておき、部分一致も二分探索で探す
+                suffix_keys += [(key[start:], i) for start in range(1, len(key))]
+                for gram in bigrams(key):
+                    self._grams.setdefault(gram, set()).add(i)
+            self._industries.setdefault(normalize(stock.get("industry", "")), []).append(i)
+
+        prefix_keys.sort()
+        suffix_keys.sort()
+        self._prefix_keys = [key for key, _, _ in prefix_keys]
+        self._prefix_entries = [(i, is_code) for _, i, is_code in prefix_keys]
+        self._suffix_keys = [key for key, _ in suffix_keys]
+        self._suffix_entries = [i for _, i in suffix_keys]
+
+    def __contains__(self, ticker):
+        # 銘柄リストに載っている銘柄コードか (大文字・小文字も含めて完全一致)
+        return ticker in self._tickers
+
+    def _range(self, keys, query):
+        # queryで始まるキーの範囲 (ソート済みリスト上の添字)
+        return bisect.bisect_left(keys, query), bisect.bisect_left(keys, query + "\uffff")
+
+    def search(self, query, limit=DEFAULT_LIMIT, industry=None):
+        # (銘柄, スコア) をスコアの高い順に最大limit件返す
+        query = normalize(query)
+        if not query:
+            return []
+        scores = {}
+
+        def add(i, score):
+            if industry and self.stocks[i].get("industry") != industry:
+                return
+            if score > scores.get(i, 0):
+                scores[i] = score
+
+        start, end = self._range(self._prefix_keys, query)
+        for key, (i, is_code) in zip(self._prefix_keys[start:end], self._prefix_entries[start:end]):
+            if is_code:
+                add(i, SCORE_CODE_EXACT if key == query else SCORE_CODE_PREFIX)
+            else:
+                add(i, SCORE_NAME_PREFIX)
+
+        # 上位の一致で足りない場合だけ、部分一致・業種・曖昧一致の順に候補を広げる
+        if len(scores) < limit:
+            start, end = self._range(self._suffix_keys, query)
+            for i in self._suffix_entries[start:end]:
+                add(i, SCORE_SUBSTRING)
+        if len(scores) < limit:
+            for name, members in self._industries.items():
+                if query in name:
+                    for i in members:
+                        add(i, SCORE_INDUSTRY)
+        if len(scores) < limit and len(query) >= FUZZY_MIN_LENGTH:
+            for i, similarity in self._fuzzy(query):
+                add(i, SCORE_FUZZY * similarity)
+
+        # 同じスコアの中では、コード一致はコード順、それ以外は名前の短い順 (より完全に一致している順)
+        def order(item):
+            i, score = item
+            stock = self.stocks[i]
+            return -score, stock["ticker"] if score >= SCORE_CODE_PREFIX else len(stock["name"]), i
+
+        ranked = sorted(scores.items(), key=order)
+        return [(self.stocks[i], score) for i, score in ranked[:limit]]
+
+    def _fuzzy(self, query):
+        # クエリの2-gramを一定以上共有する銘柄に絞ってから、キーとの類似度が閾値以上の銘柄を返す
+        # (2-gramの共有だけでは「sony」と「nekuson」のように一部の音が重なるだけの銘柄も拾ってしまう)
+        # 「ソニーG」「パナソニックHD」のような接尾辞付きの名前も引けるよう、キーの先頭部分とも比べる
+        query_grams = bigrams(query)
+        counts = {}
+        for gram in query_grams:
+            for i in self._grams.get(gram, ()):
+                counts[i] = counts.get(i, 0) + 1
+        matcher = difflib.SequenceMatcher(b=query, autojunk=False)
+        for i, shared in counts.items():
+            if shared / len(query_grams) < FUZZY_MIN_SHARED:
+                continue
+            similarity = 0.0
+            for key in self._keys[i]:
+                for target in {key, key[:len(query)]}:
+                    matcher.set_seq1(target)
+                    if matcher.real_quick_ratio() > similarity and matcher.quick_ratio() > similarity:
+                        similarity = max(similarity, matcher.ratio())
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                yield i, similarity
@@ -8,8 +8,10 @@ document.addEventListener("DOMContentLoaded", () => {
   const loadingSpinner = document.getElementById("loading-spinner");
   const loadingIndicator = document.getElementById("loading-indicator");
   const ohlcDisplay = document.getElementById("ohlc-display");
+  const chartRangeSelect = document.getElementById("chartRangeSelect");
   // --- 🌟 追加：新UI要素 ---
   const runAnalysisTriggers = document.querySelectorAll(".run-analysis-trigger");
+  const marketPresets = document.querySelectorAll(".market-preset");
   const exportPdfBtn = document.getElementById("exportPdfBtn");
   const tabBtns = document.querySelectorAll(".tab-btn");
   const marketFormArea = document.getElementById("market-form-area");
@@ -21,6 +23,9 @@ document.addEventListener("DOMContentLoaded", () => {
   let currentChartData = { ticker: "", candles: [], kairi25: [] };
   let isSyncing = false; // チャート間の同期ループ防止フラグ
   let currentAbortController = null; // 🌟 追加: ロードキャンセル用
+  // 取得済みの銘柄情報 (ticker -> {ticker, name, industry})。銘柄一覧・検索APIの結果から埋める
+  const stockCache = new Map();
+  const findStock = (ticker) => stockCache.get(ticker);
 
   // --- 1. メインチャート(株価・SMA)の初期化 ---
   const chartContainer = document.getElementById("chart");
@@ -137,7 +142,9 @@ document.addEventListener("DOMContentLoaded", () => {
     }
     const data = param.seriesData.get(candleSeries);
     if (data) {
-      const { time, open, high, low, close } = data;
+      const { open, high, low, close } = data;
+      const time = data.time;
+      const timeLabel = formatChartTime(time);
       
       // 騰落率の計算：(当日終値 - 前日終値) / 前日終値
       const currentIndex = currentChartData.candles.findIndex(c => c.time === time);
@@ -153,7 +160,7 @@ document.addEventListener("DOMContentLoaded", () => {
       const color = change >= 0 ? "red" : "blue";
 
       // 業種判定: 全体指数なら小数点2桁、それ以外は整数
-      const currentStock = allStocks.find(s => s.ticker === currentChartData.ticker);
+      const currentStock = findStock(currentChartData.ticker);
       const isIndex = currentStock && currentStock.industry === "全体指数";
       
       const fmt = (val) => isIndex ? val.toFixed(2) : Math.floor(val).toLocaleString();
@@ -164,7 +171,7 @@ document.addEventListener("DOMContentLoaded", () => {
 
       ohlcDisplay.innerHTML = `
         <div style="display: flex; flex-wrap: wrap; gap: 10px;">
-          <span><b>日付:</b> ${time}</span>
+          <span><b>日付:</b> ${timeLabel}</span>
           <span><b>始値:</b> ${fmt(open)}</span>
           <span><b>高値:</b> ${fmt(high)}</span>
           <span><b>安値:</b> ${fmt(low)}</span>
@@ -178,6 +185,12 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   });
 
+  // 分足のUNIX秒(現地時刻)を表示用の文字列に変換
+  function formatChartTime(time) {
+    if (typeof time !== "number") return time;
+    return new Date(time * 1000).toISOString().slice(0, 16).replace("T", " ");
+  }
+
   // --- 4. 2つのチャートのズーム・スクロールを同期 ---
   chart.timeScale().subscribeVisibleTimeRangeChange(range => {
     if (isSyncing || !range || currentChartData.candles.length === 0) return;
@@ -194,18 +207,66 @@ document.addEventListener("DOMContentLoaded", () => {
   });
 
   // --- 5. 業種フィルタ・閲覧履歴の管理 ---
-  function updateStockList() {
-    const selected = industrySelect.value;
-    stockSelect.innerHTML = '<option value="">銘柄を選択してください</option>';
-    if (typeof allStocks === 'undefined') return;
-    const filtered = selected === "all" ? allStocks : allStocks.filter(s => s.industry === selected);
-    filtered.forEach(s => {
+  // 銘柄リストには選択中の業種の銘柄だけを並べる。「すべての業種」では全銘柄を読み込まず、
+  // 銘柄検索・閲覧履歴から選んだ銘柄だけを選択肢に加える
+  function renderStockOptions(stocks, placeholder) {
+    stockSelect.innerHTML = "";
+    const first = document.createElement("option");
+    first.value = ""; first.textContent = placeholder;
+    stockSelect.appendChild(first);
+    stocks.forEach(s => {
+      stockCache.set(s.ticker, s);
       const opt = document.createElement("option");
       opt.value = s.ticker; opt.textContent = `${s.ticker} | ${s.name}`;
       stockSelect.appendChild(opt);
     });
   }
 
+  async function updateStockList() {
+    const selected = industrySelect.value;
+    if (selected === "all") {
+      const current = findStock(stockSelect.value);
+      renderStockOptions(current ? [current] : [], "銘柄検索または業種から選択してください");
+      if (current) stockSelect.value = current.ticker;
+      return;
+    }
+    // 選択した業種の銘柄一覧をサーバーから取得する (ETagで未変更時は304)
+    let stocks = [];
+    try {
+      const res = await fetch(`/stocks?${new URLSearchParams({ industry: selected })}`);
+      stocks = (await res.json()).stocks || [];
+    } catch (e) { console.error(e); }
+    // 取得中に業種が切り替えられた場合は古い結果を捨てる
+    if (industrySelect.value !== selected) return;
+    renderStockOptions(stocks, "銘柄を選択してください");
+  }
+
+  // 銘柄の情報 (名前・業種) を返す。未取得の銘柄 (閲覧履歴など) は検索APIのコード完全一致で引く
+  async function lookupStock(ticker) {
+    if (findStock(ticker)) return findStock(ticker);
+    try {
+      const res = await fetch(`/search_stocks?${new URLSearchParams({ q: ticker, limit: 1 })}`);
+      const match = ((await res.json()).results || []).find(s => s.ticker === ticker);
+      if (match) stockCache.set(ticker, match);
+      return match;
+    } catch (e) {
+      console.error(e);
+      return undefined;
+    }
+  }
+
+  // 検索・履歴から選んだ銘柄を選択する (業種のリストにない場合は「すべて」に戻し、その銘柄だけを選択肢に加える)
+  async function selectStock(ticker) {
+    const stock = await lookupStock(ticker);
+    if (!stock) return;
+    if (!stockSelect.querySelector(`option[value="${CSS.escape(ticker)}"]`)) {
+      industrySelect.value = "all";
+      renderStockOptions([stock], "銘柄検索または業種から選択してください");
+    }
+    stockSelect.value = ticker;
+    stockSelect.dispatchEvent(new Event('change'));
+  }
+
   function saveToHistory(ticker, name) {
     let history = JSON.parse(localStorage.getItem("stock_history") || "[]");
     history = history.filter(h => h.ticker !== ticker);
@@ -221,14 +282,7 @@ document.addEventListener("DOMContentLoaded", () => {
     history.forEach(h => {
       const btn = document.createElement("button");
       btn.textContent = `${h.ticker} ${h.name}`;
-      btn.onclick = () => { 
-        if (industrySelect.value !== "all") {
-          industrySelect.value = "all";
-          updateStockList();
-        }
-        stockSelect.value = h.ticker; 
-        stockSelect.dispatchEvent(new Event('change')); 
-      };
+      btn.onclick = () => selectStock(h.ticker);
       recentList.appendChild(btn);
     });
   }
@@ -237,46 +291,52 @@ document.addEventListener("DOMContentLoaded", () => {
   updateStockList(); renderRecent();
 
   // --- 🌟 銘柄検索機能 (オートコンプリート) ---
+  // 銘柄コード・銘柄名 (かな・ローマ字)・業種での検索はサーバー側の検索インデックスで行う
   const searchResults = document.getElementById("searchResults");
   if (stockSearch && searchResults) {
-      stockSearch.addEventListener("input", (e) => {
-          const keyword = e.target.value.trim().toLowerCase();
-          if (!keyword) {
-              searchResults.style.display = "none";
-              return;
-          }
-          
-          const filtered = allStocks.filter(s => 
-              s.ticker.toLowerCase().includes(keyword) || 
-              s.name.toLowerCase().includes(keyword)
-          );
-          
+      let searchTimer = null;
+      let searchController = null;
+
+      const renderSearchResults = (results) => {
           searchResults.innerHTML = "";
-          if (filtered.length > 0) {
-              filtered.slice(0, 10).forEach(s => {
+          if (results.length > 0) {
+              results.forEach(s => {
+                  stockCache.set(s.ticker, s);
                   const item = document.createElement("button");
                   item.className = "list-group-item list-group-item-action text-start";
-                  item.innerHTML = `<span class="fw-bold">${s.ticker}</span> <span class="small ms-2">${s.name}</span>`;
+                  item.innerHTML = `<span class="fw-bold">${s.ticker}</span> <span class="small ms-2">${s.name}</span> <span class="small text-muted ms-2">${s.industry}</span>`;
                   item.onclick = () => {
                       stockSearch.value = ""; // 入力クリア
                       searchResults.style.display = "none";
-                      
-                      // 業種フィルタをリセット
-                      if (industrySelect.value !== "all") {
-                          industrySelect.value = "all";
-                          updateStockList();
-                      }
-                      
-                      stockSelect.value = s.ticker;
-                      stockSelect.dispatchEvent(new Event('change'));
+                      selectStock(s.ticker);
                   };
                   searchResults.appendChild(item);
               });
-              searchResults.style.display = "block";
           } else {
               searchResults.innerHTML = '<div class="list-group-item text-muted small">候補が見つかりません</div>';
-              searchResults.style.display = "block";
           }
+          searchResults.style.display = "block";
+      };
+
+      stockSearch.addEventListener("input", (e) => {
+          const keyword = e.target.value.trim();
+          clearTimeout(searchTimer);
+          if (searchController) searchController.abort();
+          if (!keyword) {
+              searchResults.style.display = "none";
+              return;
+          }
+
+          // 入力が落ち着いてから検索し、古い検索リクエストは中断する
+          searchTimer = setTimeout(async () => {
+              searchController = new AbortController();
+              try {
+                  const res = await fetch(`/search_stocks?${new URLSearchParams({ q: keyword })}`, { signal: searchController.signal });
+                  renderSearchResults((await res.json()).results || []);
+              } catch (e) {
+                  if (e.name !== "AbortError") console.error(e);
+              }
+          }, 120);
       });
       
       // 検索ボックス以外をクリックしたら候補を閉じる
@@ -290,20 +350,41 @@ document.addEventListener("DOMContentLoaded", () => {
   // --- 6. サーバーからデータ取得とチャートへの反映 ---
   stockSelect.addEventListener("change", async function() {
     if (!this.value) return;
-    const stockInfo = allStocks.find(s => s.ticker === this.value);
+    const stockInfo = findStock(this.value);
     if (stockInfo) {
         saveToHistory(stockInfo.ticker, stockInfo.name);
         // AI会社説明の取得開始
         fetchCompanyInfo(stockInfo.ticker, stockInfo.name);
     }
+    subscribeQuote(this.value);
+
+    await loadChartData(this.value, stockInfo);
+  });
+
+  // 表示期間を変更したら現在の銘柄を再取得
+  if (chartRangeSelect) {
+    chartRangeSelect.addEventListener("change", () => {
+      if (!stockSelect.value) return;
+      const stockInfo = findStock(stockSelect.value);
+      loadChartData(stockSelect.value, stockInfo);
+    });
+  }
 
+  async function loadChartData(ticker, stockInfo) {
+    const [period, interval] = chartRangeSelect ? chartRangeSelect.value.split("|") : ["1y", "1d"];
     try {
-      const res = await fetch("/get_data", { method: "POST", headers: {"Content-Type":"application/json"}, body: JSON.stringify({ticker: this.value}) });
+      // GETで取得し、ブラウザのHTTPキャッシュ(ETag)で未変更時は304を受け取る
+      const params = new URLSearchParams({ ticker, period, interval });
+      const res = await fetch(`/get_data?${params}`);
       const data = await res.json();
       if (data.error) return;
 
-      currentChartData = { ticker: this.value, candles: data.candles, kairi25: data.kairi25 };
+      currentChartData = { ticker: ticker, period: period, interval: interval, candles: data.candles, kairi25: data.kairi25 };
       isSyncing = true;
+
+      // 分足の場合は時刻も表示する
+      chart.applyOptions({ timeScale: { timeVisible: data.intraday } });
+      kairiChart.applyOptions({ timeScale: { timeVisible: data.intraday } });
       
       // 業種に応じてチャートの価格スケール精度を変更
       const isIndex = stockInfo && stockInfo.industry === "全体指数";
@@ -350,7 +431,10 @@ document.addEventListener("DOMContentLoaded", () => {
       // 統計情報の表示更新
       const fmtPrice = (val) => isIndex ? val.toFixed(2) : Math.floor(val).toLocaleString();
 
-      document.getElementById("stockStats").style.display = "flex";
+      const statsBox = document.getElementById("stockStats");
+      statsBox.style.display = "flex";
+      // 取得元が混み合っている間は保存済みの古いデータを表示している
+      statsBox.title = data.stale ? "アクセス集中のため、前回取得したデータを表示しています" : "";
       document.getElementById("statCap").textContent = data.stats.market_cap;
       document.getElementById("statPER").textContent = data.stats.per;
       document.getElementById("statPBR").textContent = data.stats.pbr;
@@ -365,7 +449,47 @@ document.addEventListener("DOMContentLoaded", () => {
       document.getElementById("statExDiv").textContent = data.stats.ex_div_date;
 
     } catch (e) { console.error(e); isSyncing = false; }
-  });
+  }
+
+  // --- 🌟 現在値のリアルタイム表示 (Server-Sent Events) ---
+  let quoteSource = null;
+  let quotePollTimer = null;
+  const QUOTE_POLL_MS = 15000; // サーバー側のポーリング間隔 (QUOTE_POLL_INTERVAL) に合わせる
+  function subscribeQuote(ticker) {
+    const liveQuote = document.getElementById("liveQuote");
+    if (quoteSource) quoteSource.close();
+    clearInterval(quotePollTimer);
+    if (!liveQuote) return;
+    liveQuote.textContent = "";
+
+    const renderQuote = (q) => {
+      if (!q) return;
+      const change = q.change_pct ?? 0;
+      liveQuote.style.color = change >= 0 ? "red" : "blue";
+      liveQuote.textContent = `現在値 ${q.price.toLocaleString()} (${change >= 0 ? "+" : ""}${change.toFixed(2)}%)`;
+    };
+    // SSEが使えない・接続数の上限で断られた場合は、サーバーのスナップショットを一定間隔で取得する
+    const startPolling = () => {
+      const poll = async () => {
+        try {
+          const res = await fetch(`/quotes?tickers=${encodeURIComponent(ticker)}`);
+          if (res.ok) renderQuote((await res.json()).quotes[ticker]);
+        } catch (e) { console.error(e); }
+      };
+      poll();
+      quotePollTimer = setInterval(poll, QUOTE_POLL_MS);
+    };
+    if (!window.EventSource) { startPolling(); return; }
+
+    const source = quoteSource = new EventSource(`/quotes/stream?tickers=${encodeURIComponent(ticker)}`);
+    const render = (e) => renderQuote(JSON.parse(e.data)[ticker]);
+    source.addEventListener("snapshot", render);
+    source.addEventListener("quote", render);
+    // 200以外の応答 (503) ではブラウザが再接続せずにCLOSEDになる
+    source.addEventListener("error", () => {
+      if (source === quoteSource && source.readyState === EventSource.CLOSED) startPolling();
+    });
+  }
 
   // --- 7. AI分析モード切り替えと実行 ---
   
@@ -525,9 +649,11 @@ document.addEventListener("DOMContentLoaded", () => {
           } else if (selectedMode === "tech") {
               endpoint = "/analyze";
               isFastMode = document.getElementById("tech_fast").checked;
-              // テクニカル分析には全データを送信（バックエンドで1年分として処理）
+              // テクニカル分析は直近1年間の日足が前提のため、送信直前に1年分の日足に差し替える (loadAnalysisBars)
               bodyData = {
                   ...currentChartData,
+                  period: "1y",
+                  interval: "1d",
                   beginner_mode: document.getElementById("tech_beginner").checked,
                   deep_analysis: document.getElementById("tech_deep").checked,
                   use_lite_model: isFastMode
@@ -549,7 +675,7 @@ document.addEventListener("DOMContentLoaded", () => {
       }
 
       // UI状態の更新
-      runAnalysisTriggers.forEach(b => b.disabled = true);
+      [...runAnalysisTriggers, ...marketPresets].forEach(b => b.disabled = true);
       document.getElementById("loading-container").style.display = "block";
       cancelAnalysisBtn.style.display = "inline-block"; // キャンセルボタンを表示
       loadingIndicator.textContent = msg + (isFastMode ? " (高速モード)" : "");
@@ -559,6 +685,9 @@ document.addEventListener("DOMContentLoaded", () => {
       analysisResult.style.opacity = "0.5";
 
       try {
+          if (endpoint === "/analyze") {
+              Object.assign(bodyData, await loadAnalysisBars(currentAbortController.signal));
+          }
           const res = await fetch(endpoint, {
               method: "POST",
               headers: { "Content-Type": "application/json" },
@@ -574,6 +703,9 @@ document.addEventListener("DOMContentLoaded", () => {
               if (data.date_range) {
                   content += `> **取得ニュース期間:** ${data.date_range}\n\n`;
               }
+              if (data.digest_generated_at) {
+                  content += `> **${data.digest_generated_at} に作成した市況ダイジェストです**\n\n`;
+              }
               content += (data.analysis || "分析結果が得られませんでした。");
               const htmlResult = marked.parse(content);
               analysisResult.innerHTML = htmlResult;
@@ -584,7 +716,7 @@ document.addEventListener("DOMContentLoaded", () => {
               exportPdfBtn.dataset.rawContent = content;
               
               // 銘柄名を取得
-              const currentStock = allStocks.find(s => s.ticker === currentChartData.ticker);
+              const currentStock = findStock(currentChartData.ticker);
               const stockName = currentStock ? currentStock.name : "";
               const modeName = title.replace(/## |💎 |🌍 |📊 |📈 |🔍 |レポート|結果/g, "").trim();
               const dateStr = new Date().toISOString().split('T')[0].replace(/-/g, "");
@@ -608,7 +740,7 @@ document.addEventListener("DOMContentLoaded", () => {
               analysisResult.innerHTML = "エラーが発生しました。サーバーとの通信に失敗しました。";
           }
       } finally {
-          runAnalysisTriggers.forEach(b => b.disabled = false);
+          [...runAnalysisTriggers, ...marketPresets].forEach(b => b.disabled = false);
           document.getElementById("loading-container").style.display = "none";
           cancelAnalysisBtn.style.display = "none"; // ボタンを隠す
           analysisResult.style.opacity = "1.0";
@@ -626,6 +758,17 @@ document.addEventListener("DOMContentLoaded", () => {
       });
   }
 
+  // テクニカル分析用の直近1年間の日足 (表示中のチャートが1年・日足でなければ取得し直す。ETagでブラウザキャッシュが効く)
+  async function loadAnalysisBars(signal) {
+      const { ticker, period, interval, candles, kairi25 } = currentChartData;
+      if (period === "1y" && interval === "1d") return { candles, kairi25 };
+      const params = new URLSearchParams({ ticker, period: "1y", interval: "1d" });
+      const res = await fetch(`/get_data?${params}`, { signal });
+      const data = await res.json();
+      if (data.error) throw new Error(data.error);
+      return { candles: data.candles, kairi25: data.kairi25 };
+  }
+
   // --- 8. AI会社説明の取得 ---
   async function fetchCompanyInfo(ticker, name) {
       const display = document.getElementById("companyInfoContent");
@@ -635,13 +778,16 @@ document.addEventListener("DOMContentLoaded", () => {
           const res = await fetch("/get_company_info", {
               method: "POST",
               headers: { "Content-Type": "application/json" },
-              body: JSON.stringify({ ticker, name })
+              body: JSON.stringify({ ticker })
           });
           const data = await res.json();
           if (data.error) {
               display.innerHTML = `<span style="color:red;">取得エラー: ${data.error}</span>`;
           } else {
               display.innerHTML = marked.parse(data.info);
+              if (data.generated_at) {
+                  display.innerHTML += `<div style="font-size:0.8em; color:#888; text-align:right;">${data.generated_at} 時点の情報</div>`;
+              }
           }
       } catch (e) {
           console.error(e);
@@ -716,7 +862,7 @@ document.addEventListener("DOMContentLoaded", () => {
           const modeName = titleText.replace(/💎 |🌍 |📊 |📈 |🔍 |🕵️ |レポート|結果|分析: |個別株分析: |テクニカル分析: |再調査/g, "").trim();
           const tickerMatch = titleText.match(/([A-Z0-9.^]+)$/);
           const ticker = tickerMatch ? tickerMatch[1] : (currentChartData.ticker || "");
-          const currentStock = allStocks.find(s => s.ticker === ticker);
+          const currentStock = findStock(ticker);
           const stockName = currentStock ? currentStock.name : "";
           const dateStr = new Date().toISOString().split('T')[0].replace(/-/g, "");
           
@@ -779,6 +925,17 @@ document.addEventListener("DOMContentLoaded", () => {
       btn.addEventListener("click", runAnalysis);
   });
 
+  // 市況分析の区分プリセット: その区分の標準トピックだけを選んで分析する
+  // (サーバーが毎朝作成する市況ダイジェストと同じ組み合わせになるため、作成済みのレポートがすぐに返る)
+  marketPresets.forEach(btn => {
+      btn.addEventListener("click", (e) => {
+          const topics = JSON.parse(btn.dataset.topics);
+          document.querySelectorAll('input[name="market_topic"]').forEach(cb => { cb.checked = topics.includes(cb.value); });
+          document.getElementById("market_free_keyword").value = "";
+          runAnalysis(e);
+      });
+  });
+
   // --- 11. ウィンドウリサイズ対応 ---
   window.addEventListener("resize", () => {
     chart.applyOptions({ width: chartContainer.clientWidth });
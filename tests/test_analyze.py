@@ -0,0 +1,40 @@
+# AIテクニカル分析 (/analyze) に送るチャートデータの条件を確認するテスト
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+CANDLES = [{"time": "2026-10-15", "close": 3000.0}, {"time": "2026-10-16", "close": 3010.0}]
+KAIRI = [{"time": "2026-10-16", "value": 1.234}]
+
+
+@pytest.fixture
+def prompts_sent(monkeypatch):
+    sent = []
+
+    def fake_generate(model, template, flags=None, thinking_level=None, **fields):
+        sent.append(fields)
+        return SimpleNamespace(text="分析結果")
+
+    monkeypatch.setattr(app, "client", object())
+    monkeypatch.setattr(app, "generate_from_template", fake_generate)
+    return sent
+
+
+def test_daily_bars_for_one_year_are_analyzed(prompts_sent):
+    payload = {"ticker": "7203.T", "period": "1y", "interval": "1d", "candles": CANDLES, "kairi25": KAIRI}
+    response = app.app.test_client().post("/analyze", json=payload)
+
+    assert response.status_code == 200
+    assert prompts_sent[0]["recent_candles"] == [{"t": "2026-10-15", "c": 3000.0}, {"t": "2026-10-16", "c": 3010.0}]
+
+
+@pytest.mark.parametrize("period, interval", [("5d", "5m"), ("10y", "1d")])
+def test_other_ranges_are_rejected(prompts_sent, period, interval):
+    payload = {"ticker": "7203.T", "period": period, "interval": interval, "candles": CANDLES, "kairi25": KAIRI}
+    assert app.app.test_client().post("/analyze", json=payload).status_code == 400
+    assert not prompts_sent
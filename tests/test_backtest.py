@@ -0,0 +1,39 @@
+# 簡易バックテスト (backtest.py) の取引ごとの損益集計を確認するテスト
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import backtest  # noqa: E402
+
+
+@pytest.fixture
+def fixed_positions(monkeypatch):
+    # 売買ルールの代わりに、指定したシグナルをそのまま使う
+    def use(signals):
+        monkeypatch.setattr(backtest, "strategy_positions", lambda closes, strategy, params: np.asarray(signals, dtype=np.float64))
+    return use
+
+
+def test_exit_cost_counts_against_the_closing_trade(fixed_positions):
+    # 1日目の終値で買い、3日目の終値で売る。値上がり(+0.15%)は往復コスト(0.2%)に届かない
+    fixed_positions([1, 1, 0, 0])
+    result = backtest.backtest_closes([100.0, 100.1, 100.15, 100.15], "ma_cross", {}, cost_bps=10)
+
+    assert result["trades"] == 1
+    assert result["total_return"] < 0
+    assert result["hit_rate"] == 0.0
+
+
+def test_costs_are_charged_on_entry_and_exit_days(fixed_positions):
+    fixed_positions([1, 0, 0, 1, 1, 0, 0])
+    closes = [100.0, 103.0, 101.0, 100.0, 104.0, 106.0, 105.0]
+    result = backtest.backtest_closes(closes, "ma_cross", {}, cost_bps=25)
+
+    assert result["trades"] == 2
+    assert result["hit_rate"] == 100.0
+    # 売買した日はその日の損益から片道コストを差し引く
+    equity = (1 + 0.03 - 0.0025) * (1 - 0.0025) * (1 + 0.04 - 0.0025) * (106 / 104) * (1 - 0.0025)
+    assert result["total_return"] == pytest.approx((equity - 1) * 100)
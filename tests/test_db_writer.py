@@ -0,0 +1,63 @@
+# 単一ライタースレッド (DBWriter) のジョブ統合と異常時の振る舞いを確認するテスト
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+from benchmarks.bench import slice_period, synthetic_prices  # noqa: E402
+
+
+@pytest.fixture(params=["sqlite", "columnar"])
+def store(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(app, "PRICE_STORE", request.param)
+    return request.param
+
+
+def test_coalesced_jobs_keep_rows_from_every_job(store):
+    history = synthetic_prices("7203.T", years=10)
+    recent = slice_period(history, "1y").copy()
+    recent["Close"] += 1.0
+
+    # 同じ銘柄の長期ジョブと短期ジョブを1バッチにまとめて書き込む
+    jobs = []
+    original_submit = app.db_writer.submit
+    app.db_writer.submit = lambda *args: jobs.append(args)
+    try:
+        app.store_to_db("7203.T", history, "10y")
+        app.store_to_db("7203.T", recent, "1y")
+    finally:
+        app.db_writer.submit = original_submit
+    app.db_writer._write([("bars", app.DB_PATH, (*job, 1000.0 + i), app.threading.Event()) for i, job in enumerate(jobs)])
+
+    df = app.load_from_db("7203.T", "10y", allow_stale=True)
+    assert len(df) == len(history)
+    # 重なる日付は後のジョブの値になる
+    assert df["Close"].iloc[-1] == pytest.approx(recent["Close"].iloc[-1], rel=1e-6)
+    assert df["Close"].iloc[0] == pytest.approx(history["Close"].iloc[0], rel=1e-6)
+    row = app.get_db().execute("SELECT period, fetched_at FROM price_fetches WHERE ticker = '7203.T'").fetchone()
+    assert row == ("10y", 1001.0)
+
+
+def test_writer_survives_unexpected_errors(store, monkeypatch):
+    def broken(jobs):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(app.db_writer, "_write", broken)
+    assert app.db_writer.flush(timeout=5)
+    monkeypatch.setattr(app.db_writer, "_write", type(app.db_writer)._write.__get__(app.db_writer))
+    assert app.db_writer._thread.is_alive()
+    assert app.db_writer.flush(timeout=5)
+
+
+def test_statements_are_written_by_the_writer_thread(store):
+    payload = '{"per": "10.00"}'
+    app.db_writer.execute(app.UPSERT_FUNDAMENTALS_SQL, ("7203.T", payload, 1000.0))
+    assert app.db_writer.flush(timeout=5)
+    assert app.load_stored_fundamentals("7203.T") == ({"per": "10.00"}, 1000.0)
+
+
+def test_database_uses_wal(store):
+    assert app.get_db().execute("PRAGMA journal_mode").fetchone()[0] == "wal"
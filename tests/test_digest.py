@@ -0,0 +1,25 @@
+# 市況ダイジェスト (標準トピックの組み合わせ) と画面の区分プリセットが一致していることを確認するテスト
+import json
+import os
+import re
+import sys
+from html import unescape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+def test_presets_submit_the_digest_topic_sets(monkeypatch):
+    monkeypatch.setattr(app, "DIGEST_ENABLED", False)
+    monkeypatch.setattr(app, "PROFILE_REFRESH_ENABLED", False)
+    html = app.app.test_client().get("/").get_data(as_text=True)
+
+    checkboxes = {unescape(v) for v in re.findall(r'name="market_topic" value="([^"]+)"', html)}
+    presets = [json.loads(unescape(t)) for t in re.findall(r"class=\"market-preset[^>]*data-topics='([^']+)'", html)]
+    assert len(presets) == len(app.DIGEST_TOPIC_SETS)
+
+    for (set_name, topics), preset in zip(app.DIGEST_TOPIC_SETS.items(), presets):
+        # プリセットはチェックボックスを選び直して送るため、全トピックが画面に存在する必要がある
+        assert set(preset) <= checkboxes
+        assert app.match_digest(preset, "", {}) == app.digest_key(set_name, "base")
+        assert app.match_digest(preset, "", {"short_term": True}) == app.digest_key(set_name, "short_term")
@@ -0,0 +1,24 @@
+# /metrics の公開制限 (METRICS_TOKEN) を確認するテスト
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+def test_metrics_disabled_without_token(monkeypatch):
+    monkeypatch.setattr(app, "METRICS_TOKEN", "")
+    assert app.app.test_client().get("/metrics").status_code == 404
+
+
+def test_metrics_requires_matching_token(monkeypatch):
+    monkeypatch.setattr(app, "METRICS_TOKEN", "secret")
+    http = app.app.test_client()
+
+    assert http.get("/metrics").status_code == 403
+    assert http.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 403
+
+    response = http.get("/metrics", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    assert b"http_request_duration_seconds" in response.data
+    assert http.get("/metrics?token=secret").status_code == 200
@@ -0,0 +1,92 @@
+# プロンプトの固定部分のキャッシュ (prompts.PromptCache) と、使えない場合の切り替えを確認するテスト
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+from google.genai import errors
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+import prompts  # noqa: E402
+
+CACHE_NOT_FOUND = errors.ClientError(404, {"error": {"code": 404, "message": "CachedContent not found (or permission denied)", "status": "NOT_FOUND"}})
+OVERLOADED = errors.ServerError(503, {"error": {"code": 503, "message": "The model is overloaded.", "status": "UNAVAILABLE"}})
+
+
+class StubClient:
+    # caches.create と models.generate_content の呼び出しを記録し、指定した例外を順に送出する
+    def __init__(self, create_error=None, generate_errors=()):
+        self.created = []
+        self.configs = []
+        self._create_error = create_error
+        self._generate_errors = list(generate_errors)
+        self.caches = SimpleNamespace(create=self._create)
+        self.models = SimpleNamespace(generate_content=self._generate)
+
+    def _create(self, model, config):
+        self.created.append(model)
+        if self._create_error:
+            raise self._create_error
+        return SimpleNamespace(name=f"cachedContents/{len(self.created)}")
+
+    def _generate(self, model, contents, config=None):
+        self.configs.append(config)
+        if self._generate_errors:
+            raise self._generate_errors.pop(0)
+        return SimpleNamespace(text="ok", usage_metadata=None)
+
+
+@pytest.fixture
+def use_client(monkeypatch):
+    def use(client):
+        monkeypatch.setattr(app, "client", client)
+        monkeypatch.setattr(app, "prompt_cache", prompts.PromptCache(client))
+        return client
+    return use
+
+
+def generate():
+    return app.generate_from_template(app.MODEL_LITE, "company_info", company_name="トヨタ自動車", ticker="7203.T")
+
+
+def test_cached_prompt_is_reused(use_client):
+    client = use_client(StubClient())
+    generate()
+    generate()
+
+    assert len(client.created) == 1
+    assert [c.cached_content for c in client.configs] == ["cachedContents/1", "cachedContents/1"]
+
+
+def test_falls_back_to_system_instruction_when_create_fails(use_client):
+    client = use_client(StubClient(create_error=errors.ClientError(400, {"error": {"code": 400, "message": "too few tokens"}})))
+    assert generate().text == "ok"
+
+    assert len(client.configs) == 1
+    assert client.configs[0].cached_content is None
+    assert client.configs[0].system_instruction == prompts.TEMPLATES["company_info"]["system"]
+    # 登録に失敗したテンプレートはしばらく登録し直さない
+    generate()
+    assert len(client.created) == 1
+
+
+def test_retries_without_cache_when_cached_content_is_gone(use_client):
+    client = use_client(StubClient(generate_errors=[CACHE_NOT_FOUND]))
+    assert generate().text == "ok"
+
+    assert [c.cached_content for c in client.configs] == ["cachedContents/1", None]
+    assert client.configs[1].system_instruction == prompts.TEMPLATES["company_info"]["system"]
+    # 次の呼び出しではキャッシュを登録し直す
+    generate()
+    assert len(client.created) == 2
+
+
+def test_other_errors_are_not_retried(use_client):
+    client = use_client(StubClient(generate_errors=[OVERLOADED]))
+    with pytest.raises(errors.ServerError):
+        generate()
+
+    assert len(client.configs) == 1
+    generate()
+    assert len(client.created) == 1
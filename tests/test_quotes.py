@@ -0,0 +1,65 @@
+# 現在値スナップショット (/quotes とポーリング対象の管理) を確認するテスト
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+@pytest.fixture
+def quotes(monkeypatch):
+    # 上流を呼ばずに、指定した銘柄だけ現在値が取れる状態にする
+    available = {}
+
+    def fake_fetch_quotes(tickers):
+        return {t: available[t] for t in tickers if t in available}, {t for t in tickers if t not in available}
+
+    monkeypatch.setattr(app, "fetch_quotes", fake_fetch_quotes)
+    monkeypatch.setattr(app, "quote_service", app.QuoteService())
+    return available
+
+
+def quote(ticker, price):
+    return {"ticker": ticker, "price": price, "prev_close": price, "change": 0.0, "change_pct": 0.0,
+            "as_of": "2026-10-16", "updated_at": time.time()}
+
+
+def test_unknown_tickers_are_not_watched(quotes):
+    response = app.app.test_client().get("/quotes?tickers=JUNK1,JUNK2.T")
+    assert response.status_code == 400
+    assert not app.quote_service._watched
+
+
+def test_listed_tickers_are_returned(quotes):
+    quotes["7203.T"] = quote("7203.T", 3000.0)
+    response = app.app.test_client().get("/quotes?tickers=7203.T,JUNK")
+
+    assert response.status_code == 200
+    assert response.get_json()["quotes"]["7203.T"]["price"] == 3000.0
+    assert list(app.quote_service._watched) == ["7203.T"]
+
+
+def test_failed_tickers_do_not_wait_for_first_poll(quotes):
+    http = app.app.test_client()
+    start = time.monotonic()
+    response = http.get("/quotes?tickers=6758.T")
+
+    assert response.status_code == 200
+    assert response.get_json()["quotes"] == {}
+    assert time.monotonic() - start < app.QUOTE_FIRST_WAIT
+
+    # 2回目以降は取得失敗が分かっているので待たない
+    start = time.monotonic()
+    http.get("/quotes?tickers=6758.T")
+    assert time.monotonic() - start < 0.5
+
+
+def test_watch_list_is_capped(quotes, monkeypatch):
+    monkeypatch.setattr(app, "QUOTE_MAX_WATCHED", 2)
+    service = app.quote_service
+    assert service.watch(["7203.T", "6758.T"]) == ["7203.T", "6758.T"]
+    assert service.watch(["9984.T", "7203.T"]) == ["7203.T"]
+    assert sorted(service._watched) == ["6758.T", "7203.T"]
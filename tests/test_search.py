@@ -0,0 +1,65 @@
+# 銘柄検索インデックス (search.py) の一致・並び順を確認するテスト
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import search  # noqa: E402
+
+STOCKS = [
+    {"ticker": "7203.T", "name": "トヨタ自動車", "industry": "製造業(完成品)", "kana": "トヨタジドウシャ"},
+    {"ticker": "6758.T", "name": "ソニーG", "industry": "製造業(完成品)"},
+    {"ticker": "6752.T", "name": "パナソニックHD", "industry": "製造業(完成品)"},
+    {"ticker": "3659.T", "name": "ネクソン", "industry": "情報・通信"},
+    {"ticker": "8308.T", "name": "りそなHD", "industry": "金融系"},
+    {"ticker": "6526.T", "name": "ソシオネクスト", "industry": "製造業(完成品)"},
+    {"ticker": "6724.T", "name": "セイコーエプソン", "industry": "製造業(完成品)"},
+    {"ticker": "4661.T", "name": "オリエンタルランド", "industry": "商業・サービス"},
+    {"ticker": "7974.T", "name": "任天堂", "industry": "製造業(完成品)", "kana": "ニンテンドウ"},
+]
+
+
+@pytest.fixture(scope="module")
+def index():
+    return search.SearchIndex(STOCKS)
+
+
+def names(results):
+    return [stock["name"] for stock, _ in results]
+
+
+def test_long_vowel_repeats_previous_vowel():
+    assert search.to_romaji(search.normalize("ソニー")) == "sonii"
+    assert search.to_romaji(search.normalize("キーエンス")) == "kiiensu"
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("7203", "トヨタ自動車"),
+    ("toyota", "トヨタ自動車"),
+    ("にんてんどう", "任天堂"),
+    ("nintendou", "任天堂"),
+    ("そにー", "ソニーG"),
+    ("soni", "ソニーG"),
+])
+def test_exact_and_prefix_matches_come_first(index, query, expected):
+    assert names(index.search(query))[0] == expected
+
+
+def test_fuzzy_match_ranks_the_intended_stock_alone(index):
+    assert names(index.search("sony")) == ["ソニーG"]
+    assert names(index.search("toyta")) == ["トヨタ自動車"]
+    assert names(index.search("panasonic")) == ["パナソニックHD"]
+
+
+def test_fuzzy_match_ignores_unrelated_names(index):
+    # 2-gramが少し重なるだけの銘柄は曖昧一致として返さない
+    assert "オリエンタルランド" not in names(index.search("nintenda"))
+    assert names(index.search("hitachi")) == []
+    assert names(index.search("mitsubishi")) == []
+
+
+def test_ticker_lookup_returns_the_stock_itself(index):
+    # 画面は閲覧履歴の銘柄を limit=1 のコード検索で引くため、コード完全一致が必ず先頭になる
+    for stock in STOCKS:
+        assert names(index.search(stock["ticker"], limit=1)) == [stock["name"]]
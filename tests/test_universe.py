@@ -0,0 +1,40 @@
+# 銘柄間比較 (/universe_stats) のキャッシュと計算期間の指定を確認するテスト
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+from benchmarks.bench import synthetic_prices  # noqa: E402
+
+TICKERS = ["^N225", "7203.T", "6758.T", "9984.T", "8306.T"]
+
+
+@pytest.fixture
+def http(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "DB_PATH", str(tmp_path / "test.db"))
+    for ticker in TICKERS:
+        app.store_to_db(ticker, synthetic_prices(ticker, years=2), "2y")
+    assert app.db_writer.flush(timeout=10)
+    app._price_matrix_cache.clear()
+    app._universe_cache.clear()
+    return app.app.test_client()
+
+
+def test_windows_outside_the_choices_are_rejected(http):
+    assert http.get("/universe_stats?window=61").status_code == 400
+    assert http.get("/universe_stats?window=abc").status_code == 400
+
+
+def test_price_matrix_is_shared_across_windows(http, monkeypatch):
+    monkeypatch.setattr(app, "CORR_CACHE_SIZE", 2)
+    for window in app.CORR_WINDOWS:
+        response = http.get(f"/universe_stats?period=1y&window={window}")
+        assert response.status_code == 200
+        assert response.get_json()["window"] == window
+
+    # 価格行列は期間ごとに1つだけ作り、相関行列は上限の件数 (最近使った順) だけ残す
+    assert len(app._price_matrix_cache) == 1
+    assert [key[3] for key in app._universe_cache] == list(app.CORR_WINDOWS[-2:])
+    assert sorted(http.get("/universe_stats?period=1y").get_json()["tickers"]) == sorted(TICKERS)
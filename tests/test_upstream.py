@@ -0,0 +1,107 @@
+# 外部APIの流量制限 (yfinance層で YFRateLimitError が発生した場合) の振る舞いを確認するテスト
+import os
+import sys
+import time
+
+import pytest
+from prometheus_client import REGISTRY
+from yfinance.data import YfData
+from yfinance.exceptions import YFRateLimitError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+from benchmarks.bench import synthetic_prices  # noqa: E402
+
+
+def throttled_count():
+    return REGISTRY.get_sample_value("upstream_requests_total", {"host": "yahoo", "result": "throttled"}) or 0.0
+
+
+@pytest.fixture
+def rate_limited(tmp_path, monkeypatch):
+    # Yahooへのリクエストそのものが429になる状態を再現する (yfinanceの内部で例外を起こす)
+    def too_many_requests(self, *args, **kwargs):
+        raise YFRateLimitError()
+
+    monkeypatch.setattr(YfData, "get", too_many_requests)
+    monkeypatch.setattr(YfData, "cache_get", too_many_requests)
+    monkeypatch.setattr(app, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setitem(app.UPSTREAM_LIMITS, "yahoo", app.TokenBucket(100, 100))
+    return app.app.test_client()
+
+
+def test_throttled_without_stored_data_returns_503(rate_limited):
+    before = throttled_count()
+    response = rate_limited.get("/get_data?ticker=7203.T&period=1y&interval=1d")
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(app.UPSTREAM_RETRY_AFTER)
+    assert throttled_count() == before + 1
+    # クールダウン中は上流を呼ばずにすぐ断る
+    assert app.UPSTREAM_LIMITS["yahoo"]._blocked_until > time.monotonic()
+    with pytest.raises(app.UpstreamThrottled):
+        with app.upstream("yahoo", timeout=0):
+            pass
+
+
+def test_throttled_serves_stale_stored_bars(rate_limited):
+    app.store_to_db("7203.T", synthetic_prices("7203.T", years=1), "1y", "1d")
+    app.db_writer.flush()
+    conn = app.get_db()
+    with conn:
+        conn.execute("UPDATE price_fetches SET fetched_at = 0")
+
+    response = rate_limited.get("/get_data?ticker=7203.T&period=1y&interval=1d")
+
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["stale"] is True
+    assert data["source"] == "db"
+    assert len(data["candles"]) > 0
+
+
+def test_fetch_quotes_stops_calling_after_rate_limit(rate_limited, monkeypatch):
+    monkeypatch.setattr(app, "QUOTE_FETCH_THREADS", 1)
+    before = throttled_count()
+    quotes, failed = app.fetch_quotes(["7203.T", "6758.T", "9984.T"])
+
+    # 最初の銘柄で流量制限を受けたら、残りの銘柄は上流を呼ばずに次回へ回す (失敗扱いにもしない)
+    assert quotes == {} and failed == set()
+    assert throttled_count() == before + 1
+
+
+def test_fetch_quotes_uses_one_token_per_ticker(monkeypatch):
+    monkeypatch.setitem(app.UPSTREAM_LIMITS, "yahoo", app.TokenBucket(0.001, 2))
+    monkeypatch.setattr(app, "fetch_history", lambda ticker, period, interval: synthetic_prices(ticker, years=1).tail(5))
+    quotes, failed = app.fetch_quotes(["7203.T", "6758.T", "9984.T", "8306.T"])
+
+    assert len(quotes) == 2
+    assert failed == set()
+
+
+def test_fundamentals_use_one_token_per_call(monkeypatch):
+    calls = []
+
+    class CountingTicker:
+        # fast_info・info の参照ごとに上流を1回呼んだとみなす
+        def __init__(self, ticker):
+            self.fast_info = CountingInfo({"market_cap": 3e13, "last_price": 3000.0})
+
+        @property
+        def info(self):
+            calls.append("info")
+            return {"trailingPE": 10.0, "priceToBook": 1.2, "dividendRate": 90.0}
+
+    class CountingInfo(dict):
+        def __getitem__(self, key):
+            calls.append(key)
+            return super().__getitem__(key)
+
+    bucket = app.TokenBucket(0.001, 10)
+    monkeypatch.setitem(app.UPSTREAM_LIMITS, "yahoo", bucket)
+    monkeypatch.setattr(app.yf, "Ticker", CountingTicker)
+    fundamentals = app.fetch_fundamentals("7203.T")
+
+    assert fundamentals["per"] == "10.00"
+    assert len(calls) == 3
+    assert bucket._tokens == pytest.approx(10 - len(calls), abs=0.01)